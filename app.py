@@ -1,18 +1,166 @@
 import socketio
-import json
 import asyncio
-from miner_data import MinerList, Miner
-from sanic import Sanic
+import time
+import uuid
+from miner_data import Miner
+from broadcast import Broadcaster, DEFAULT_FORMAT, available_formats, encode
+from commands import OUTPUT_INTERVAL, group_outputs
+from config import CONFIG_FILE, load_config
+from diagnostics import LoopMonitor, Profiler, task_counts
+from fleet import Fleet, rpc_methods, invoke, fleet_stats, state_event
+from shard import ShardHub, ShardCallError, spawn_shards
+from subscriptions import SubscriptionManager, PAGE_SIZE
+from metrics import registry, EMIT_SECONDS
+from sanic import Sanic, response
 
-miner_list = MinerList(Miner("192.168.1.249"))
+# load the webserver config, it is reloaded when the file changes
+config = load_config(CONFIG_FILE)
 
-# set basic data for initialization of the web server
-miner_data = miner_list.basic_data()
+# split the bench over shard processes when configured, otherwise run every miner in this process
+shard_count = config.shards.count
+
+# the miners, installer, history and discovery of this process, None when the shards run the miners
+# built by start_fleet once the server is listening, so the dashboard is up before the bench is loaded
+fleet = None
+# the same calls clients make, answered by this process
+methods = {}
+# set once fleet is built, made when the server starts
+fleet_ready = None
+
+# ip -> latest data for that miner, filled in once the fleet is built
+miner_data = {}
 running = True
+# seconds between broadcasts of whatever changed
+BROADCAST_INTERVAL = 1
+
+# tracks what clients have been sent so each cycle only sends what changed
+broadcaster = Broadcaster()
+
+# lag of the event loop and the code that blocks it, and profiles of it on demand from /debug/profile
+monitor = LoopMonitor(slow=config.diagnostics.slow_callback)
+profiler = Profiler()
+
+
+def store_miner_data(ip: str, data: dict) -> None:
+    """Keep the latest poll result of a miner for the next broadcast"""
+    miner_data[ip] = data
+
+
+def drop_miner_data(ip: str) -> None:
+    """Forget a miner that left the list"""
+    miner_data.pop(ip, None)
+
+
+# sid -> wire format each client asked for
+client_formats = {}
+# what each client subscribed to, clients with the same selector and format share a room
+subscriptions = SubscriptionManager()
+
+
+def emit_state_change(event: dict) -> None:
+    """Tell clients a miner moved to a new install state"""
+    sio.start_background_task(sio.emit, 'miner_state', event)
+
+
+def send_state_change(miner: Miner, old: str, new: str, elapsed: float) -> None:
+    emit_state_change(state_event(miner, old, new, elapsed))
+
+
+# run id -> command of every run_command still running, other clients can watch them by id
+command_runs = {}
+
+
+def command_room(run_id: str) -> str:
+    return f"command:{run_id}"
+
+
+def emit_command_output(run_id: str, lines: list) -> None:
+    """Send the lines miners printed for a command to the clients watching it"""
+    sio.start_background_task(sio.emit, 'command_output', {"id": run_id, "lines": lines},
+                              room=command_room(run_id))
+
+
+def start_fleet() -> None:
+    """Build the miners of this process from the saved states and start them"""
+    global fleet, methods
+    fleet = Fleet(config)
+    methods = rpc_methods(fleet, on_output=emit_command_output)
+    fleet.miner_list.subscribe(send_state_change)
+    miner_data.update((data["IP"], data) for data in fleet.miner_list.basic_data())
+    # polls each miner on its own timer, results land in miner_data as they come in
+    fleet.poll(on_result=store_miner_data, on_remove=drop_miner_data)
+    # the miners start a few at a time, see TokenBucket
+    fleet.start()
+    fleet_ready.set()
+    # apply changes to the config file without restarting, so clients and installs carry on
+    asyncio.create_task(fleet.watch(CONFIG_FILE))
+
+# collects the miners of every shard into miner_data, only used when the bench is sharded
+hub = None
+if shard_count:
+    bus_host, bus_port = config.shards.listen.rsplit(":", 1)
+    hub = ShardHub(miner_data, on_state=emit_state_change, on_output=emit_command_output, host=bus_host,
+                   port=int(bus_port))
+
+
+async def fleet_call(method: str, *args, ip: str = None):
+    """Call one of the rpc_methods here, on the shard that owns ip, or on every shard with the replies merged"""
+    if hub is None:
+        # a client can get in before the fleet is built, it only takes a moment
+        await fleet_ready.wait()
+        return await invoke(methods, method, args)
+    if ip is not None:
+        return await hub.call(method, *args, ip=ip)
+    return await hub.call_all(method, *args)
+
+
+def current_stats() -> dict:
+    """Counts for /metrics, from this process or summed over the shards"""
+    if hub is not None:
+        return hub.stats_total()
+    return fleet_stats(fleet) if fleet is not None else {}
+
+
+# values read from the miners, pools and installer when /metrics is scraped
+registry.callback("miners", "Miners on the bench by install state", lambda: current_stats().get("states", {}),
+                  labelnames=("state",))
+registry.callback("miners_health", "Miners by health verdict", lambda: current_stats().get("health", {}),
+                  labelnames=("status",))
+registry.callback("installs_completed_total", "Firmware installs that finished",
+                  lambda: current_stats().get("installs_completed", 0), metric_type="counter")
+registry.callback("installs_failed_total", "Firmware installs that failed",
+                  lambda: current_stats().get("installs_failed", 0), metric_type="counter")
+registry.callback("ssh_connections_open", "SSH connections open in the pool",
+                  lambda: current_stats().get("ssh_connections", 0))
+registry.callback("api_connections_open", "TCP connections to miner APIs kept open",
+                  lambda: current_stats().get("api_connections", 0))
+registry.callback("installer_processes_running", "Installer processes running",
+                  lambda: current_stats().get("processes_running", 0))
+registry.callback("installer_processes_waiting", "Installer processes waiting for a free slot",
+                  lambda: current_stats().get("processes_waiting", 0))
+registry.callback("miners_warming_up", "Miners waiting for their turn to start",
+                  lambda: current_stats().get("warmup_waiting", 0))
+registry.callback("upload_bytes_total", "Bytes of config and referral sent to miners",
+                  lambda: current_stats().get("bytes_uploaded", 0), metric_type="counter")
+registry.callback("uploads_active", "Files being sent to miners",
+                  lambda: current_stats().get("uploads_active", 0))
+registry.callback("asyncio_tasks", "Live asyncio tasks by what they run", lambda: task_counts(),
+                  labelnames=("category",))
+registry.callback("clients_connected", "Dashboard clients connected", lambda: len(client_formats))
+registry.callback("shards_connected", "Shard processes connected to this one",
+                  lambda: len(hub.shards) if hub is not None else 0)
 
 # configure the web server
 app = Sanic("App")
 
+
+@app.listener("before_server_start")
+async def create_events(_app, _loop) -> None:
+    global fleet_ready
+    fleet_ready = asyncio.Event()
+    monitor.start()
+
+
 app.static('/', "./public/index.html")
 app.static('/sio_events.js', "./public/sio_events.js")
 app.static('/sio.js', "./public/sio.js")
@@ -20,86 +168,355 @@ app.static('/graph_options.js', "./public/graph_options.js")
 app.static('/generate_graphs.js', "./public/generate_graphs.js")
 app.static('/create_layout.js', "./public/create_layout.js")
 
+
+@app.route('/metrics')
+async def metrics(_request):
+    """Prometheus scrape endpoint"""
+    return response.text(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def debug_loop(_request):
+    """Event loop lag, live tasks by what they run, and the latest stalls with the code that caused them"""
+    return response.json(monitor.report())
+
+
+async def start_profile(request):
+    """Start profiling the event loop, ?mode=stack (the default, cheap enough for a loaded bench) or ?mode=cprofile"""
+    try:
+        profiler.start(request.args.get("mode", "stack"))
+    except ValueError as e:
+        return response.json({"ok": False, "error": str(e)}, status=400)
+    return response.json({"ok": True, "mode": profiler.mode})
+
+
+async def stop_profile(request):
+    """Stop profiling and return the report, ?format=collapsed gives just the stacks for a flame graph tool"""
+    report = profiler.stop()
+    if report is None:
+        return response.json({"error": "no profile is running"}, status=409)
+    if report["mode"] == "cprofile":
+        return response.text(report["stats"])
+    if request.args.get("format") == "collapsed":
+        return response.text(report["collapsed"])
+    return response.json(report)
+
+
+if config.diagnostics.routes:
+    app.add_route(debug_loop, '/debug/loop')
+    app.add_route(start_profile, '/debug/profile/start')
+    app.add_route(stop_profile, '/debug/profile/stop')
+
+
 # attach socketio
 sio = socketio.AsyncServer(async_mode="sanic")
 sio.attach(app)
 
-async def cb(data):
-    """Callback to print data from client"""
-    print(data)
+async def send_deltas(deltas: list) -> None:
+    """Send each subscription the changes to its miners, serialized once per format"""
+    for subscription, delta in deltas:
+        for fmt in subscription.formats():
+            payload = encode(delta, fmt)
+            with EMIT_SECONDS.time(format=fmt):
+                await sio.emit('miner_delta', payload, room=subscription.room(fmt))
+
+
+async def subscribe_client(sid: str, selector: dict, fmt: str, page_size: int = PAGE_SIZE) -> dict:
+    """
+    Put a client in the room for selector and send it the snapshot of those miners in pages
 
+    The snapshot is taken in the same step the client joins the room, so
+    the deltas it gets from then on apply on top of the pages. Raises
+    ValueError if the selector isn't valid.
+    """
+    subscription, old_room = subscriptions.subscribe(sid, selector, fmt, broadcaster.last)
+    if old_room is not None:
+        sio.leave_room(sid, old_room)
+    sio.enter_room(sid, subscription.room(fmt))
+    pages = subscriptions.pages(subscription, broadcaster.last, page_size)
+    for page in pages:
+        await sio.emit('miner_page', encode(page, fmt), to=sid)
+    return {"ok": True, "total": pages[0]["total"], "pages": len(pages)}
 
-async def send_install_data(data):
-    """Send install data to all clients"""
-    await sio.emit('install_data', json.dumps(data), callback=cb)
+
+@sio.event
+async def connect(sid, _environ, auth=None) -> None:
+    """
+    Event for connection
+
+    auth can hold {"selector": {...}, "page_size": n} so a client that
+    only wants a few miners never gets the whole bench, see subscribe.
+    """
+    client_formats[sid] = DEFAULT_FORMAT
+    auth = auth if isinstance(auth, dict) else {}
+    try:
+        await subscribe_client(sid, auth.get("selector"), DEFAULT_FORMAT, int(auth.get("page_size", PAGE_SIZE)))
+    except (TypeError, ValueError):
+        # a bad selector gets the whole bench rather than nothing
+        await subscribe_client(sid, {}, DEFAULT_FORMAT)
 
 
-async def send_data(data):
-    """Send miner data to all clients"""
-    await sio.emit('miner_data', json.dumps(data), callback=cb)
+@sio.event
+async def disconnect(sid) -> None:
+    """Event for disconnection"""
+    client_formats.pop(sid, None)
+    subscriptions.unsubscribe(sid)
 
 
 @sio.event
-async def connect(sid, _environ) -> None:
-    """Event for connection"""
-    global miner_data
-    if miner_data is not None:
-        data = {"miners": miner_data}
-        # send some basic miner data
-        await sio.emit('miner_data', json.dumps(data), callback=cb, to=sid)
+async def subscribe(sid, request: dict) -> dict:
+    """
+    Event to only get some of the miners, request is {"selector": {...}, "page_size": n (optional)}
+
+    The selector can have "ips", "cidr", "state" and "unhealthy", an empty
+    one is the whole bench. The snapshot of the selected miners is sent
+    again as miner_page events, then only their deltas.
+    """
+    try:
+        return await subscribe_client(sid, request.get("selector"), client_formats.get(sid, DEFAULT_FORMAT),
+                                      int(request.get("page_size", PAGE_SIZE)))
+    except (AttributeError, TypeError, ValueError) as e:
+        return {"ok": False, "error": str(e)}
+
+
+@sio.event
+async def set_format(sid, fmt: str) -> bool:
+    """
+    Event to pick the wire format for this client, resends the snapshot in that format
+
+    The dashboard in public only reads JSON, msgpack is for custom clients
+    that decode it themselves
+    """
+    if fmt not in available_formats():
+        return False
+    client_formats[sid] = fmt
+    subscription = subscriptions.by_sid.get(sid)
+    await subscribe_client(sid, subscription.selector if subscription is not None else {}, fmt)
+    return True
 
 
 @sio.event
 async def pause(_sid, ip: str) -> None:
     """Event to pause a miner"""
-    await miner_list.pause(ip)
+    await fleet_call("pause", ip, ip=ip)
 
 
 @sio.event
 async def unpause(_sid, ip: str) -> None:
     """Event to unpause a miner"""
-    await miner_list.unpause(ip)
+    await fleet_call("unpause", ip, ip=ip)
 
 
 @sio.event
 async def check_pause(_sid, ip: str) -> bool:
     """Event to check if a miner is paused"""
-    result = await miner_list.check_pause(ip)
+    result = await fleet_call("check_pause", ip, ip=ip)
     return result
 
 
 @sio.event
 async def light(_sid, ip: str) -> None:
     """Event to turn on the fault light of a miner"""
-    await miner_list.light(ip)
+    await fleet_call("light", ip, ip=ip)
 
 
 @sio.event
 async def unlight(_sid, ip: str) -> None:
     """Event to turn off the fault light of a miner"""
-    await miner_list.unlight(ip)
+    await fleet_call("unlight", ip, ip=ip)
 
 
 @sio.event
 async def check_light(_sid, ip: str) -> bool:
     """Event to check if a fault light on a miner is on"""
-    result = await miner_list.check_light(ip)
+    result = await fleet_call("check_light", ip, ip=ip)
     return result
 
 
+@sio.event
+async def batch(_sid, request: dict) -> dict:
+    """
+    Event to run pause, unpause, light, unlight or reboot on many miners in one round trip
+
+    request is {"action": ..., "selector": {"ips": [...], "cidr": ..., "state": ..., "tags": [...]}},
+    the reply has the result for every selected miner
+    """
+    try:
+        return await fleet_call("batch", request["action"], request.get("selector", {}))
+    except (KeyError, ValueError, ShardCallError) as e:
+        return {"action": request.get("action"), "error": str(e), "ok": 0, "failed": 0, "results": {}}
+
+
+@sio.event
+async def distribute(_sid, request: dict) -> dict:
+    """
+    Event to push the config or referral to many installed miners at once
+
+    request is {"artifact": "config" or "referral", "selector": {...}}, the
+    reply has the result and throughput for every selected miner
+    """
+    try:
+        return await fleet_call("distribute", request["artifact"], request.get("selector", {}))
+    except (KeyError, ValueError, ShardCallError) as e:
+        return {"artifact": request.get("artifact"), "error": str(e), "sent": 0, "resumed": 0, "skipped": 0,
+                "failed": 0, "bytes": 0, "results": {}}
+
+
+async def finish_command(run_id: str, command: str, selector: dict, timeout: float or None) -> None:
+    """Wait for a command to finish on every miner and send the watchers the miners grouped by output"""
+    try:
+        summary = group_outputs(command, await fleet_call("run_command", run_id, command, selector, timeout) or {})
+        summary["error"] = None
+    except (ValueError, ShardCallError) as e:
+        summary = {**group_outputs(command, {}), "error": str(e)}
+    summary["id"] = run_id
+    # the last lines are still on their way
+    await asyncio.sleep(OUTPUT_INTERVAL)
+    await sio.emit('command_done', summary, room=command_room(run_id))
+    del command_runs[run_id]
+    await sio.close_room(command_room(run_id))
+
+
+@sio.event
+async def run_command(sid, request: dict) -> dict:
+    """
+    Event to run a shell command on many miners at once, for diagnostics
+
+    request is {"command": ..., "selector": {...}, "timeout": seconds per
+    miner (optional)}, the reply is {"id", "error"}. What the miners print
+    comes as command_output events {"id", "lines": [[ip, stream, line], ...]},
+    then the miners grouped by output as one command_done event, so 200
+    replies read as 180 alike and 20 that differ.
+    """
+    try:
+        command = request["command"]
+        if not isinstance(command, str) or not command.strip():
+            raise ValueError("command is empty")
+        selector = request.get("selector", {})
+        timeout = float(request["timeout"]) if request.get("timeout") else None
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return {"id": None, "error": str(e)}
+    run_id = uuid.uuid4().hex[:12]
+    command_runs[run_id] = command
+    sio.enter_room(sid, command_room(run_id))
+    sio.start_background_task(finish_command, run_id, command, selector, timeout)
+    return {"id": run_id, "error": None}
+
+
+@sio.event
+async def watch_command(sid, run_id: str) -> bool:
+    """Event to get the output of a command another client started, False if it already finished"""
+    if run_id not in command_runs:
+        return False
+    sio.enter_room(sid, command_room(run_id))
+    return True
+
+
+@sio.event
+async def tag(_sid, request: dict) -> list or dict:
+    """
+    Event to tag the miners matching a selector, request is {"selector": {...}, "tags": [...]}
+
+    The reply is the IPs tagged, or {"error": ...} for a bad request
+    """
+    try:
+        return await fleet_call("tag", request["selector"], request["tags"])
+    except (KeyError, TypeError, ValueError, ShardCallError) as e:
+        return {"error": str(e)}
+
+
+@sio.event
+async def untag(_sid, request: dict) -> list or dict:
+    """
+    Event to untag the miners matching a selector, request is {"selector": {...}, "tags": [...]}
+
+    The reply is the IPs untagged, or {"error": ...} for a bad request
+    """
+    try:
+        return await fleet_call("untag", request["selector"], request["tags"])
+    except (KeyError, TypeError, ValueError, ShardCallError) as e:
+        return {"error": str(e)}
+
+
+@sio.event
+async def get_logs(_sid, request: dict) -> dict:
+    """Event to get install log entries newer than the given sequence number for each IP"""
+    return await fleet_call("get_logs", request.get("since", {}), request.get("format", "entries"))
+
+
+@sio.event
+async def history(_sid, request: dict) -> dict:
+    """
+    Event to get a window of history for several miners in one reply
+
+    request is {"ips": [...], "start": unix time, "end": unix time (optional),
+    "metrics": [...] (optional), "tier": "5s", "1m" or "1h" (optional)}
+    """
+    try:
+        # pin the end so every shard reads the same window
+        request = {**request, "end": request.get("end") or time.time()}
+        return await fleet_call("history", request)
+    except (AttributeError, TypeError, ValueError, ShardCallError) as e:
+        return {"tier": None, "series": {}, "error": str(e)}
+
+
+@sio.event
+async def state_times(_sid) -> dict:
+    """Event to get the seconds each miner has spent in each install state"""
+    return await fleet_call("state_times")
+
+
+@sio.event
+async def install_stats(_sid) -> dict:
+    """Event to get install throughput and rollout state"""
+    return await fleet_call("install_stats")
+
+
+@sio.event
+async def resume_installs(_sid) -> dict:
+    """Event to resume an install rollout halted by failures"""
+    return await fleet_call("resume_installs")
+
+
+@sio.event
+async def install_priority(_sid, request: dict) -> bool:
+    """Event to move a waiting miner up or down the install queue, lower priority goes first"""
+    try:
+        return await fleet_call("install_priority", request["ip"], int(request["priority"]), ip=request["ip"])
+    except KeyError:
+        # not a miner any shard has
+        return False
+
+
+@sio.event
+async def install_history(_sid, ip: str) -> list:
+    """Event to get the latest install outcomes of a miner, kept across restarts"""
+    try:
+        return await fleet_call("install_history", ip, ip=ip)
+    except KeyError:
+        return []
+
+
 async def run() -> None:
     """Run loop for getting miner data"""
-    global miner_list
     global running
-    # run the install process
-    asyncio.create_task(miner_list.install())
+    if hub is not None:
+        # the shards run the installs, discovery and polling, and publish their miners to the hub
+        await hub.start()
+        if config.shards.spawn:
+            await spawn_shards(shard_count, hub.host, hub.port, CONFIG_FILE)
+    else:
+        # the server is listening already, now load the bench, run the installs, discovery and polls
+        start_fleet()
     while running:
-        global miner_data
-        # get miner data
-        miner_data = await miner_list.get_data()
-        # send miner data
-        sio.start_background_task(send_data, {"miners": miner_data})
-        await sio.sleep(5)
+        if hub is None:
+            # the shards judge their own miners before publishing them
+            fleet.health.evaluate()
+        # send only what changed since the last broadcast
+        delta = broadcaster.delta(list(miner_data.values()))
+        if delta is not None:
+            # split it up right away, subscriptions made before the next cycle start from this state
+            sio.start_background_task(send_deltas, subscriptions.dispatch(delta, broadcaster.last))
+        await sio.sleep(BROADCAST_INTERVAL)
 
 # run the main loop
 app.add_task(run)
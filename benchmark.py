@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from broadcast import Broadcaster, encode
+from metrics import POLL_SECONDS
+from miner_data import Miner, MinerList
+from poller import PollScheduler
+
+# fleet sizes measured unless told otherwise
+SIZES = (10, 100, 1000, 5000)
+# broadcast cycles measured per size, after every miner has been polled once
+CYCLES = 5
+# seconds between polls of each miner and between broadcasts, the webserver broadcasts every second
+INTERVAL = 1.0
+
+
+async def start_simulator(count: int, latency: float, failure_rate: float):
+    """Run the simulator in its own process so its CPU doesn't count against ours"""
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulator.py"),
+        "--count", str(count), "--services", "api", "--latency", str(latency),
+        "--failure-rate", str(failure_rate),
+        stdout=asyncio.subprocess.PIPE, limit=16 * 1024 * 1024)
+    # the simulator prints where its miners listen once they are all up
+    line = await proc.stdout.readline()
+    if not line:
+        await proc.wait()
+        raise RuntimeError("simulator exited before starting")
+    return proc, json.loads(line)
+
+
+def poll_totals() -> tuple:
+    """Polls finished so far and the seconds they took, from the poll histogram"""
+    totals = {name: value for name, _labels, value in POLL_SECONDS.samples()}
+    return totals.get("miner_poll_seconds_count", 0), totals.get("miner_poll_seconds_sum", 0.0)
+
+
+async def measure(count: int, cycles: int, latency: float, failure_rate: float, interval: float) -> dict:
+    """Poll a simulated fleet like the webserver does, and measure its hot path"""
+    proc, ports = await start_simulator(count, latency, failure_rate)
+    scheduler = None
+    try:
+        miner_list = MinerList(*[Miner(port["ip"], api_port=port["api"]) for port in ports])
+        for miner in miner_list.miners.values():
+            # skip the install, go straight to polling the API
+            miner.firmware.set()
+        miner_data = {}
+        failed = 0
+
+        def on_result(ip: str, data: dict) -> None:
+            nonlocal failed
+            miner_data[ip] = data
+            if not miner_list.miners[ip].polled_ok:
+                failed += 1
+
+        # each miner on its own timer, every miner polled about once per broadcast
+        scheduler = PollScheduler(miner_list, on_result)
+        scheduler.fast_interval = scheduler.normal_interval = scheduler.slow_interval = interval
+        scheduler.start()
+        broadcaster = Broadcaster()
+
+        # warm up until every miner answered once, then the first full snapshot a connecting client gets
+        deadline = time.perf_counter() + interval * 2 + scheduler.timeout
+        while len(miner_data) < count and time.perf_counter() < deadline:
+            await asyncio.sleep(interval / 10)
+        broadcaster.delta(list(miner_data.values()))
+        snapshot_bytes = len(encode(broadcaster.snapshot()))
+
+        broadcasts, delta_bytes = [], []
+        failed = 0
+        polls_start, poll_seconds_start = poll_totals()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(cycles):
+            await asyncio.sleep(interval)
+            broadcast_start = time.perf_counter()
+            delta = broadcaster.delta(list(miner_data.values()))
+            payload = encode(delta) if delta is not None else ""
+            broadcasts.append(time.perf_counter() - broadcast_start)
+            delta_bytes.append(len(payload))
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        polls_end, poll_seconds_end = poll_totals()
+        polls = polls_end - polls_start
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+        proc.terminate()
+        await proc.wait()
+    for miner in miner_list.miners.values():
+        await miner.close()
+
+    return {
+        "miners": count,
+        "polls_per_second": round(polls / wall, 1),
+        "poll_ms_mean": round((poll_seconds_end - poll_seconds_start) / polls * 1000, 1) if polls else None,
+        "broadcast_ms_mean": round(statistics.mean(broadcasts) * 1000, 1),
+        "broadcast_ms_max": round(max(broadcasts) * 1000, 1),
+        "cpu_ms_per_cycle": round(cpu / cycles * 1000, 1),
+        "cpu_us_per_poll": round(cpu / polls * 1e6, 1) if polls else None,
+        "snapshot_bytes": snapshot_bytes,
+        "delta_bytes_mean": round(statistics.mean(delta_bytes)),
+        "failed_polls": failed,
+    }
+
+
+async def run(args) -> list[dict]:
+    results = []
+    for count in args.sizes:
+        result = await measure(count, args.cycles, args.latency, args.failure_rate, args.interval)
+        results.append(result)
+        print("  ".join(f"{key}={value}" for key, value in result.items()), flush=True)
+    return results
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark polling and broadcasting against simulated miners")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=list(SIZES), help="comma separated fleet sizes")
+    parser.add_argument("--cycles", type=int, default=CYCLES, help="broadcast cycles measured per size")
+    parser.add_argument("--interval", type=float, default=INTERVAL,
+                        help="seconds between polls of each miner and between broadcasts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every miner reply")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance a miner drops a connection")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args(sys.argv[1:])
+    benchmark_results = asyncio.run(run(arguments))
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
@@ -0,0 +1,89 @@
+import json
+
+from metrics import ENCODE_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# wire format every client starts with
+DEFAULT_FORMAT = "json"
+
+
+def available_formats() -> list[str]:
+    """Formats a client can ask for with the set_format event"""
+    formats = ["json"]
+    if msgpack is not None:
+        formats.append("msgpack")
+    return formats
+
+
+def encode(data, fmt: str = DEFAULT_FORMAT) -> str or bytes:
+    """
+    Serialize data for a client
+
+    JSON goes out as text (using orjson when it is installed, it is several
+    times faster than json), msgpack goes out as binary.
+    """
+    with ENCODE_SECONDS.time(format=fmt):
+        if fmt == "msgpack":
+            return msgpack.packb(data)
+        if orjson is not None:
+            return orjson.dumps(data).decode('utf-8')
+        return json.dumps(data)
+
+
+class Broadcaster:
+    """
+    Turns each poll of the fleet into a delta against the last one sent
+
+    Clients get a full snapshot when they connect and after that only the
+    fields of each miner that changed:
+        {"changed": {ip: {field: value}},   fields to update on a known miner
+         "replaced": {ip: {...}},           new miners, or miners whose fields were added or dropped
+         "removed": [ip]}                   miners that are gone
+    """
+    def __init__(self):
+        # ip -> copy of the last data sent for that miner
+        self.last = {}
+
+    def snapshot(self) -> dict:
+        """Full state as last sent, for a newly connected client"""
+        return {"miners": list(self.last.values())}
+
+    def delta(self, miners: list[dict]) -> dict or None:
+        """Diff a poll against the last one, returns None if nothing changed"""
+        changed = {}
+        replaced = {}
+        current = {}
+        for data in miners:
+            ip = data["IP"]
+            # data can be a dict the miner keeps mutating, so keep our own copy
+            data = dict(data)
+            current[ip] = data
+            old = self.last.get(ip)
+            if old is None or old.keys() != data.keys():
+                replaced[ip] = data
+                continue
+            fields = {key: value for key, value in data.items() if old[key] != value}
+            if fields:
+                changed[ip] = fields
+        removed = [ip for ip in self.last if ip not in current]
+        self.last = current
+
+        if not (changed or replaced or removed):
+            return None
+        delta = {}
+        if changed:
+            delta["changed"] = changed
+        if replaced:
+            delta["replaced"] = replaced
+        if removed:
+            delta["removed"] = removed
+        return delta
@@ -0,0 +1,79 @@
+import asyncio
+import ipaddress
+
+# miners a command runs on at once when fanned out over the bench
+COMMAND_CONCURRENCY = 64
+# seconds a command may run on one miner before it is given up on
+COMMAND_TIMEOUT = 30
+# characters of stdout and of stderr kept per miner, diagnostics that print more are cut short
+MAX_OUTPUT = 64 * 1024
+# seconds output lines are collected before they are sent on, so a chatty command is a few messages a second
+OUTPUT_INTERVAL = 0.2
+
+
+class OutputBuffer:
+    """
+    Collects the lines commands print on many miners and hands them on in batches
+
+    add() is the on_line callback of MinerList.fan_out, sink(lines) gets
+    [[ip, stream, line], ...] at most every OUTPUT_INTERVAL, and once more
+    from close() with whatever is left.
+    """
+    def __init__(self, sink, interval: float = OUTPUT_INTERVAL):
+        self.sink = sink
+        self.interval = interval
+        self._lines = []
+        self._handle = None
+
+    def add(self, ip: str, stream: str, line: str) -> None:
+        self._lines.append([ip, stream, line])
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._lines:
+            lines, self._lines = self._lines, []
+            self.sink(lines)
+
+    def close(self) -> None:
+        self.flush()
+
+
+def group_outputs(command: str, results: dict) -> dict:
+    """
+    Group the results of a fanned out command by what each miner printed
+
+    results is ip -> {"exit_status", "stdout", "stderr", "error", "seconds"}.
+    Miners with the same exit status, error and output (ignoring trailing
+    whitespace) share a group, largest group first, so 200 replies read as
+    one group of 180 and the 20 that differ from it. Returns {"command",
+    "total", "ok", "failed", "timed_out", "differ", "groups": [{"count",
+    "ips", "exit_status", "error", "stdout", "stderr"}], "results": {ip:
+    {"group", "exit_status", "error", "seconds"}}}.
+    """
+    groups = {}
+    for ip, result in results.items():
+        key = (result["exit_status"], result["error"], result["stdout"].rstrip(), result["stderr"].rstrip())
+        groups.setdefault(key, []).append(ip)
+    ordered = sorted(groups.items(), key=lambda item: (-len(item[1]), min(ipaddress.ip_address(ip) for ip in item[1])))
+
+    summary = {"command": command, "total": len(results), "ok": 0, "failed": 0, "timed_out": 0,
+               "differ": len(results) - len(ordered[0][1]) if ordered else 0, "groups": [], "results": {}}
+    for index, ((exit_status, error, stdout, stderr), ips) in enumerate(ordered):
+        ips.sort(key=ipaddress.ip_address)
+        summary["groups"].append({"count": len(ips), "ips": ips, "exit_status": exit_status, "error": error,
+                                  "stdout": stdout, "stderr": stderr})
+        for ip in ips:
+            result = results[ip]
+            summary["results"][ip] = {"group": index, "exit_status": exit_status, "error": error,
+                                      "seconds": result["seconds"]}
+            if result.get("timed_out"):
+                summary["timed_out"] += 1
+            if exit_status == 0 and error is None:
+                summary["ok"] += 1
+            else:
+                summary["failed"] += 1
+    return summary
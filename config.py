@@ -0,0 +1,316 @@
+import asyncio
+import ipaddress
+import os
+import re
+from dataclasses import dataclass, field, fields
+
+from commands import COMMAND_CONCURRENCY, COMMAND_TIMEOUT
+from distribution import UPLOAD_BANDWIDTH, MAX_UPLOADS
+from diagnostics import SLOW_CALLBACK
+from discovery import PORTS as DISCOVERY_PORTS, PROBE_TIMEOUT, CONCURRENCY as DISCOVERY_CONCURRENCY
+from installer import MAX_CONCURRENT, CANARY, BATCH_SIZE, MAX_FAILURE_RATIO
+from miner_api import API_PORT, MAX_CONCURRENT_REQUESTS, CONNECT_TIMEOUT as API_CONNECT_TIMEOUT, READ_TIMEOUT
+from miner_data import USERNAME, PASSWORD, BATCH_CONCURRENCY, UNLOCK_TIMEOUT, INSTALL_TIMEOUT
+from poller import FAST_INTERVAL, NORMAL_INTERVAL, SLOW_INTERVAL, MAX_BACKOFF, POLL_TIMEOUT
+from processes import MAX_PROCESSES
+from ssh_pool import MAX_CONNECTIONS, CONNECT_TIMEOUT as SSH_CONNECT_TIMEOUT, IDLE_TIMEOUT
+from warmup import WARMUP_RATE, WARMUP_BURST
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+try:
+    import watchgod
+except ImportError:
+    watchgod = None
+
+# settings of the webserver, the config pushed to the miners is ./files/config.toml
+CONFIG_FILE = "settings.toml"
+# where the firmware tarball is looked for when the config doesn't name one
+FILES_DIR = os.path.join(os.getcwd(), "files")
+# seconds between checks of the config file when watchgod isn't installed
+RELOAD_POLL_INTERVAL = 2
+
+
+class ConfigError(ValueError):
+    """The config file is not valid TOML, or has a setting that doesn't exist, has the wrong type or is out of range"""
+
+
+@dataclass
+class Credentials:
+    """SSH login of the miners once they run the firmware"""
+    username: str = USERNAME
+    password: str = PASSWORD
+
+
+@dataclass
+class Ports:
+    """Ports of the miners, the same on every miner of the bench"""
+    api: int = API_PORT
+    http: int = 80
+    ssh: int = 22
+
+
+@dataclass
+class Limits:
+    """Caps on what runs at once across the whole bench"""
+    ssh_connections: int = MAX_CONNECTIONS
+    api_requests: int = MAX_CONCURRENT_REQUESTS
+    batch: int = BATCH_CONCURRENCY
+    # miners started per second, after the first warmup_burst, 0 for no pacing
+    warmup_rate: float = WARMUP_RATE
+    warmup_burst: int = WARMUP_BURST
+    # megabytes a second across every upload to the miners, 0 for no limit
+    upload_bandwidth: float = UPLOAD_BANDWIDTH
+    uploads: int = MAX_UPLOADS
+    # miners a command fanned out over the bench runs on at once
+    commands: int = COMMAND_CONCURRENCY
+
+
+@dataclass
+class Timeouts:
+    """Seconds each kind of operation may take"""
+    api_connect: float = API_CONNECT_TIMEOUT
+    api_read: float = READ_TIMEOUT
+    ssh_connect: float = SSH_CONNECT_TIMEOUT
+    ssh_idle: float = IDLE_TIMEOUT
+    unlock: float = UNLOCK_TIMEOUT
+    install: float = INSTALL_TIMEOUT
+    # per miner, for commands fanned out over the bench
+    command: float = COMMAND_TIMEOUT
+
+
+@dataclass
+class PollSettings:
+    """Seconds between polls of a miner, by what it is doing"""
+    fast: float = FAST_INTERVAL
+    normal: float = NORMAL_INTERVAL
+    slow: float = SLOW_INTERVAL
+    max_backoff: float = MAX_BACKOFF
+    timeout: float = POLL_TIMEOUT
+
+
+@dataclass
+class DiscoverySettings:
+    subnets: list = field(default_factory=list)
+    interval: float = 60
+    ports: list = field(default_factory=lambda: list(DISCOVERY_PORTS))
+    timeout: float = PROBE_TIMEOUT
+    concurrency: int = DISCOVERY_CONCURRENCY
+    remove_after: int = 3
+
+
+@dataclass
+class InstallSettings:
+    # firmware tarball to install, empty to use the newest one in ./files
+    firmware: str = ""
+    max_concurrent: int = MAX_CONCURRENT
+    canary: int = CANARY
+    batch_size: int = BATCH_SIZE
+    max_failure_ratio: float = MAX_FAILURE_RATIO
+    max_processes: int = MAX_PROCESSES
+
+
+@dataclass
+class ShardSettings:
+    count: int = 0
+    by: str = "hash"
+    listen: str = "127.0.0.1:4100"
+    spawn: bool = True
+
+
+@dataclass
+class DiagnosticsSettings:
+    """Read when the process starts"""
+    # seconds the event loop may be blocked before the code blocking it is logged
+    slow_callback: float = SLOW_CALLBACK
+    # serve /debug/loop and the profiler under /debug/profile
+    routes: bool = True
+
+
+# settings that size a pool or a wait and stall it at 0 or below, section -> names
+_POSITIVE = {
+    "limits": ("ssh_connections", "api_requests", "batch", "uploads", "commands"),
+    "timeouts": tuple(item.name for item in fields(Timeouts)),
+    "poll": tuple(item.name for item in fields(PollSettings)),
+    "discovery": ("interval", "timeout", "concurrency", "remove_after"),
+    "install": ("max_concurrent", "batch_size", "max_processes"),
+    "diagnostics": ("slow_callback",),
+}
+# settings 0 turns off, section -> names
+_NOT_NEGATIVE = {
+    "limits": ("warmup_rate", "warmup_burst", "upload_bandwidth"),
+    "install": ("canary",),
+}
+
+
+@dataclass
+class Config:
+    """
+    Everything in settings.toml, with the defaults filled in
+
+    Sections missing from the file get their defaults, keys that are not
+    settings or values of the wrong type raise ConfigError, so a typo is
+    caught when the file is loaded instead of being silently ignored.
+    """
+    # miners that are always on the bench
+    miners: list = field(default_factory=list)
+    # tag -> IPs or CIDR ranges whose miners get the tag
+    tags: dict = field(default_factory=dict)
+    credentials: Credentials = field(default_factory=Credentials)
+    ports: Ports = field(default_factory=Ports)
+    limits: Limits = field(default_factory=Limits)
+    timeouts: Timeouts = field(default_factory=Timeouts)
+    poll: PollSettings = field(default_factory=PollSettings)
+    discovery: DiscoverySettings = field(default_factory=DiscoverySettings)
+    install: InstallSettings = field(default_factory=InstallSettings)
+    shards: ShardSettings = field(default_factory=ShardSettings)
+    diagnostics: DiagnosticsSettings = field(default_factory=DiagnosticsSettings)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Config":
+        """Build a Config from a parsed TOML document, raises ConfigError if it isn't valid"""
+        config = _build(cls, data, "")
+        for ip in config.miners:
+            _check(ipaddress.ip_address, ip, "miners")
+        for subnet in config.discovery.subnets:
+            _check(lambda value: ipaddress.ip_network(value, strict=False), subnet, "discovery.subnets")
+        for tag, members in config.tags.items():
+            if not isinstance(members, list):
+                raise ConfigError(f"tags.{tag} must be a list of IPs or CIDR ranges")
+            for member in members:
+                _check(lambda value: ipaddress.ip_network(value, strict=False), member, f"tags.{tag}")
+        for section, names in _POSITIVE.items():
+            for name in names:
+                if getattr(getattr(config, section), name) <= 0:
+                    raise ConfigError(f"{section}.{name} must be more than 0")
+        for section, names in _NOT_NEGATIVE.items():
+            for name in names:
+                if getattr(getattr(config, section), name) < 0:
+                    raise ConfigError(f"{section}.{name} can't be negative, 0 turns it off")
+        for name in ("api", "http", "ssh"):
+            _check_port(getattr(config.ports, name), f"ports.{name}")
+        if not config.discovery.ports:
+            raise ConfigError("discovery.ports must list at least one port")
+        for port in config.discovery.ports:
+            _check_port(port, "discovery.ports")
+        if config.shards.by not in ("hash", "subnet"):
+            raise ConfigError(f'shards.by must be "hash" or "subnet", not {config.shards.by!r}')
+        return config
+
+    def firmware_file(self) -> str or None:
+        """Path of the firmware tarball to install, None if none is configured or found"""
+        if self.install.firmware:
+            return os.path.abspath(self.install.firmware)
+        return find_firmware()
+
+
+def _check(parse, value, name: str) -> None:
+    if not isinstance(value, str):
+        raise ConfigError(f"{name}: {value!r} is not a string")
+    try:
+        parse(value)
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f"{name}: {e}") from None
+
+
+def _check_port(value, name: str) -> None:
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 < value < 65536:
+        raise ConfigError(f"{name}: {value!r} is not a port number")
+
+
+def _build(cls, data: dict, prefix: str):
+    """Instance of a settings dataclass from one table of the file, checking every key"""
+    if not isinstance(data, dict):
+        raise ConfigError(f"{prefix.rstrip('.')} must be a table")
+    known = {item.name: item for item in fields(cls)}
+    for key in data:
+        if key not in known:
+            raise ConfigError(f"unknown setting {prefix}{key}")
+    values = {}
+    for name, item in known.items():
+        if name not in data:
+            continue
+        value = data[name]
+        expected = item.type
+        if hasattr(expected, "__dataclass_fields__"):
+            value = _build(expected, value, f"{prefix}{name}.")
+        elif expected is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        elif not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise ConfigError(f"{prefix}{name} must be {expected.__name__}, not {value!r}")
+        values[name] = value
+    return cls(**values)
+
+
+def find_firmware(directory: str = FILES_DIR) -> str or None:
+    """Newest .tar.gz in directory, None if there is none"""
+    try:
+        tarballs = [entry for entry in os.scandir(directory) if entry.name.endswith(".tar.gz") and entry.is_file()]
+    except OSError:
+        return None
+    if not tarballs:
+        return None
+    return max(tarballs, key=lambda entry: entry.stat().st_mtime).path
+
+
+def load_config(path: str = CONFIG_FILE) -> Config:
+    """
+    Read and check the config file
+
+    Raises OSError if it can't be read and ConfigError if it isn't valid
+    TOML or has invalid settings.
+    """
+    with open(path, "rb") as config_file:
+        try:
+            data = tomllib.load(config_file)
+        except tomllib.TOMLDecodeError as e:
+            raise ConfigError(f"{path}: {e}") from None
+    return Config.from_dict(data)
+
+
+async def _changes(path: str):
+    """Yield every time the file may have changed"""
+    if watchgod is not None:
+        directory = os.path.dirname(os.path.abspath(path))
+        # only the config file itself, editors write temp files next to it
+        pattern = f".*{re.escape(os.sep + os.path.basename(path))}$"
+        async for _ in watchgod.awatch(directory, watcher_cls=watchgod.RegExpWatcher,
+                                       watcher_kwargs={"re_files": pattern, "re_dirs": "^$"}):
+            yield
+        return
+    stamp = None
+    while True:
+        try:
+            stat = os.stat(path)
+            current = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            current = None
+        if stamp is not None and current != stamp and current is not None:
+            yield
+        stamp = current
+        await asyncio.sleep(RELOAD_POLL_INTERVAL)
+
+
+async def watch_config(path: str, on_change, current: Config = None) -> None:
+    """
+    Reload the config whenever the file changes and call on_change(old, new)
+
+    Uses watchgod when it is installed and checks the modification time
+    otherwise. A file that fails to load is reported and skipped, the last
+    good config stays in effect until the file is fixed.
+    """
+    if current is None:
+        current = load_config(path)
+    async for _ in _changes(path):
+        try:
+            new = load_config(path)
+        except (OSError, ConfigError) as e:
+            print(f"Not reloading {path}: {e}")
+            continue
+        if new == current:
+            continue
+        old, current = current, new
+        on_change(old, new)
@@ -0,0 +1,227 @@
+import asyncio
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+# seconds between heartbeats of the event loop, the lag is how late each one wakes up
+LAG_INTERVAL = 0.1
+# seconds the loop may be blocked before the code blocking it is logged
+SLOW_CALLBACK = 0.1
+# stalls kept for /debug/loop
+MAX_STALLS = 50
+# frames of the blocking code logged with a stall, innermost last
+STACK_DEPTH = 12
+# seconds between samples of the stack sampler, and the longest a profile runs if it is never stopped
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300
+# lines of cProfile output and of sampled functions in a report
+REPORT_LINES = 60
+# task category by the name of the coroutine it runs, anything else is "other"
+TASK_CATEGORIES = {
+    "PollScheduler._poll_loop": "polls",
+    "PollScheduler._sync_loop": "polls",
+    "MinerList._run": "installs",
+    "Miner.main_loop": "installs",
+    "AsyncServer.emit": "emits",
+    "send_deltas": "emits",
+    "finish_command": "commands",
+    "ShardWorker._answer": "calls",
+}
+PROFILE_MODES = ("stack", "cprofile")
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _where(frame) -> str:
+    """file:function of a frame, relative to the repo for our own code"""
+    path = frame.f_code.co_filename
+    if path.startswith(_ROOT):
+        path = os.path.relpath(path, _ROOT)
+    else:
+        path = os.path.basename(path)
+    return f"{path}:{frame.f_code.co_name}"
+
+
+def task_counts(loop=None) -> dict:
+    """Live asyncio tasks by TASK_CATEGORIES"""
+    counts = dict.fromkeys(TASK_CATEGORIES.values(), 0)
+    counts["other"] = 0
+    for task in asyncio.all_tasks(loop):
+        coro = task.get_coro()
+        counts[TASK_CATEGORIES.get(getattr(coro, "__qualname__", ""), "other")] += 1
+    return counts
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop runs, and catches the code that blocks it
+
+    A heartbeat coroutine sleeps LAG_INTERVAL at a time, how much later than
+    that it wakes up is the lag. A watchdog thread checks the heartbeat, and
+    when the loop has been stuck for more than slow seconds it takes the
+    stack of the loop thread right then, so the stall is logged with the
+    line that caused it rather than with whichever callback ran next. A
+    thread works the same whatever loop Sanic picks, uvloop included.
+    """
+    def __init__(self, interval: float = LAG_INTERVAL, slow: float = SLOW_CALLBACK):
+        self.interval = interval
+        self.slow = slow
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # the latest stalls, newest last
+        self.stalls = collections.deque(maxlen=MAX_STALLS)
+        self.loop = None
+        self.thread_id = None
+        self._beat_at = None
+        # stack the watchdog took of a stall that hasn't ended yet
+        self._stalled = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """Start measuring, call from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self._beat_at = time.perf_counter()
+        self._task = asyncio.create_task(self._beat())
+        self._stop.clear()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _beat(self) -> None:
+        while True:
+            self._beat_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self.lag = max(0.0, now - self._beat_at - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            LOOP_LAG_SECONDS.observe(self.lag)
+            stalled, self._stalled = self._stalled, None
+            if stalled is not None:
+                self._record(stalled, self.lag)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.slow / 2):
+            if self._stalled is not None:
+                continue
+            overdue = time.perf_counter() - self._beat_at - self.interval
+            if overdue > self.slow:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self._stalled = traceback.format_stack(frame, limit=STACK_DEPTH)
+
+    def _record(self, stack: list[str], seconds: float) -> None:
+        LOOP_STALLS.inc()
+        self.stalls.append({"time": time.time(), "seconds": round(seconds, 3), "stack": stack})
+        print(f"Event loop blocked, timers ran {seconds:.3f}s late, in:\n{''.join(stack).rstrip()}")
+
+    def report(self) -> dict:
+        """What /debug/loop shows"""
+        return {"lag": round(self.lag, 4), "max_lag": round(self.max_lag, 4), "interval": self.interval,
+                "slow": self.slow, "tasks": task_counts(self.loop), "stalls": list(self.stalls)}
+
+
+class Profiler:
+    """
+    Profile of the event loop thread, started and stopped on demand
+
+    "stack" samples the stack of the loop thread from another thread every
+    SAMPLE_INTERVAL, which costs the loop next to nothing and can run on a
+    loaded bench, and reports the stacks in the collapsed format flame
+    graph tools read. "cprofile" traces every call on the loop thread,
+    exact counts but a lot slower while it runs. Either stops by itself
+    after MAX_PROFILE_SECONDS.
+    """
+    def __init__(self):
+        self.mode = None
+        self.started = None
+        self._samples = collections.Counter()
+        self._profile = None
+        # sampler thread of the running stack profile, and the event that stops it
+        self._thread = None
+        self._stop = None
+        self._thread_id = None
+        self._timer = None
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = "stack") -> None:
+        """Start profiling, call from the event loop. Raises ValueError for an unknown mode or if already running"""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {PROFILE_MODES}, not {mode!r}")
+        if self.running:
+            raise ValueError(f"a {self.mode} profile is already running")
+        self.mode = mode
+        self.started = time.perf_counter()
+        self._samples = collections.Counter()
+        self._thread_id = threading.get_ident()
+        if mode == "cprofile":
+            # only traces the thread it is enabled on, the loop thread
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            # a fresh event per run, a sampler still winding down can't be woken up again by it
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, args=(self._stop, self._samples),
+                                            name="stack-sampler", daemon=True)
+            self._thread.start()
+        # a forgotten cprofile would slow the whole bench down for good
+        self._timer = asyncio.get_running_loop().call_later(MAX_PROFILE_SECONDS, self.stop)
+
+    def _sample(self, stop: threading.Event, samples: collections.Counter) -> None:
+        while not stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_where(frame))
+                frame = frame.f_back
+            if stack:
+                samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> dict or None:
+        """Stop profiling and return the report, None if nothing was running"""
+        if not self.running:
+            return None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        report = {"mode": self.mode, "seconds": round(time.perf_counter() - self.started, 3)}
+        if self.mode == "cprofile":
+            self._profile.disable()
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats("cumulative").print_stats(REPORT_LINES)
+            report["stats"] = out.getvalue()
+            self._profile = None
+        else:
+            self._stop.set()
+            # at most one sample in progress, the wait is a few milliseconds
+            self._thread.join()
+            self._thread = None
+            self._stop = None
+            samples, self._samples = self._samples, collections.Counter()
+            # time spent in each function itself, the innermost frame of every sample
+            leaves = collections.Counter()
+            for stack, count in samples.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            total = sum(samples.values())
+            report["samples"] = total
+            report["top"] = [{"function": function, "samples": count, "share": round(count / total, 4)}
+                             for function, count in leaves.most_common(REPORT_LINES)]
+            report["collapsed"] = "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+        self.mode = None
+        return report
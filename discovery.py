@@ -0,0 +1,221 @@
+import asyncio
+import ipaddress
+import time
+
+from miner_data import MinerList
+from timeseries import MAX_OPEN_FILES
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the OS there has no per process socket limit to respect
+    resource = None
+
+# ports probed on every host
+PORTS = (80, 22, 4028)
+# a host is a miner if one of these is open, they are probed first to decide if the host is up at all
+MINER_PORTS = (80, 4028)
+# seconds to wait on each probe, bench networks are local so this can be short
+PROBE_TIMEOUT = 0.3
+# maximum number of probes in flight
+CONCURRENCY = 1024
+# file descriptors left over for the webserver, SSH, the API and the mapped history files
+FD_HEADROOM = 256 + MAX_OPEN_FILES
+
+# probe outcomes
+OPEN = "open"
+CLOSED = "closed"
+
+
+async def probe(ip: str, port: int, timeout: float = PROBE_TIMEOUT) -> str or None:
+    """
+    Try to connect to a port on a host
+
+    Returns OPEN if the port accepted, CLOSED if the host refused it and None
+    if nothing answered in time.
+    """
+    try:
+        _reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except asyncio.TimeoutError:
+        return None
+    except ConnectionRefusedError:
+        # the host is there, the port is not
+        return CLOSED
+    except OSError:
+        # unreachable network or host
+        return None
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return OPEN
+
+
+def socket_budget(wanted: int) -> int:
+    """
+    Work out how many sockets the scanner can have open at once
+
+    Raises the soft open file limit towards the hard limit when needed, and
+    leaves FD_HEADROOM descriptors for everything else in the process.
+    """
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = wanted + FD_HEADROOM
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, min(wanted, soft - FD_HEADROOM))
+
+
+class ScanResult:
+    def __init__(self, found: dict, scanned: int, elapsed: float):
+        # ip -> list of open ports, for every host that looks like a miner
+        self.found = found
+        # number of addresses probed
+        self.scanned = scanned
+        # seconds the scan took
+        self.elapsed = elapsed
+
+    @property
+    def hosts_per_second(self) -> float:
+        """Scan throughput"""
+        if self.elapsed <= 0:
+            return float(self.scanned)
+        return self.scanned / self.elapsed
+
+
+class Scanner:
+    """
+    Bounded async port scanner for finding miners in CIDR ranges
+
+    A fixed pool of workers pulls addresses from the ranges, so a /16 never
+    turns into 65k tasks at once, and every probe takes a slot of a
+    semaphore so the number of open sockets stays under the OS limit. The
+    first pass probes the first port and the MINER_PORTS among the ports
+    together, so a miner with its web interface down is still found by its
+    API. Hosts that answer on none of them are not probed on the others,
+    which keeps the cost of empty addresses to one timeout.
+    """
+    def __init__(self, subnets: list[str], ports: tuple = PORTS, timeout: float = PROBE_TIMEOUT,
+                 concurrency: int = CONCURRENCY):
+        self.subnets = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+        self.ports = tuple(ports)
+        # probed before the rest, in order and without duplicates
+        self.first_ports = tuple(dict.fromkeys([self.ports[0], *[port for port in self.ports if port in MINER_PORTS]]))
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    def hosts(self):
+        """Every address in the configured ranges, without duplicates"""
+        seen = set()
+        for subnet in self.subnets:
+            # a /32 has no "hosts", scan the address itself
+            for host in (subnet.hosts() if subnet.num_addresses > 1 else subnet):
+                ip = str(host)
+                if ip not in seen:
+                    seen.add(ip)
+                    yield ip
+
+    async def scan_host(self, ip: str, sockets: asyncio.Semaphore = None) -> list[int] or None:
+        """Probe one host, returns its open ports or None if it isn't a miner. sockets bounds the probes in flight"""
+        async def bounded(port: int) -> str or None:
+            if sockets is None:
+                return await probe(ip, port, self.timeout)
+            async with sockets:
+                return await probe(ip, port, self.timeout)
+
+        states = dict(zip(self.first_ports, await asyncio.gather(*[bounded(port) for port in self.first_ports])))
+        if all(state is None for state in states.values()):
+            # nothing answered, don't spend more probes on it
+            return None
+        rest = [port for port in self.ports if port not in states]
+        states.update(zip(rest, await asyncio.gather(*[bounded(port) for port in rest])))
+        open_ports = [port for port in self.ports if states[port] == OPEN]
+        if any(port in MINER_PORTS for port in open_ports):
+            return open_ports
+        return None
+
+    async def scan(self) -> ScanResult:
+        """Scan all ranges and return the hosts that look like miners"""
+        start = time.monotonic()
+        hosts = self.hosts()
+        found = {}
+        scanned = 0
+        # one worker per socket, a live host takes a few of them for a moment and the rest wait their turn
+        budget = socket_budget(self.concurrency)
+        sockets = asyncio.Semaphore(budget)
+
+        async def worker():
+            nonlocal scanned
+            # the generator is shared, each address is handed to exactly one worker
+            for ip in hosts:
+                scanned += 1
+                open_ports = await self.scan_host(ip, sockets)
+                if open_ports is not None:
+                    found[ip] = open_ports
+
+        await asyncio.gather(*[worker() for _ in range(budget)])
+        return ScanResult(found, scanned, time.monotonic() - start)
+
+
+class Discovery:
+    """
+    Periodically scan for miners and keep a MinerList in sync with the network
+
+    Only miners found by the scanner are ever removed, and never while they
+    are installing since miners drop off the network when they reboot.
+    """
+    def __init__(self, miner_list: MinerList, scanner: Scanner, interval: float = 60, remove_after: int = 3,
+                 accept=None):
+        self.miner_list = miner_list
+        self.scanner = scanner
+        # accept(ip) -> bool, picks the miners this list manages when the bench is split into shards
+        self.accept = accept
+        # seconds between the start of each scan
+        self.interval = interval
+        # number of scans in a row a miner can be missing before it is removed
+        self.remove_after = remove_after
+        # ip -> scans in a row the miner was not found, for miners we added
+        self.missed = {}
+        # last scan result
+        self.last_result = None
+
+    def apply(self, result: ScanResult) -> None:
+        """Add new miners and remove ones that have been gone for a while"""
+        for ip in result.found:
+            if self.accept is not None and not self.accept(ip):
+                continue
+            if ip not in self.miner_list.miners:
+                self.miner_list.append(self.miner_list.new_miner(ip))
+                self.missed[ip] = 0
+            elif ip in self.missed:
+                self.missed[ip] = 0
+        for ip in list(self.missed):
+            if ip in result.found:
+                continue
+            miner = self.miner_list.miners.get(ip)
+            if miner is None:
+                del self.missed[ip]
+                continue
+            self.missed[ip] += 1
+            if self.missed[ip] >= self.remove_after and miner.main_state != "install":
+                del self.missed[ip]
+                self.miner_list.remove(ip)
+
+    async def run(self) -> None:
+        """Scan loop"""
+        while True:
+            result = await self.scanner.scan()
+            self.last_result = result
+            self.apply(result)
+            print(f"Scanned {result.scanned} hosts in {result.elapsed:.1f}s "
+                  f"({result.hosts_per_second:.0f} hosts/s), {len(result.found)} miners found")
+            await asyncio.sleep(max(0.0, self.interval - result.elapsed))
@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+import asyncssh
+
+from warmup import TokenBucket
+
+# bytes per SFTP write, and the unit the bandwidth budget is spent in
+CHUNK_SIZE = 256 * 1024
+# uploads running at once when pushing to many miners
+MAX_UPLOADS = 32
+# megabytes a second across every upload, 0 for no limit
+UPLOAD_BANDWIDTH = 0
+# tries per miner, a retry resumes where the last try stopped
+ATTEMPTS = 3
+# seconds between tries, long enough for a dropped connection to be noticed
+RETRY_DELAY = 5
+
+
+class TransferError(Exception):
+    """The file on the miner doesn't match after the upload"""
+
+
+async def remote_sha256(conn, path: str) -> str or None:
+    """sha256 of a file on the miner, None if it isn't there"""
+    result = await conn.run(f"sha256sum {path}")
+    if result.exit_status != 0 or not result.stdout:
+        return None
+    return result.stdout.split()[0]
+
+
+async def _replace(sftp, source: str, target: str) -> None:
+    """Move the finished upload into place in one step where the server allows it"""
+    try:
+        await sftp.posix_rename(source, target)
+    except asyncssh.SFTPError:
+        # plain SFTP rename won't overwrite
+        if await sftp.exists(target):
+            await sftp.remove(target)
+        await sftp.rename(source, target)
+
+
+class Distributor:
+    """
+    Uploads files to miners over SFTP, skipping miners that have them and resuming dropped uploads
+
+    A miner whose copy already has the right sha256 is skipped. Otherwise
+    the file goes to <remote path>.<hash>.part in CHUNK_SIZE writes at
+    explicit offsets, so a try cut short by a reboot or a dropped
+    connection carries on from the size of the part file, and is only
+    moved into place once its hash matches. Every upload spends from one
+    bandwidth budget, so pushing to the whole bench doesn't starve the
+    API polls.
+    """
+    def __init__(self, bandwidth: float = UPLOAD_BANDWIDTH, max_uploads: int = MAX_UPLOADS):
+        self.max_uploads = max_uploads
+        # bytes a second shared by every upload, None for no limit
+        self.budget = None
+        self.set_limits(bandwidth, max_uploads)
+        # ip -> result of the last upload to that miner
+        self.last = {}
+        self.active = 0
+        self.sent = 0
+        self.resumed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        # seconds at least one upload was running, for the throughput of the whole bench
+        self._busy_seconds = 0.0
+        self._busy_since = None
+
+    def set_limits(self, bandwidth: float, max_uploads: int) -> None:
+        """Change the budget and concurrency, uploads already running pick up the new budget"""
+        self.max_uploads = max_uploads
+        rate = bandwidth * 1000000
+        if not rate:
+            self.budget = None
+        elif self.budget is None:
+            self.budget = TokenBucket(rate, CHUNK_SIZE)
+        else:
+            self.budget.set_rate(rate, CHUNK_SIZE)
+
+    def stats(self) -> dict:
+        """Upload counts, and bytes a second over the time uploads were running"""
+        busy = self._busy_seconds
+        if self._busy_since is not None:
+            busy += time.monotonic() - self._busy_since
+        return {
+            "active": self.active,
+            "sent": self.sent,
+            "resumed": self.resumed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "bytes_sent": self.bytes_sent,
+            "throughput": round(self.bytes_sent / busy) if busy else 0,
+        }
+
+    async def send(self, miner, artifact, remote_path: str) -> dict:
+        """
+        Upload an artifact to one miner unless it already has it
+
+        Returns {"status": "sent" | "resumed" | "skipped" | "failed",
+        "bytes", "resumed_from", "seconds", "throughput", "error"}, with
+        the bytes actually sent and their bytes a second.
+        """
+        await artifact.stage()
+        if not miner.running.is_set():
+            miner.add_to_output("Paused...")
+        await miner.running.wait()
+
+        if self.active == 0:
+            self._busy_since = time.monotonic()
+        self.active += 1
+        start = time.monotonic()
+        transfer = {"status": "failed", "bytes": 0, "resumed_from": 0, "error": None}
+        try:
+            for attempt in range(ATTEMPTS):
+                try:
+                    transfer["status"] = await self._upload(miner, artifact, remote_path, transfer)
+                    transfer["error"] = None
+                    break
+                except (OSError, asyncssh.Error, TransferError) as e:
+                    transfer["error"] = str(e) or type(e).__name__
+                    if attempt + 1 < ATTEMPTS:
+                        miner.add_to_output(f"Sending {artifact.name} failed ({transfer['error']}), retrying...")
+                        await asyncio.sleep(RETRY_DELAY)
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self._busy_seconds += time.monotonic() - self._busy_since
+                self._busy_since = None
+        seconds = time.monotonic() - start
+        transfer["seconds"] = round(seconds, 3)
+        transfer["throughput"] = round(transfer["bytes"] / seconds) if seconds and transfer["bytes"] else 0
+        if transfer["status"] == "skipped":
+            self.skipped += 1
+        elif transfer["status"] == "failed":
+            self.failed += 1
+        else:
+            self.sent += 1
+            if transfer["status"] == "resumed":
+                self.resumed += 1
+        self.last[miner.ip] = transfer
+        return transfer
+
+    async def _upload(self, miner, artifact, remote_path: str, transfer: dict) -> str:
+        # named by the hash, so a part file of another version is never resumed
+        part = f"{remote_path}.{artifact.sha256[:12]}.part"
+        async with miner.get_connection(miner.settings.username, miner.settings.password) as conn:
+            if await remote_sha256(conn, remote_path) == artifact.sha256:
+                return "skipped"
+            async with conn.start_sftp_client() as sftp:
+                try:
+                    offset = (await sftp.stat(part)).size or 0
+                except asyncssh.SFTPError as e:
+                    if e.code != asyncssh.FX_NO_SUCH_FILE:
+                        raise
+                    offset = 0
+                if offset > artifact.size:
+                    offset = 0
+                # where the try that ends up working started
+                transfer["resumed_from"] = offset
+                if offset:
+                    miner.add_to_output(f"Resuming {artifact.name} at {offset} of {artifact.size} bytes...")
+                async with sftp.open(part, "r+b" if offset else "wb") as remote:
+                    # chunks come from the page cache after the first miner, not worth a thread each
+                    with open(artifact.path, "rb") as local:
+                        local.seek(offset)
+                        while offset < artifact.size:
+                            chunk = local.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            if self.budget is not None:
+                                await self.budget.take(len(chunk))
+                            await remote.write(chunk, offset)
+                            offset += len(chunk)
+                            transfer["bytes"] += len(chunk)
+                            self.bytes_sent += len(chunk)
+                if await remote_sha256(conn, part) != artifact.sha256:
+                    # start over on the next try
+                    await sftp.remove(part)
+                    raise TransferError(f"{artifact.name} doesn't match after the upload")
+                await _replace(sftp, part, remote_path)
+        return "resumed" if transfer["resumed_from"] else "sent"
+
+    async def push(self, miners: list, artifact, remote_path: str, after=None) -> dict:
+        """
+        Upload an artifact to many miners at once, max_uploads at a time
+
+        after(miner) is awaited for every miner that got the file, to put
+        it to use. Returns {"sent", "resumed", "skipped", "failed", "bytes",
+        "results": {ip: result of send}}.
+        """
+        semaphore = asyncio.Semaphore(self.max_uploads)
+
+        async def one(miner) -> dict:
+            async with semaphore:
+                result = await self.send(miner, artifact, remote_path)
+                if after is not None and result["status"] in ("sent", "resumed"):
+                    await after(miner)
+                return result
+
+        results = await asyncio.gather(*(one(miner) for miner in miners))
+        summary = {"sent": 0, "resumed": 0, "skipped": 0, "failed": 0,
+                   "bytes": sum(result["bytes"] for result in results),
+                   "results": {miner.ip: result for miner, result in zip(miners, results)}}
+        for result in results:
+            summary[result["status"]] += 1
+        # resumed uploads are sent too
+        summary["sent"] += summary["resumed"]
+        return summary
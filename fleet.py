@@ -0,0 +1,440 @@
+import asyncio
+import inspect
+import ipaddress
+import zlib
+
+from commands import OutputBuffer
+from config import Config, CONFIG_FILE, watch_config
+from discovery import Discovery, Scanner
+from distribution import Distributor
+from health import HealthAnalyzer
+from installer import InstallOrchestrator
+from miner_api import set_request_limit
+from miner_data import Miner, MinerList, MinerSettings, STATES
+from poller import PollScheduler
+from processes import ProcessPool
+from ssh_pool import SSHPool
+from state_store import StateStore, STATE_FILE
+from timeseries import TimeSeriesStore
+from warmup import TokenBucket
+
+
+def shard_for(ip: str, count: int, subnets: list[str] = None) -> int:
+    """
+    Index of the shard that owns a miner
+
+    With subnets the nth subnet goes to shard n % count, so a rack stays on
+    one shard. Miners outside every subnet, or all of them without subnets,
+    are spread by a hash of the IP that is the same in every process.
+    """
+    if count <= 1:
+        return 0
+    if subnets:
+        address = ipaddress.ip_address(ip)
+        for index, subnet in enumerate(subnets):
+            if address in ipaddress.ip_network(subnet, strict=False):
+                return index % count
+    return zlib.crc32(ip.encode()) % count
+
+
+class Fleet:
+    """
+    The miners of this process and everything that runs them, built from the config
+
+    apply brings the running fleet in line with a reloaded config: miners
+    are added and removed, pools resized and limits changed in place, so
+    clients stay connected and installs keep running. shard is
+    (index, count) to only run the miners that shard owns.
+
+    Install states, identities and tags are saved to state_file as they
+    change, and the miners pick up where they left off when the fleet is
+    built again after a restart. Pass state_file=None to not save them.
+    """
+    def __init__(self, config: Config, shard: tuple = None, state_file: str = STATE_FILE):
+        self.config = config
+        self.shard = shard
+        # saved miner states, None when they aren't kept
+        self.state_store = StateStore(state_file) if state_file is not None else None
+        # hashrate, temps and fans history, kept on disk across restarts
+        self.history = TimeSeriesStore()
+        # health verdicts of the miners, from their latest polls compared to the rest of the fleet
+        self.health = HealthAnalyzer()
+        # rate limits installs and stages the firmware, config and referral once for the whole bench
+        firmware = config.firmware_file()
+        self.installer = InstallOrchestrator(firmware=firmware,
+                                             max_concurrent=config.install.max_concurrent,
+                                             canary=config.install.canary,
+                                             batch_size=config.install.batch_size,
+                                             max_failure_ratio=config.install.max_failure_ratio,
+                                             distributor=Distributor(config.limits.upload_bandwidth,
+                                                                     config.limits.uploads))
+        # caps SSH sessions across the whole bench
+        self.ssh_pool = SSHPool(max_connections=config.limits.ssh_connections,
+                                idle_timeout=config.timeouts.ssh_idle,
+                                connect_timeout=config.timeouts.ssh_connect)
+        # runs the installer program, caps how many run at once
+        self.process_pool = ProcessPool(max_processes=config.install.max_processes)
+        set_request_limit(config.limits.api_requests)
+        # spreads the start of the miners, at boot and when discovery finds a rack at once
+        self.warmup = TokenBucket(config.limits.warmup_rate, config.limits.warmup_burst)
+
+        self.miner_list = MinerList(ssh_pool=self.ssh_pool, history=self.history, installer=self.installer,
+                                    tags=config.tags, process_pool=self.process_pool,
+                                    settings=self._miner_settings(config, firmware), ports=self._ports(config),
+                                    warmup=self.warmup if config.limits.warmup_rate else None)
+        # polls the miners, made by poll
+        self.poller = None
+        self.started = False
+        # miners taken out of the config while installing, removed once they are done
+        self.pending_removals = set()
+        self.miner_list.subscribe(self._state_changed)
+
+        # scans the configured subnets for more miners, None without subnets
+        self.discovery = None
+        self._discovery_task = None
+        self._configure_discovery()
+        self._restore([ip for ip in config.miners if self.owns(ip)])
+
+    def _restore(self, configured: list[str]) -> None:
+        """Add the configured miners, and the ones discovery found before a restart, as they were saved"""
+        records = self.state_store.load() if self.state_store is not None else {}
+        miners = [self.miner_list.new_miner(ip) for ip in configured]
+        if self.discovery is not None:
+            subnets = [ipaddress.ip_network(subnet, strict=False) for subnet in self._owned_subnets()]
+            for ip, record in records.items():
+                if record.discovered and ip not in configured and self.owns(ip) and \
+                        any(ipaddress.ip_address(ip) in subnet for subnet in subnets):
+                    miners.append(self.miner_list.new_miner(ip))
+                    # removed like any other discovered miner if it isn't found again
+                    self.discovery.missed[ip] = 0
+        for miner in miners:
+            record = records.get(miner.ip)
+            if record is not None:
+                record.restore(miner)
+        self.miner_list.append(*miners)
+        if self.state_store is not None:
+            self.state_store.loaded(ip for ip in records if ip in self.miner_list.miners)
+            self.miner_list.subscribe(self.state_store.record_transition)
+
+    def _discovered(self):
+        return self.discovery.missed if self.discovery is not None else ()
+
+    @staticmethod
+    def _miner_settings(config: Config, firmware: str or None) -> MinerSettings:
+        return MinerSettings(username=config.credentials.username, password=config.credentials.password,
+                             firmware=firmware, unlock_timeout=config.timeouts.unlock,
+                             install_timeout=config.timeouts.install,
+                             api_connect_timeout=config.timeouts.api_connect, api_timeout=config.timeouts.api_read)
+
+    @staticmethod
+    def _ports(config: Config) -> dict:
+        return {"api_port": config.ports.api, "http_port": config.ports.http, "ssh_port": config.ports.ssh}
+
+    def _owned_subnets(self) -> list[str]:
+        """Subnets this process scans, each shard only scans its own when split by subnet"""
+        subnets = self.config.discovery.subnets
+        if self.shard is not None and self.config.shards.by == "subnet":
+            index, count = self.shard
+            return [subnet for number, subnet in enumerate(subnets) if number % count == index]
+        return list(subnets)
+
+    def owns(self, ip: str) -> bool:
+        """Whether this process runs the miner at ip"""
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        subnets = self.config.discovery.subnets if self.config.shards.by == "subnet" else None
+        return shard_for(ip, count, subnets) == index
+
+    def poll(self, on_result, on_remove=None) -> PollScheduler:
+        """
+        Make the poller, results are handed to on_result as they come in
+
+        Every result goes through the health analyzer first, so the data
+        handed on has its "Health" verdict, call health.evaluate() before
+        each broadcast to bring the verdicts up to date.
+        """
+        def result(ip: str, data: dict) -> None:
+            self.health.record(ip, data)
+            on_result(ip, data)
+
+        def remove(ip: str) -> None:
+            self.health.remove(ip)
+            if on_remove is not None:
+                on_remove(ip)
+
+        self.poller = PollScheduler(self.miner_list, on_result=result, on_remove=remove)
+        self._configure_poller()
+        return self.poller
+
+    def start(self) -> None:
+        """Run the installs, discovery and polling"""
+        self.started = True
+        asyncio.create_task(self.miner_list.install())
+        if self.state_store is not None:
+            asyncio.create_task(self.state_store.run(self.miner_list, self._discovered))
+        self._start_discovery()
+        if self.poller is not None:
+            self.poller.start()
+
+    async def watch(self, path: str = CONFIG_FILE) -> None:
+        """Apply the config file every time it changes"""
+        await watch_config(path, lambda _old, new: self.apply(new), self.config)
+
+    def apply(self, config: Config) -> list[str]:
+        """
+        Change the running fleet to match a new config, returns what changed
+
+        Nothing is restarted: limits and timeouts take effect for the next
+        operation, miners already installing finish before they are removed,
+        and the shard layout, which can't change on the fly, is left as is.
+        """
+        old, self.config = self.config, config
+        changes = []
+        if config.shards != old.shards:
+            # moving miners between processes needs every process restarted
+            config.shards = old.shards
+            changes.append("shards (restart the server to apply)")
+
+        if (config.credentials, config.timeouts, config.install.firmware) != \
+                (old.credentials, old.timeouts, old.install.firmware):
+            # every miner holds this object, changing it in place reaches them all
+            settings, new_settings = self.miner_list.settings, self._miner_settings(config, config.firmware_file())
+            for name in MinerSettings.__slots__:
+                setattr(settings, name, getattr(new_settings, name))
+            self.miner_list.apply_settings()
+            self.installer.set_firmware(settings.firmware)
+            self.ssh_pool.idle_timeout = config.timeouts.ssh_idle
+            self.ssh_pool.connect_timeout = config.timeouts.ssh_connect
+            changes.append("credentials, firmware or timeouts")
+
+        if config.ports != old.ports:
+            self.miner_list.ports = self._ports(config)
+            old_ports = (old.ports.api, old.ports.http, old.ports.ssh)
+            for miner in self.miner_list.miners.values():
+                # miners on other ports were put there on purpose, like simulated ones
+                if (miner.api_port, miner.http_port, miner.ssh_port) == old_ports:
+                    miner.set_ports(config.ports.api, config.ports.http, config.ports.ssh)
+            changes.append("ports")
+
+        if config.limits != old.limits:
+            if config.limits.ssh_connections != old.limits.ssh_connections:
+                self.ssh_pool.resize(config.limits.ssh_connections)
+            if config.limits.api_requests != old.limits.api_requests:
+                set_request_limit(config.limits.api_requests)
+            self.warmup.set_rate(config.limits.warmup_rate, config.limits.warmup_burst)
+            # a rate of 0 starts miners without pacing, the bucket is kept for when it is turned back on
+            self.miner_list.warmup = self.warmup if config.limits.warmup_rate else None
+            self.installer.distributor.set_limits(config.limits.upload_bandwidth, config.limits.uploads)
+            changes.append("limits")
+
+        if config.install != old.install:
+            self.installer.set_limits(config.install.max_concurrent, config.install.canary,
+                                      config.install.batch_size, config.install.max_failure_ratio)
+            self.process_pool.resize(config.install.max_processes)
+            changes.append("install")
+
+        if config.poll != old.poll:
+            self._configure_poller()
+            changes.append("poll intervals")
+
+        if config.tags != old.tags:
+            self.miner_list.set_tag_rules(config.tags)
+            changes.append("tags")
+
+        if config.discovery != old.discovery:
+            self._configure_discovery()
+            changes.append("discovery")
+
+        if config.miners != old.miners:
+            added, removed = self._sync_miners(old, config)
+            changes.append(f"miners +{added} -{removed}")
+
+        if changes:
+            print(f"Config reloaded: {', '.join(changes)}")
+        return changes
+
+    def _sync_miners(self, old: Config, config: Config) -> tuple[int, int]:
+        """Add miners new to the config and remove the ones taken out of it"""
+        added = 0
+        for ip in config.miners:
+            if not self.owns(ip):
+                continue
+            self.pending_removals.discard(ip)
+            if ip not in self.miner_list.miners:
+                self.miner_list.append(self.miner_list.new_miner(ip))
+                added += 1
+            elif self.discovery is not None:
+                # it is configured now, discovery must not remove it
+                self.discovery.missed.pop(ip, None)
+        wanted = set(config.miners)
+        for ip in old.miners:
+            if ip not in wanted and ip in self.miner_list.miners:
+                self.pending_removals.add(ip)
+        removed = len(self.pending_removals)
+        self._remove_pending()
+        return added, removed
+
+    def _remove_pending(self) -> None:
+        for ip in list(self.pending_removals):
+            miner = self.miner_list.miners.get(ip)
+            if miner is None:
+                self.pending_removals.discard(ip)
+            elif miner.main_state != "install":
+                self.pending_removals.discard(ip)
+                self.miner_list.remove(ip)
+
+    def _state_changed(self, miner: Miner, old: str, new: str, elapsed: float) -> None:
+        if miner.ip in self.pending_removals and new != "install":
+            self._remove_pending()
+
+    def _configure_poller(self) -> None:
+        if self.poller is None:
+            return
+        poll = self.config.poll
+        self.poller.fast_interval = poll.fast
+        self.poller.normal_interval = poll.normal
+        self.poller.slow_interval = poll.slow
+        self.poller.max_backoff = poll.max_backoff
+        self.poller.timeout = poll.timeout
+
+    def _configure_discovery(self) -> None:
+        """Make, change or stop discovery, a running scan finishes with the settings it started with"""
+        settings = self.config.discovery
+        subnets = self._owned_subnets()
+        if not subnets:
+            if self._discovery_task is not None:
+                self._discovery_task.cancel()
+                self._discovery_task = None
+            self.discovery = None
+            return
+        scanner = Scanner(subnets, ports=settings.ports, timeout=settings.timeout,
+                          concurrency=settings.concurrency)
+        if self.discovery is None:
+            self.discovery = Discovery(self.miner_list, scanner, interval=settings.interval,
+                                       remove_after=settings.remove_after,
+                                       accept=self.owns if self.shard is not None else None)
+            if self.started:
+                self._start_discovery()
+        else:
+            self.discovery.scanner = scanner
+            self.discovery.interval = settings.interval
+            self.discovery.remove_after = settings.remove_after
+
+    def _start_discovery(self) -> None:
+        if self.discovery is not None and (self._discovery_task is None or self._discovery_task.done()):
+            self._discovery_task = asyncio.create_task(self.discovery.run())
+
+
+def rpc_methods(fleet: Fleet, on_output=None) -> dict:
+    """
+    Everything clients can ask of the fleet, by name, so a shard can answer it for its miners
+
+    on_output(run_id, lines) gets the output of run_command as it is
+    printed, in the batches OutputBuffer makes.
+    """
+    miner_list = fleet.miner_list
+    installer = fleet.installer
+
+    async def batch(action: str, selector: dict) -> dict:
+        return await miner_list.batch(action, selector, concurrency=fleet.config.limits.batch)
+
+    def check_tags(tags: list) -> None:
+        # a bare string would be spread into one tag per character
+        if not isinstance(tags, list) or not all(isinstance(name, str) for name in tags):
+            raise ValueError("tags must be a list of strings")
+
+    def tag(selector: dict, tags: list) -> list:
+        check_tags(tags)
+        return miner_list.tag(selector, *tags)
+
+    def untag(selector: dict, tags: list) -> list:
+        check_tags(tags)
+        return miner_list.untag(selector, *tags)
+
+    def query_history(request: dict) -> dict:
+        start = request.get("start")
+        if not isinstance(start, (int, float)) or isinstance(start, bool):
+            raise ValueError("start must be a unix time")
+        # only miners of this process, the ips become file names and the history directory is shared by shards
+        ips = [ip for ip in request.get("ips") or miner_list.miners if isinstance(ip, str) and ip in miner_list.miners]
+        return fleet.history.query(ips, start, request.get("end"), request.get("metrics"), request.get("tier"))
+
+    def resume_installs() -> dict:
+        installer.resume()
+        return installer.stats()
+
+    async def distribute(name: str, selector: dict) -> dict:
+        # only installed miners take the firmware login
+        miners = [miner for miner in miner_list.select(selector) if miner.main_state == "done"]
+        return await installer.distribute(miners, name)
+
+    async def run_command(run_id: str, command: str, selector: dict, timeout: float = None) -> dict:
+        # results by miner, grouped by whoever made the call so the replies of every shard group together
+        output = OutputBuffer(lambda lines: on_output(run_id, lines)) if on_output is not None else None
+        try:
+            return await miner_list.run_on(command, selector, concurrency=fleet.config.limits.commands,
+                                           timeout=timeout or fleet.config.timeouts.command,
+                                           on_line=output.add if output is not None else None)
+        finally:
+            if output is not None:
+                output.close()
+
+    def install_history(ip: str) -> list:
+        if fleet.state_store is None or ip not in miner_list.miners:
+            return []
+        return fleet.state_store.install_history(ip)
+
+    return {
+        "pause": miner_list.pause,
+        "unpause": miner_list.unpause,
+        "check_pause": miner_list.check_pause,
+        "light": miner_list.light,
+        "unlight": miner_list.unlight,
+        "check_light": miner_list.check_light,
+        "batch": batch,
+        "tag": tag,
+        "untag": untag,
+        "get_logs": miner_list.get_logs,
+        "state_times": miner_list.state_times,
+        "history": query_history,
+        "install_stats": installer.stats,
+        "distribute": distribute,
+        "run_command": run_command,
+        "resume_installs": resume_installs,
+        "install_priority": installer.prioritize,
+        "install_history": install_history,
+    }
+
+
+async def invoke(methods: dict, method: str, args: list):
+    """Call one of rpc_methods, awaiting it if it is async"""
+    result = methods[method](*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def fleet_stats(fleet: Fleet) -> dict:
+    """Counts behind the /metrics gauges, summed over shards by merge_results"""
+    states = {state: 0 for state in STATES}
+    for miner in fleet.miner_list.miners.values():
+        states[miner.main_state] += 1
+    return {
+        "states": states,
+        "health": fleet.health.counts(),
+        "installs_completed": fleet.installer.completed,
+        "installs_failed": fleet.installer.failed,
+        "ssh_connections": fleet.ssh_pool.open_connections,
+        "api_connections": sum(1 for miner in fleet.miner_list.miners.values() if miner.api.connected),
+        "processes_running": fleet.process_pool.running,
+        "processes_waiting": fleet.process_pool.waiting,
+        "warmup_waiting": fleet.warmup.waiting,
+        "bytes_uploaded": fleet.installer.bytes_uploaded,
+        "uploads_active": fleet.installer.distributor.active,
+    }
+
+
+def state_event(miner: Miner, old: str, new: str, elapsed: float) -> dict:
+    """The miner_state event clients get when a miner changes install state"""
+    return {"IP": miner.ip, "from": old, "to": new, "elapsed": round(elapsed, 1)}
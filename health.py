@@ -0,0 +1,357 @@
+import numpy as np
+
+from installer import CONFIG_FILE as MINER_CONFIG_FILE
+from metrics import HEALTH_SECONDS
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+# polls of a miner the rolling means are taken over
+WINDOW = 12
+# how far from the fleet, in robust standard deviations, a board or fan has to be to be reported
+Z_THRESHOLD = 3.5
+# smallest spread the z-scores assume, so a bench of identical miners doesn't flag tiny differences
+MIN_HASHRATE_SPREAD = 0.02
+MIN_TEMP_SPREAD = 2.0
+MIN_FAN_SPREAD = 100.0
+# miners with stats needed before anything is compared to the fleet
+MIN_FLEET = 5
+# temp_control of the firmware config, used when files/config.toml doesn't have it
+TEMP_LIMITS = {"target_temp": 80.0, "hot_temp": 100.0, "dangerous_temp": 120.0}
+# verdicts, worst last
+OK = "ok"
+WARNING = "warning"
+CRITICAL = "critical"
+# miners without stats to judge, not installed yet or still installing
+UNKNOWN = "unknown"
+_VERDICTS = (OK, WARNING, CRITICAL)
+_UNKNOWN = {"status": UNKNOWN, "reasons": []}
+_OK = {"status": OK, "reasons": []}
+
+
+def load_temp_limits(path: str = MINER_CONFIG_FILE) -> dict:
+    """temp_control thresholds of the config pushed to the miners, the defaults if it can't be read"""
+    try:
+        with open(path, "rb") as config_file:
+            temp_control = tomllib.load(config_file).get("temp_control", {})
+    except (OSError, tomllib.TOMLDecodeError):
+        temp_control = {}
+    return {name: float(temp_control.get(name, default)) for name, default in TEMP_LIMITS.items()}
+
+
+def _robust_z(values: np.ndarray, mask: np.ndarray, min_spread: float, relative: bool = False) -> np.ndarray:
+    """
+    How far each value is from the median of the masked values, in robust standard deviations
+
+    Uses the median absolute deviation so the failing boards being looked
+    for don't drag the fleet statistics along with them. With relative,
+    min_spread is a fraction of the median.
+    """
+    sample = values[mask]
+    z = np.zeros(values.shape)
+    if sample.size < MIN_FLEET:
+        return z
+    # the sample is a copy, partition it in place, the middle element is close enough to the median
+    middle = sample.size // 2
+    sample.partition(middle)
+    median = sample[middle]
+    if relative:
+        min_spread *= median
+    deviation = np.abs(sample - median, out=sample)
+    deviation.partition(middle)
+    spread = max(1.4826 * deviation[middle], min_spread)
+    np.divide(values - median, spread, out=z, where=mask)
+    return z
+
+
+class HealthAnalyzer:
+    """
+    Latest hashboard and fan samples of every miner, checked against the fleet in one pass
+
+    Each poll result is copied into NumPy arrays as it comes in, one row
+    per miner, then evaluate() runs once per broadcast over the whole
+    fleet: rolling means of the board hashrates, fleet-relative robust
+    z-scores of the hashrates, temperatures and fan speeds, the temp_control
+    thresholds, and boards or fans that were there before and are now gone.
+    What was there before is forgotten when the MAC or model in the
+    "Identity" of the data changes, other hardware took the IP.
+    The verdict is put in the miner data as "Health":
+        {"status": "ok" | "warning" | "critical" | "unknown", "reasons": [...]}
+    and only rewritten for miners whose verdict changed.
+    """
+    def __init__(self, temp_limits: dict = None, capacity: int = 64):
+        self.temp_limits = temp_limits if temp_limits is not None else load_temp_limits()
+        # ip -> row, rows of removed miners are reused
+        self.rows = {}
+        self._free = []
+        # row -> ip and the data dict the verdict goes in
+        self._ips = []
+        self._data = []
+        # column -> board or fan key in the miner data, the same key is the same column for every miner
+        self.boards = []
+        self.fans = []
+        self._board_columns = {}
+        self._fan_columns = {}
+        # row -> verdict and reasons last written to its data, never changed in place
+        self._health = []
+        # row -> (MAC, model) of the hardware the seen boards and fans belong to
+        self._hardware = []
+        self._allocate(capacity, 0, 0)
+
+    def _allocate(self, rows: int, boards: int, fans: int) -> None:
+        """Grow the arrays, keeping what is in them"""
+        old = getattr(self, "hashrate", None)
+        hashrate = np.full((rows, boards, WINDOW), np.nan)
+        # sum and count of the samples in each window, kept up to date by record
+        hashrate_sum = np.zeros((rows, boards))
+        hashrate_count = np.zeros((rows, boards), np.intp)
+        board_temp = np.zeros((rows, boards))
+        chip_temp = np.zeros((rows, boards))
+        board_present = np.zeros((rows, boards), bool)
+        board_seen = np.zeros((rows, boards), bool)
+        fan_rpm = np.zeros((rows, fans))
+        fan_present = np.zeros((rows, fans), bool)
+        fan_seen = np.zeros((rows, fans), bool)
+        # polled ok on its last poll, installed but its API isn't answering
+        active = np.zeros(rows, bool)
+        api_down = np.zeros(rows, bool)
+        # next slot of the hashrate window
+        position = np.zeros(rows, np.intp)
+        # index of the verdict in _VERDICTS, -1 for unknown
+        status = np.full(rows, -1, np.int8)
+        if old is not None:
+            r, b, f = old.shape[0], old.shape[1], self.fan_rpm.shape[1]
+            hashrate[:r, :b] = old
+            hashrate_sum[:r, :b] = self.hashrate_sum
+            hashrate_count[:r, :b] = self.hashrate_count
+            board_temp[:r, :b] = self.board_temp
+            chip_temp[:r, :b] = self.chip_temp
+            board_present[:r, :b] = self.board_present
+            board_seen[:r, :b] = self.board_seen
+            fan_rpm[:r, :f] = self.fan_rpm
+            fan_present[:r, :f] = self.fan_present
+            fan_seen[:r, :f] = self.fan_seen
+            active[:r] = self.active
+            api_down[:r] = self.api_down
+            position[:r] = self.position
+            status[:r] = self.status
+        self.hashrate = hashrate
+        self.hashrate_sum = hashrate_sum
+        self.hashrate_count = hashrate_count
+        self.board_temp = board_temp
+        self.chip_temp = chip_temp
+        self.board_present = board_present
+        self.board_seen = board_seen
+        self.fan_rpm = fan_rpm
+        self.fan_present = fan_present
+        self.fan_seen = fan_seen
+        self.active = active
+        self.api_down = api_down
+        self.position = position
+        self.status = status
+
+    def _column(self, key: str, columns: dict, keys: list) -> int:
+        column = columns.get(key)
+        if column is None:
+            column = columns[key] = len(keys)
+            keys.append(key)
+            self._allocate(self.hashrate.shape[0], len(self.boards), len(self.fans))
+        return column
+
+    def _row(self, ip: str, data: dict) -> int:
+        row = self.rows.get(ip)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self._ips[row] = ip
+                self._data[row] = data
+                self._health[row] = None
+                self._hardware[row] = None
+            else:
+                row = len(self._ips)
+                self._ips.append(ip)
+                self._data.append(data)
+                self._health.append(None)
+                self._hardware.append(None)
+                if row >= self.hashrate.shape[0]:
+                    self._allocate(row * 2, len(self.boards), len(self.fans))
+            self.rows[ip] = row
+        self._data[row] = data
+        return row
+
+    def record(self, ip: str, data: dict) -> None:
+        """Take in a poll result, data gets the verdict of the miner right away and is updated by evaluate()"""
+        row = self._row(ip, data)
+        identity = data.get("Identity")
+        if identity is not None:
+            hardware = (identity.get("mac"), identity.get("model"))
+            if hardware != self._hardware[row]:
+                if self._hardware[row] is not None:
+                    # other hardware at this IP, boards and fans the old one had aren't missing from it
+                    self._forget(row)
+                self._hardware[row] = hardware
+        hashrates = data.get("HR")
+        if hashrates is None:
+            # not polled, forget the window so old samples aren't judged when it comes back
+            self.active[row] = False
+            self.api_down[row] = data.get("State") == "done"
+            self._clear_window(row)
+            self.board_present[row] = False
+            self.fan_present[row] = False
+        else:
+            self.active[row] = True
+            self.api_down[row] = False
+            temps = data.get("Temps", {})
+            fans = data.get("Fans", {})
+            for key in hashrates:
+                self._column(key, self._board_columns, self.boards)
+            for key in fans:
+                self._column(key, self._fan_columns, self.fans)
+            position = self.position[row]
+            # drop the oldest samples from the sums
+            oldest = self.hashrate[row, :, position]
+            sampled = ~np.isnan(oldest)
+            self.hashrate_sum[row, sampled] -= oldest[sampled]
+            self.hashrate_count[row] -= sampled
+            self.hashrate[row, :, position] = np.nan
+            self.board_present[row] = False
+            for key, board in hashrates.items():
+                column = self._board_columns[key]
+                self.hashrate[row, column, position] = board["HR"]
+                self.hashrate_sum[row, column] += board["HR"]
+                self.hashrate_count[row, column] += 1
+                temp = temps.get(key, {})
+                self.board_temp[row, column] = temp.get("Board", 0.0)
+                self.chip_temp[row, column] = temp.get("Chip", 0.0)
+                self.board_present[row, column] = True
+            self.board_seen[row] |= self.board_present[row]
+            self.position[row] = (position + 1) % WINDOW
+            self.fan_present[row] = False
+            for key, fan in fans.items():
+                column = self._fan_columns[key]
+                self.fan_rpm[row, column] = fan["RPM"]
+                self.fan_present[row, column] = True
+            self.fan_seen[row] |= self.fan_present[row]
+        data["Health"] = self._health[row] or _UNKNOWN
+
+    def _clear_window(self, row: int) -> None:
+        self.hashrate[row] = np.nan
+        self.hashrate_sum[row] = 0.0
+        self.hashrate_count[row] = 0
+
+    def _forget(self, row: int) -> None:
+        """Forget the samples and the boards and fans seen on a row"""
+        self._clear_window(row)
+        self.board_present[row] = False
+        self.board_seen[row] = False
+        self.fan_present[row] = False
+        self.fan_seen[row] = False
+        self.position[row] = 0
+
+    def remove(self, ip: str) -> None:
+        """Forget a miner that left the list"""
+        row = self.rows.pop(ip, None)
+        if row is None:
+            return
+        self._ips[row] = None
+        self._data[row] = None
+        self._health[row] = None
+        self._hardware[row] = None
+        self.active[row] = False
+        self.api_down[row] = False
+        self._forget(row)
+        self.status[row] = -1
+        self._free.append(row)
+
+    def evaluate(self) -> int:
+        """Judge every miner against the fleet and the thresholds, returns how many verdicts changed"""
+        with HEALTH_SECONDS.time():
+            return self._evaluate()
+
+    def _evaluate(self) -> int:
+        used = len(self._ips)
+        active = self.active[:used]
+        present = self.board_present[:used] & active[:, None]
+        samples = self.hashrate_count[:used]
+        rolling = np.divide(self.hashrate_sum[:used], samples, out=np.zeros(samples.shape), where=samples > 0)
+        latest = self.hashrate[np.arange(used), :, (self.position[:used] - 1) % WINDOW]
+        board_temp = self.board_temp[:used]
+        chip_temp = self.chip_temp[:used]
+        fan_rpm = self.fan_rpm[:used]
+        fans_present = self.fan_present[:used] & active[:, None]
+
+        hottest = np.maximum(board_temp, chip_temp)
+
+        # boards that are hashing make up the fleet the others are compared to
+        hashing = present & (latest > 0)
+        # firmware without the temps command reports no temperatures
+        has_temp = hashing & (hottest > 0)
+        spinning = fans_present & (fan_rpm > 0)
+        hashrate_z = _robust_z(rolling, hashing, MIN_HASHRATE_SPREAD, relative=True)
+        temp_z = _robust_z(hottest, has_temp, MIN_TEMP_SPREAD)
+        fan_z = _robust_z(fan_rpm, spinning, MIN_FAN_SPREAD)
+
+        hot = self.temp_limits["hot_temp"]
+        dangerous = self.temp_limits["dangerous_temp"]
+        board_checks = (
+            # (cells flagged, level, reason, z-scores the reason quotes)
+            (self.board_seen[:used] & ~present & active[:, None], CRITICAL, "{key} missing", None),
+            (present & ~(latest > 0), CRITICAL, "{key} not hashing", None),
+            (present & (hottest >= dangerous), CRITICAL, "{key} at {temp:.0f}°C, over dangerous_temp", None),
+            (present & (hottest >= hot) & (hottest < dangerous), WARNING, "{key} at {temp:.0f}°C, over hot_temp",
+             None),
+            (hashing & (hashrate_z <= -Z_THRESHOLD), WARNING, "{key} hashrate {z:.1f}σ below the fleet",
+             hashrate_z),
+            (has_temp & (temp_z >= Z_THRESHOLD) & (hottest < hot), WARNING, "{key} {z:.1f}σ hotter than the fleet",
+             temp_z),
+        )
+        fan_checks = (
+            (self.fan_seen[:used] & ~fans_present & active[:, None], CRITICAL, "{key} missing", None),
+            (fans_present & (fan_rpm <= 0), CRITICAL, "{key} stopped", None),
+            (spinning & (fan_z <= -Z_THRESHOLD), WARNING, "{key} {z:.1f}σ slower than the fleet", fan_z),
+        )
+
+        # row -> [index of the worst verdict, reasons], only for rows with something wrong
+        flagged = {}
+        for row in np.flatnonzero(self.api_down[:used]):
+            flagged[row] = [_VERDICTS.index(CRITICAL), ["API not answering"]]
+        for keys, checks in ((self.boards, board_checks), (self.fans, fan_checks)):
+            for cells, level, reason, z in checks:
+                for row, column in zip(*np.nonzero(cells)):
+                    entry = flagged.setdefault(row, [0, []])
+                    entry[0] = max(entry[0], _VERDICTS.index(level))
+                    entry[1].append(reason.format(key=keys[column], temp=hottest[row, column],
+                                                  z=abs(z[row, column]) if z is not None else 0.0))
+
+        # besides the flagged rows only miners that were flagged, came up or went down can change
+        status = self.status[:used]
+        candidates = set(flagged)
+        candidates.update(np.flatnonzero((status > 0) | ((status == 0) != active)).tolist())
+        changed = 0
+        for row in candidates:
+            if self._data[row] is None:
+                continue
+            if row in flagged:
+                level, reasons = flagged[row]
+                health = {"status": _VERDICTS[level], "reasons": reasons}
+            else:
+                level, health = (0, _OK) if active[row] else (-1, _UNKNOWN)
+            if health != self._health[row]:
+                self._health[row] = health
+                self._data[row]["Health"] = health
+                changed += 1
+            self.status[row] = level
+        return changed
+
+    def counts(self) -> dict:
+        """Number of miners with each verdict"""
+        status = self.status[:len(self._ips)]
+        counts = {verdict: int(np.count_nonzero(status == level)) for level, verdict in enumerate(_VERDICTS)}
+        counts[UNKNOWN] = len(self.rows) - sum(counts.values())
+        return counts
+
+    def verdicts(self) -> dict:
+        """ip -> latest verdict of every miner"""
+        return {ip: self._health[row] or _UNKNOWN for ip, row in self.rows.items()}
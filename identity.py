@@ -0,0 +1,143 @@
+import asyncio
+import re
+import sys
+import time
+
+# seconds a fetched identity is trusted before it is fetched again
+IDENTITY_TTL = 600
+# keys of the version reply that name the mining software, checked in this order
+FIRMWARE_KEYS = ("BOSminer+", "BOSminer", "BMMiner", "CGMiner", "bmminer", "cgminer", "LUXminer")
+# keys of the version reply that hold the model of the miner
+MODEL_KEYS = ("Type", "Model", "Miner")
+
+_MAC = re.compile(r"([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}")
+
+
+class Identity:
+    """What a miner is: the firmware it runs, its version, model and MAC address"""
+    __slots__ = ("firmware", "version", "model", "mac", "fetched_at")
+
+    def __init__(self, firmware: str = None, version: str = None, model: str = None, mac: str = None):
+        self.firmware = firmware
+        self.version = version
+        self.model = model
+        self.mac = mac
+        # monotonic time it was fetched
+        self.fetched_at = time.monotonic()
+
+    @classmethod
+    def from_version(cls, reply: dict, mac: str = None) -> "Identity":
+        """
+        Parse the reply to the API version command
+
+        Raises KeyError or IndexError if there is no VERSION section.
+        """
+        version = reply["VERSION"][0]
+        firmware = next((key for key in FIRMWARE_KEYS if key in version), None)
+        if firmware is None:
+            # unknown software, the first key that isn't the API version names it
+            firmware = next((key for key in version if key not in ("API", "CompileTime", *MODEL_KEYS)), None)
+        model = next((version[key] for key in MODEL_KEYS if key in version), None)
+        return cls(firmware, version.get(firmware) if firmware else None, model, mac)
+
+    def to_dict(self) -> dict:
+        return {"firmware": self.firmware, "version": self.version, "model": self.model, "mac": self.mac}
+
+
+async def lookup_mac(ip: str) -> str or None:
+    """
+    MAC address of a host on the local network, from the ARP cache
+
+    The cache is filled by any connection we just made to the host, so this
+    costs no request to the miner. Returns None for hosts behind a router
+    or when it can't be read.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/net/arp") as arp:
+                for line in arp.readlines()[1:]:
+                    fields = line.split()
+                    if len(fields) >= 4 and fields[0] == ip and fields[3] != "00:00:00:00:00:00":
+                        return fields[3].lower()
+        except OSError:
+            pass
+        return None
+    try:
+        proc = await asyncio.create_subprocess_exec("arp", "-a", ip, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=5)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    for line in stdout.decode(errors="replace").splitlines():
+        if ip in line.split() or f"({ip})" in line:
+            match = _MAC.search(line)
+            if match:
+                return match.group(0).replace("-", ":").lower()
+    return None
+
+
+class IdentityCache:
+    """
+    The identity of one miner, fetched once and shared by every caller
+
+    Callers that ask while a fetch is running wait on that fetch instead of
+    starting their own. The identity expires after ttl seconds or when
+    invalidate is called (the firmware changed, on a reboot). suspect is
+    for a disconnect: the next get only refetches if the MAC address in
+    the ARP cache shows different hardware, or can't be read.
+    """
+    def __init__(self, ip: str, fetch, ttl: float = IDENTITY_TTL, on_change=None):
+        self.ip = ip
+        # async fetch() -> Identity, raises if the miner can't be asked
+        self.fetch = fetch
+        self.ttl = ttl
+        # called with the new Identity (or None) whenever it changes
+        self.on_change = on_change
+        self.identity = None
+        # set after a disconnect, the hardware may have been swapped
+        self.suspect_hardware = False
+        self._pending = None
+
+    def invalidate(self) -> None:
+        """Forget the identity, the next get fetches it again"""
+        if self.identity is not None:
+            self.identity = None
+            if self.on_change is not None:
+                self.on_change(None)
+        self.suspect_hardware = False
+
+    def restore(self, identity: Identity) -> None:
+        """Use an identity saved before a restart, the MAC is checked before it is trusted"""
+        self.identity = identity
+        self.suspect_hardware = True
+        if self.on_change is not None:
+            self.on_change(identity)
+
+    def suspect(self) -> None:
+        """The miner disconnected, check it is the same hardware before trusting the identity again"""
+        self.suspect_hardware = True
+
+    async def get(self) -> Identity:
+        """The cached identity, fetching it if it is missing, expired or the hardware changed"""
+        if self.identity is not None and self.suspect_hardware:
+            mac = await lookup_mac(self.ip)
+            if mac is None or mac != self.identity.mac:
+                self.invalidate()
+            self.suspect_hardware = False
+        if self.identity is not None and time.monotonic() - self.identity.fetched_at < self.ttl:
+            return self.identity
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._fetch())
+        # shield so one caller being cancelled doesn't cancel the fetch for everyone else
+        return await asyncio.shield(self._pending)
+
+    async def _fetch(self) -> Identity:
+        try:
+            identity = await self.fetch()
+        finally:
+            self._pending = None
+        old = self.identity
+        self.identity = identity
+        if self.on_change is not None and (old is None or old.to_dict() != identity.to_dict()):
+            self.on_change(identity)
+        return identity
@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import asyncssh
+
+from distribution import Distributor
+from miner_log import ERROR
+from processes import JobCancelled
+# files pushed to every miner after the firmware install
+CONFIG_FILE = os.path.join(os.getcwd(), "files", "config.toml")
+REFERRAL_FILE = os.path.join(os.getcwd(), "files", "referral.ipk")
+# where they go on the miner
+REMOTE_CONFIG = "/etc/bosminer.toml"
+REMOTE_REFERRAL = "/tmp/referral.ipk"
+# hash of the firmware last installed on a miner, checked before installing again
+REMOTE_FW_MARKER = "/etc/testbench_fw.sha256"
+# sha256 of the artifacts by path, size and mtime, so a restart doesn't hash the firmware again
+HASH_CACHE_FILE = os.path.join(os.getcwd(), "hashes.json")
+
+# installs running at the same time
+MAX_CONCURRENT = 10
+# installs that must succeed before the rest of the bench is let through
+CANARY = 1
+# installs let through per batch after the canary
+BATCH_SIZE = 10
+# a stage with more failures than this halts the rollout until resume is called
+MAX_FAILURE_RATIO = 0.5
+# priority of an install unless told otherwise, lower goes first
+DEFAULT_PRIORITY = 10
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file, read in chunks so large tarballs don't sit in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """
+    sha256 of files kept on disk, keyed by path and only valid for the size and mtime they were hashed at
+
+    Shards share the file, it is replaced in one step so a reader never
+    sees half of it, and a missing or broken file just means hashing again.
+    """
+    def __init__(self, path: str = HASH_CACHE_FILE):
+        self.path = path
+        # path -> [size, mtime_ns, sha256], read on first use
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path) as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, path: str, size: int, mtime_ns: int) -> str or None:
+        entry = self._load().get(os.path.abspath(path))
+        if entry is not None and entry[:2] == [size, mtime_ns]:
+            return entry[2]
+        return None
+
+    def put(self, path: str, size: int, mtime_ns: int, sha256: str) -> None:
+        self._load()[os.path.abspath(path)] = [size, mtime_ns, sha256]
+        temp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "w") as cache_file:
+                json.dump(self._entries, cache_file)
+            os.replace(temp, self.path)
+        except OSError as e:
+            # only costs a hash on the next restart
+            print(f"Could not save file hashes: {e}")
+
+
+class Artifact:
+    """A file that gets sent to miners, hashed once for the whole bench and looked up on disk after a restart"""
+    def __init__(self, path: str, cache: HashCache = None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = 0
+        self.sha256 = None
+        self.cache = cache
+        # (size, mtime) the hash was computed for
+        self._stamp = None
+
+    async def stage(self) -> "Artifact":
+        """Hash the file if it is new or changed, in a thread so the loop keeps running"""
+        stat = os.stat(self.path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp != self._stamp:
+            sha256 = self.cache.get(self.path, *stamp) if self.cache is not None else None
+            if sha256 is None:
+                sha256 = await asyncio.get_running_loop().run_in_executor(None, hash_file, self.path)
+                if self.cache is not None:
+                    self.cache.put(self.path, *stamp, sha256)
+            self.sha256 = sha256
+            self.size = stat.st_size
+            self._stamp = stamp
+        return self
+
+
+class InstallOrchestrator:
+    """
+    Decides when each miner is allowed to install, and stages the files it needs
+
+    Miners wait in a priority queue for a slot. The first CANARY installs go
+    alone; once they succeed the rest are let through in batches of
+    BATCH_SIZE, never more than MAX_CONCURRENT at once. A canary or batch
+    with too many failures halts the rollout until resume is called.
+    """
+    def __init__(self, firmware: str = None, config: str = CONFIG_FILE, referral: str = REFERRAL_FILE,
+                 max_concurrent: int = MAX_CONCURRENT, canary: int = CANARY, batch_size: int = BATCH_SIZE,
+                 max_failure_ratio: float = MAX_FAILURE_RATIO, hash_cache: HashCache = None,
+                 distributor: Distributor = None):
+        # nothing is read until an artifact is first needed, so building the orchestrator is cheap
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+        self.firmware = Artifact(firmware, self.hash_cache) if firmware else None
+        self.config = Artifact(config, self.hash_cache) if config and os.path.exists(config) else None
+        self.referral = Artifact(referral, self.hash_cache) if referral and os.path.exists(referral) else None
+        # sends the config and referral, under one bandwidth budget
+        self.distributor = distributor if distributor is not None else Distributor()
+        self.max_concurrent = max_concurrent
+        self.canary = canary
+        self.batch_size = batch_size
+        self.max_failure_ratio = max_failure_ratio
+
+        # heap of (priority, order, ip, future) for miners waiting on a slot
+        self._waiting = []
+        self._order = itertools.count()
+        # ips let through and currently installing
+        self.active = set()
+        # current stage: "canary" or "batch", and its number
+        self.stage = "canary" if canary > 0 else "batch"
+        self.stage_number = 1
+        # installs let into, and finished in, the current stage
+        self._stage_admitted = 0
+        self._stage_failed = 0
+        self._stage_done = 0
+        # set when a stage failed too often
+        self.halted = False
+
+        # throughput
+        self.started_at = None
+        self.completed = 0
+        self.failed = 0
+        # paused or stopped before they finished, not counted as failures
+        self.aborted = 0
+        self.skipped_uploads = 0
+        # bytes of config and referral the distributor sent
+        self.bytes_uploaded = 0
+        # the installer program sends the firmware itself, this is the tarball size times the installs
+        self.firmware_bytes_estimated = 0
+
+    async def stage_artifacts(self) -> None:
+        """Hash every artifact once, later calls only rehash files that changed"""
+        for artifact in (self.firmware, self.config, self.referral):
+            if artifact is not None:
+                await artifact.stage()
+
+    @asynccontextmanager
+    async def slot(self, miner, priority: int = DEFAULT_PRIORITY):
+        """Wait for this miner's turn to install, the install runs inside the block"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiting, (priority, next(self._order), miner.ip, future))
+        if len(self._waiting) > 1 or not self._can_admit():
+            miner.add_to_output(f"Queued for install ({len(self._waiting)} waiting)...")
+        self._admit()
+        try:
+            await future
+        except asyncio.CancelledError:
+            miner.install_outcome = "aborted"
+            if future.cancelled():
+                self._waiting = [item for item in self._waiting if item[3] is not future]
+                heapq.heapify(self._waiting)
+            else:
+                # we were let in just as we got cancelled, give the slot back
+                self.active.discard(miner.ip)
+                self._stage_admitted -= 1
+                self._admit()
+            raise
+
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        outcome = "failed"
+        try:
+            await self.stage_artifacts()
+            yield self
+            outcome = "completed"
+        except (JobCancelled, asyncio.CancelledError):
+            # paused or stopped on purpose, it says nothing about the firmware
+            outcome = "aborted"
+            raise
+        finally:
+            self.active.discard(miner.ip)
+            # the state store records the install the same way
+            miner.install_outcome = outcome
+            self._finish(outcome)
+
+    def prioritize(self, ip: str, priority: int) -> bool:
+        """Change the priority of a waiting miner, returns False if it isn't waiting"""
+        for index, (_, order, waiting_ip, future) in enumerate(self._waiting):
+            if waiting_ip == ip:
+                self._waiting[index] = (priority, order, waiting_ip, future)
+                heapq.heapify(self._waiting)
+                return True
+        return False
+
+    def resume(self) -> None:
+        """Resume a halted rollout, starting a fresh batch"""
+        self.halted = False
+        self._next_stage()
+        self._admit()
+
+    def set_limits(self, max_concurrent: int, canary: int, batch_size: int, max_failure_ratio: float) -> None:
+        """Change the rollout limits while installs run, a higher limit lets waiting miners in right away"""
+        self.max_concurrent = max_concurrent
+        self.canary = canary
+        self.batch_size = batch_size
+        self.max_failure_ratio = max_failure_ratio
+        self._admit()
+
+    def set_firmware(self, firmware: str or None) -> None:
+        """Use a different firmware tarball for installs that start from now on"""
+        if firmware != (self.firmware.path if self.firmware is not None else None):
+            self.firmware = Artifact(firmware, self.hash_cache) if firmware else None
+
+    def stats(self) -> dict:
+        """Install throughput so far"""
+        hours = (time.monotonic() - self.started_at) / 3600 if self.started_at else 0
+        return {
+            "stage": self.stage,
+            "stage_number": self.stage_number,
+            "halted": self.halted,
+            "active": len(self.active),
+            "waiting": len(self._waiting),
+            "completed": self.completed,
+            "failed": self.failed,
+            "aborted": self.aborted,
+            "installs_per_hour": round(self.completed / hours, 2) if hours else 0.0,
+            "bytes_uploaded": self.bytes_uploaded,
+            "firmware_bytes_estimated": self.firmware_bytes_estimated,
+            "skipped_uploads": self.skipped_uploads,
+            "uploads": self.distributor.stats(),
+        }
+
+    async def has_firmware(self, miner) -> bool:
+        """Check if the miner already runs the firmware we would install"""
+        if self.firmware is None:
+            return False
+        await self.firmware.stage()
+        return await self._remote_hash(miner, REMOTE_FW_MARKER, plain=True) == self.firmware.sha256
+
+    async def installed(self, miner) -> None:
+        """Push the config and referral after a firmware install, then mark the firmware as installed"""
+        if self.firmware is not None:
+            self.firmware_bytes_estimated += self.firmware.size
+        await self.configure(miner)
+        # only now, has_firmware skips the install for a miner with the marker, config and referral included
+        if self.firmware is not None:
+            await miner.run_command(f"echo {self.firmware.sha256} > {REMOTE_FW_MARKER}")
+
+    def _pushes(self) -> dict:
+        """name -> (artifact, where it goes on the miner, command that puts it to use)"""
+        return {
+            "config": (self.config, REMOTE_CONFIG, "/etc/init.d/bosminer restart"),
+            "referral": (self.referral, REMOTE_REFERRAL, f"opkg install {REMOTE_REFERRAL}"),
+        }
+
+    async def configure(self, miner) -> None:
+        """Push config.toml and referral.ipk, skipping whichever the miner already has"""
+        for artifact, remote_path, command in self._pushes().values():
+            if artifact is not None and await self.push(miner, artifact, remote_path):
+                await miner.run_command(command)
+
+    async def push(self, miner, artifact: Artifact, remote_path: str) -> bool:
+        """
+        Send an artifact unless the miner has a matching copy, returns True if it was sent
+
+        Raises RuntimeError if it couldn't be sent.
+        """
+        result = await self.distributor.send(miner, artifact, remote_path)
+        self.bytes_uploaded += result["bytes"]
+        if result["status"] == "skipped":
+            self.skipped_uploads += 1
+            miner.add_to_output(f"{artifact.name} already up to date...")
+            return False
+        if result["status"] == "failed":
+            miner.add_to_output(f"Could not send {artifact.name}: {result['error']}", ERROR)
+            raise RuntimeError(f"could not send {artifact.name} to {miner.ip}: {result['error']}")
+        miner.add_to_output(f"{artifact.name} sent...")
+        return True
+
+    async def distribute(self, miners: list, name: str) -> dict:
+        """
+        Push the config or referral to many miners at once, and put it to use on the ones that got it
+
+        Raises ValueError for an unknown name or one that has no file.
+        """
+        if name not in self._pushes():
+            raise ValueError(f"unknown artifact {name}, use one of {sorted(self._pushes())}")
+        artifact, remote_path, command = self._pushes()[name]
+        if artifact is None:
+            raise ValueError(f"there is no {name} file to send")
+
+        async def put_to_use(miner) -> None:
+            await miner.run_command(command)
+
+        summary = await self.distributor.push(miners, artifact, remote_path, after=put_to_use)
+        self.bytes_uploaded += summary["bytes"]
+        self.skipped_uploads += summary["skipped"]
+        return {"artifact": name, **summary}
+
+    @staticmethod
+    async def _remote_hash(miner, remote_path: str, plain: bool = False) -> str or None:
+        """sha256 of a file on the miner, or the contents of a hash marker file"""
+        command = f"cat {remote_path}" if plain else f"sha256sum {remote_path}"
+        try:
+            async with miner.get_connection(miner.settings.username, miner.settings.password) as conn:
+                result = await conn.run(command)
+        except (OSError, asyncssh.Error):
+            # can't tell, assume the miner doesn't have it
+            return None
+        if result.exit_status != 0 or not result.stdout:
+            return None
+        return result.stdout.split()[0]
+
+    def _limit(self) -> int:
+        """Installs the current stage can still let through"""
+        if self.stage == "canary":
+            return self.canary - self._stage_admitted
+        return self.batch_size - self._stage_admitted
+
+    def _can_admit(self) -> bool:
+        return not self.halted and self._limit() > 0 and len(self.active) < self.max_concurrent
+
+    def _admit(self) -> None:
+        """Let waiting miners through while the stage has room"""
+        while self._waiting and self._can_admit():
+            _, _, ip, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self._stage_admitted += 1
+            self.active.add(ip)
+            future.set_result(None)
+
+    def _finish(self, outcome: str) -> None:
+        """
+        Account for a finished install and move the rollout along
+
+        outcome is "completed", "failed" or "aborted". An aborted install
+        frees its place in the stage as if it had never been let in, so
+        pausing a canary doesn't halt the rollout.
+        """
+        if outcome == "aborted":
+            self.aborted += 1
+            self._stage_admitted -= 1
+        else:
+            self._stage_done += 1
+            if outcome == "completed":
+                self.completed += 1
+            else:
+                self.failed += 1
+                self._stage_failed += 1
+        # the stage is over once everything let in has finished and either it was full or no one is waiting
+        stage_over = (self._stage_done and self._stage_done == self._stage_admitted
+                      and (self._limit() <= 0 or not self._waiting))
+        if stage_over:
+            if self._stage_failed > self._stage_done * self.max_failure_ratio:
+                self.halted = True
+                print(f"Install rollout halted, {self._stage_failed} of {self._stage_done} failed in "
+                      f"{self.stage} {self.stage_number}")
+            else:
+                self._next_stage()
+        self._admit()
+
+    def _next_stage(self) -> None:
+        # the canary stage only ends once at least one canary succeeded
+        if self.stage == "canary" and self._stage_done > self._stage_failed:
+            self.stage = "batch"
+            self.stage_number = 0
+        self.stage_number += 1
+        self._stage_admitted = 0
+        self._stage_failed = 0
+        self._stage_done = 0
@@ -0,0 +1,195 @@
+import bisect
+import math
+import time
+from contextlib import contextmanager
+
+# default histogram buckets in seconds, from a fast API reply up to a stuck SSH command
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# buckets for work that stays on the event loop, like serializing a broadcast
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Metric:
+    """A named metric, optionally split by labels"""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # tuple of label values -> value(s) for that combination
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[tuple]:
+        """(name, labels, value) for every line of this metric"""
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down"""
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts of observations in buckets, plus their sum and count"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # per bucket counts (not cumulative, that is done when rendering), sum, count
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent inside the block, works around awaits too"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[tuple]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """
+    A metric read from somewhere else when scraped, like the size of a pool
+
+    callback returns a number, or a dict of label value tuples -> number.
+    """
+    def __init__(self, name: str, documentation: str, callback, metric_type: str = "gauge",
+                 labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self.callback = callback
+
+    def samples(self) -> list[tuple]:
+        result = self.callback()
+        if not isinstance(result, dict):
+            return [(self.name, {}, result)]
+        return [(self.name, dict(zip(self.labelnames, key if isinstance(key, tuple) else (key,))), value)
+                for key, value in result.items()]
+
+
+class Registry:
+    """Every metric the webserver exposes, rendered in the Prometheus text format"""
+    def __init__(self):
+        # name -> metric, in the order they were registered
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str) -> None:
+        self.metrics.pop(name, None)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback, metric_type: str = "gauge",
+                 labelnames: tuple = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, metric_type, labelnames))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# the registry served on /metrics
+registry = Registry()
+
+# hot path timings
+PING_SECONDS = registry.histogram("miner_ping_seconds", "Time to open a TCP connection to a miner port")
+API_COMMAND_SECONDS = registry.histogram("miner_api_command_seconds", "Time for a miner API command to reply")
+SSH_CONNECT_SECONDS = registry.histogram("ssh_connect_seconds", "Time to get a pooled SSH connection to a miner")
+SSH_COMMAND_SECONDS = registry.histogram("ssh_command_seconds", "Time to run a command over SSH on a miner")
+POLL_SECONDS = registry.histogram("miner_poll_seconds", "Time to poll one miner for the dashboard")
+POLL_CYCLE_SECONDS = registry.histogram("poll_cycle_seconds", "Time for one MinerList.get_data over every miner")
+ENCODE_SECONDS = registry.histogram("broadcast_encode_seconds", "Time to serialize a broadcast",
+                                    ("format",), FAST_BUCKETS)
+EMIT_SECONDS = registry.histogram("broadcast_emit_seconds", "Time to emit a broadcast to the clients",
+                                  ("format",), FAST_BUCKETS)
+HEALTH_SECONDS = registry.histogram("health_evaluate_seconds", "Time to judge the health of every miner",
+                                    buckets=FAST_BUCKETS)
+LOOP_LAG_SECONDS = registry.histogram("event_loop_lag_seconds", "How late the event loop runs a timer",
+                                      buckets=FAST_BUCKETS)
+LOOP_STALLS = registry.counter("event_loop_stalls_total", "Times the event loop was blocked past the slow threshold")
@@ -0,0 +1,184 @@
+import asyncio
+import json
+
+# default port of the [cgminer, bmminer, bosminer] API
+API_PORT = 4028
+# seconds to wait for the API port to accept a connection
+CONNECT_TIMEOUT = 5
+# seconds to wait for a full reply after sending a command
+READ_TIMEOUT = 10
+# biggest reply we will buffer, devs+temps+fans on 3 boards is a few KB
+MAX_REPLY_SIZE = 1024 * 1024
+# maximum number of API requests in flight across every miner
+MAX_CONCURRENT_REQUESTS = 256
+
+# global limit on open API requests, created lazily so it binds to the running loop
+_request_limit = None
+
+
+class APIError(Exception):
+    """Base error for anything that goes wrong talking to the miner API"""
+
+
+class APIConnectionError(APIError):
+    """The API port refused, reset or closed the connection"""
+
+
+class APITimeoutError(APIError):
+    """The API did not connect or reply in time"""
+
+
+class APIResponseError(APIError):
+    """The API replied with something that is not a valid response"""
+
+
+def request_limit() -> asyncio.Semaphore:
+    """Get the semaphore bounding API requests across all miners"""
+    global _request_limit
+    if _request_limit is None:
+        _request_limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _request_limit
+
+
+def set_request_limit(limit: int) -> None:
+    """
+    Change the number of API requests allowed in flight
+
+    New requests wait on the new limit right away, requests already holding
+    the old one finish under it, so for a moment both can be in flight.
+    """
+    global MAX_CONCURRENT_REQUESTS, _request_limit
+    MAX_CONCURRENT_REQUESTS = limit
+    _request_limit = None
+
+
+class MinerAPI:
+    """
+    Client for the JSON API on port 4028 of a single miner
+
+    The connection is kept open between commands when the firmware allows it,
+    cgminer based firmware closes the socket after every reply so we learn
+    that on the first command and stop trying to reuse it.
+    """
+    def __init__(self, ip: str, port: int = API_PORT,
+                 connect_timeout: float = CONNECT_TIMEOUT, timeout: float = READ_TIMEOUT):
+        # miner IP address
+        self.ip = ip
+        # API port
+        self.port = port
+        # timeouts for connecting and for reading a reply
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        # None until we know if the firmware keeps the connection open
+        self.reusable = None
+        # open streams, if any
+        self._reader = None
+        self._writer = None
+        # only one command can be on the wire at a time per connection
+        self._lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        """Whether a connection to the API is open right now"""
+        return self._writer is not None
+
+    async def send_command(self, command: str, parameter: str = None) -> dict:
+        """Send a command to the API and return the decoded reply"""
+        return self._decode(await self.send_raw(command, parameter))
+
+    async def send_raw(self, command: str, parameter: str = None) -> bytes:
+        """Send a command to the API and return the reply undecoded, without the null terminator"""
+        payload = {"command": command}
+        if parameter is not None:
+            payload["parameter"] = parameter
+        payload = json.dumps(payload).encode('utf-8')
+
+        async with request_limit():
+            async with self._lock:
+                raw = await self._request(payload)
+        return raw.rstrip(b"\x00")
+
+    async def close(self) -> None:
+        """Close the connection to the API if one is open"""
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _connect(self) -> None:
+        """Open a new connection to the API port"""
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port, limit=MAX_REPLY_SIZE),
+                timeout=self.connect_timeout)
+        except asyncio.TimeoutError as e:
+            raise APITimeoutError(f"{self.ip}:{self.port} connect timed out") from e
+        except OSError as e:
+            raise APIConnectionError(f"{self.ip}:{self.port} {e}") from e
+
+    async def _request(self, payload: bytes) -> bytes:
+        """Write a command and read back one null terminated reply"""
+        # one retry, a reused connection may have been closed by the miner while idle
+        for _ in range(2):
+            reused = self._writer is not None
+            if not reused:
+                await self._connect()
+            try:
+                self._writer.write(payload)
+                await self._writer.drain()
+                raw = await asyncio.wait_for(self._read_reply(), timeout=self.timeout)
+            except asyncio.TimeoutError as e:
+                await self.close()
+                raise APITimeoutError(f"{self.ip}:{self.port} reply timed out") from e
+            except (OSError, asyncio.IncompleteReadError) as e:
+                await self.close()
+                if reused:
+                    # the firmware dropped our kept-alive connection, stop reusing it
+                    self.reusable = False
+                    continue
+                raise APIConnectionError(f"{self.ip}:{self.port} connection lost") from e
+            except asyncio.LimitOverrunError as e:
+                await self.close()
+                raise APIResponseError(f"{self.ip}:{self.port} reply too large") from e
+
+            # keep the connection for the next command unless the firmware closed it
+            if self._reader.at_eof():
+                self.reusable = False
+            if self.reusable is False:
+                await self.close()
+            elif self.reusable is None and reused:
+                # a second command went through on the same connection
+                self.reusable = True
+            return raw
+        raise APIConnectionError(f"{self.ip}:{self.port} connection lost")
+
+    async def _read_reply(self) -> bytes:
+        """Read one reply, framed by the trailing null byte"""
+        try:
+            # StreamReader buffers into a single bytearray, no per chunk concatenation
+            return await self._reader.readuntil(b"\x00")
+        except asyncio.IncompleteReadError as e:
+            # some firmware closes the socket instead of sending the null byte
+            if e.partial:
+                self.reusable = False
+                return e.partial
+            raise
+
+    def _decode(self, raw: bytes) -> dict:
+        """Decode a raw reply into a dict"""
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            raise APIResponseError(f"{self.ip}:{self.port} invalid JSON reply") from e
+        if not isinstance(data, dict):
+            raise APIResponseError(f"{self.ip}:{self.port} unexpected reply")
+        # single commands report failures in STATUS
+        status = data.get("STATUS")
+        if isinstance(status, list) and status and status[0].get("STATUS") == "E":
+            raise APIResponseError(f"{self.ip}:{self.port} {status[0].get('Msg', 'command failed')}")
+        return data
@@ -1,25 +1,117 @@
 import asyncio
-import json
+import ipaddress
 import asyncssh
 import os
+import time
+from contextlib import asynccontextmanager
+from miner_api import MinerAPI, APIError, APIConnectionError, APITimeoutError, CONNECT_TIMEOUT, READ_TIMEOUT
+from ssh_pool import SSHPool, default_pool
+from processes import ProcessPool, ProcessResult, default_pool as default_process_pool
+from miner_log import MinerLog, INFO, WARNING, ERROR
+from timeseries import TimeSeriesStore
+from installer import InstallOrchestrator
+from state_machine import StateMachine, wait_until
+from identity import Identity, IdentityCache, lookup_mac
+from warmup import TokenBucket
+from commands import COMMAND_CONCURRENCY, COMMAND_TIMEOUT, MAX_OUTPUT, group_outputs
+from parsing import MinerStats, parse_stats
+from metrics import PING_SECONDS, API_COMMAND_SECONDS, SSH_CONNECT_SECONDS, SSH_COMMAND_SECONDS, POLL_CYCLE_SECONDS
+
+# install states and the states each one can move to, any state can fall back to "start"
+STATES = {
+    # waiting for the miner to come up, then deciding what it needs
+    "start": {"unlock", "install", "update", "done"},
+    # unlocking SSH on stock firmware
+    "unlock": {"install", "reset"},
+    # unlock failed, waiting for the user to reset the miner and unplug it
+    "reset": {"start"},
+    "install": {"done"},
+    "update": {"done"},
+    # installed, monitoring until the miner is unplugged
+    "done": {"start"},
+}
+# seconds each state may take before falling back to "start", None for no limit
+STATE_TIMEOUTS = {
+    "start": None,
+    "unlock": 300,
+    "reset": None,
+    "install": 1800,
+    "update": 600,
+    "done": None,
+}
+# seconds the installer takes to reboot the miner, it is still up for a bit after it exits
+REBOOT_GRACE = 30
+# seconds the installer may run, less than the install state timeout so it is killed first
+INSTALL_TIMEOUT = 1500
+# seconds the SSH unlock may run
+UNLOCK_TIMEOUT = 240
+# installer program, used for both the SSH unlock and the install
+INSTALLER = os.path.join(os.getcwd(), "files", "asicseer_installer.exe")
+# actions MinerList.batch can run on a selection of miners
+BATCH_ACTIONS = ("pause", "unpause", "light", "unlight", "reboot")
+# miners a batch action works on at the same time
+BATCH_CONCURRENCY = 32
+# tries run_command makes before giving up on a command
+COMMAND_ATTEMPTS = 3
+# SSH login of the firmware, unless the config says otherwise
+USERNAME = "root"
+PASSWORD = "admin"
+
+
+class MinerSettings:
+    """
+    Login, firmware and timeouts shared by every miner of a MinerList
+
+    Miners keep a reference to it instead of a copy, so a reloaded config
+    reaches the whole list by changing it in place.
+    """
+    __slots__ = ("username", "password", "firmware", "unlock_timeout", "install_timeout",
+                 "api_connect_timeout", "api_timeout")
+
+    def __init__(self, username: str = USERNAME, password: str = PASSWORD, firmware: str = None,
+                 unlock_timeout: float = UNLOCK_TIMEOUT, install_timeout: float = INSTALL_TIMEOUT,
+                 api_connect_timeout: float = CONNECT_TIMEOUT, api_timeout: float = READ_TIMEOUT):
+        self.username = username
+        self.password = password
+        # firmware tarball to install, None if there isn't one
+        self.firmware = firmware
+        self.unlock_timeout = unlock_timeout
+        self.install_timeout = install_timeout
+        self.api_connect_timeout = api_connect_timeout
+        self.api_timeout = api_timeout
 
-# file path for firmware tarball
-fw_file = None
-for file in os.listdir(os.path.join(os.getcwd(), "files")):
-    if file.endswith(".tar.gz"):
-        fw_file = os.path.join(os.getcwd(), "files", file)
-        print(fw_file)
 
 class Miner:
-    def __init__(self, ip: str):
+    def __init__(self, ip: str, api_port: int = 4028, http_port: int = 80, ssh_port: int = 22):
         # install state to track what has been done
-        self.main_state = "start"
+        self.state_machine = StateMachine("start", STATES, STATE_TIMEOUTS)
         # miner data that gets sent to the webserver
         self.stats = None
+        # whether the last get_api_data got stats from the API
+        self.polled_ok = False
         # miner IP address
         self.ip = ip
         # API port
-        self.api_port = 4028
+        self.api_port = api_port
+        # web UI and SSH ports, only changed for simulated miners
+        self.http_port = http_port
+        self.ssh_port = ssh_port
+        # pooled client for the API
+        self.api = MinerAPI(self.ip, self.api_port)
+        # login, firmware and timeouts, replaced by the settings of the MinerList this miner is added to
+        self.settings = MinerSettings()
+        # firmware, version, model and MAC, fetched once and kept until the miner reboots or is swapped
+        self.identity = IdentityCache(self.ip, self._fetch_identity, on_change=self._identity_changed)
+        # SSH connection pool, replaced by the pool of the MinerList this miner is added to
+        self.ssh_pool = default_pool
+        # pool running the installer, replaced by the pool of the MinerList this miner is added to
+        self.process_pool = default_process_pool
+        # installer jobs running for this miner, cancelled when it is paused
+        self.jobs = set()
+        # history store, set by the MinerList this miner is added to
+        self.history = None
+        # install orchestrator, set by the MinerList this miner is added to
+        self.installer = None
         # pause option for the webserver client
         self.running = asyncio.Event()
         self.running.set()
@@ -27,8 +119,19 @@ class Miner:
         self.firmware = asyncio.Event()
         # fault light option
         self.lit = False
-        # text data from the installer
-        self.messages = {"IP": self.ip, "text": ""}
+        # set when resumed as installed after a restart, checked before it is trusted
+        self.revalidate = False
+        # how the orchestrator counted the last install: "completed", "failed" or "aborted", None outside of one
+        self.install_outcome = None
+        # labels used to select groups of miners, like the rack they sit in
+        self.tags = set()
+        # log from the installer, clients fetch the text with MinerList.get_logs
+        self.log = MinerLog()
+        # install data that gets sent to the webserver, log_seq tells clients when the log has new entries
+        self.messages = {"IP": self.ip, "log_seq": 0, "Paused": False, "Lit": False, "State": "start",
+                         "Identity": None}
+        # clients filter on the state, keep it in the data
+        self.state_machine.subscribe(lambda old, new, elapsed: self.update_controls())
 
     async def ping(self, port: int) -> bool:
         """
@@ -43,7 +146,8 @@ class Miner:
         connection_fut = asyncio.open_connection(self.ip, port)
         try:
             # get the read and write streams from the connection
-            reader, writer = await asyncio.wait_for(connection_fut, timeout=1)
+            with PING_SECONDS.time():
+                reader, writer = await asyncio.wait_for(connection_fut, timeout=1)
             # immediately close connection, we know connection happened
             writer.close()
             # make sure the writer is closed
@@ -53,11 +157,9 @@ class Miner:
         except asyncio.exceptions.TimeoutError:
             # ping failed if we time out
             return False
-        except ConnectionRefusedError:
-            # handle for other connection errors
-            self.add_to_output("Unknown error...")
-        # ping failed, likely with an exception
-        return False
+        except OSError:
+            # refused or unreachable, the port is not up (yet)
+            return False
 
     async def ping_ssh(self) -> bool:
         """
@@ -69,7 +171,7 @@ class Miner:
         await self.running.wait()
 
         # ping port 22 (SSH)
-        if await self.ping(22):
+        if await self.ping(self.ssh_port):
             # ping returned true, SSH is up
             return True
         else:
@@ -86,28 +188,57 @@ class Miner:
         await self.running.wait()
 
         # ping port 80 (HTTP)
-        if await self.ping(80):
+        if await self.ping(self.http_port):
             # ping returned true, HTTP is up
             return True
         else:
             # ping returned false, HTTP is down
             return False
 
+    @property
+    def main_state(self) -> str:
+        """Current install state"""
+        return self.state_machine.state
+
+    async def ping_http_down(self) -> bool:
+        """
+        Check that the HTTP port of the miner is down
+        """
+        return not await self.ping_http()
+
     async def wait_for_disconnect(self) -> None:
         """
         Wait for the miner to disconnect
         """
         self.add_to_output('Waiting for disconnect...')
-        while await self.ping_http():
-            # pause logic
-            if not self.running.is_set():
-                self.add_to_output("Paused...")
-            await self.running.wait()
-            await asyncio.sleep(1)
+        # ping_http waits while paused, so backing off here is enough
+        await wait_until(self.ping_http_down, initial=1, maximum=5)
+        # the miner is gone, any cached SSH connection to it is dead
+        await self.ssh_pool.invalidate(self.ip)
+        # and the next one plugged in here may be different hardware, with its light off
+        self.identity.suspect()
+        if self.lit:
+            self.lit = False
+            self.update_controls()
+
+    async def wait_for_boot(self) -> None:
+        """
+        Wait for the miner to go down for a reboot and come back up for good
+        """
+        # new firmware, the version has to be fetched again
+        self.identity.invalidate()
+        # the installer exits before the miner actually reboots
+        await wait_until(self.ping_http_down, timeout=REBOOT_GRACE, initial=1, maximum=3)
+        while True:
+            await wait_until(self.ping_http, initial=1, maximum=5)
+            # make sure it stays up, the firmware can restart once more on first boot
+            await asyncio.sleep(5)
+            if await self.ping_http():
+                return
 
     async def get_version(self) -> str or bool:
         """
-        Get the version of the miner
+        Get the version of the miner, from the identity cache unless it expired
         """
         # pause logic
         if not self.running.is_set():
@@ -116,210 +247,284 @@ class Miner:
 
         # tell the user we are getting the version
         self.add_to_output("Getting version...")
+        try:
+            identity = await self.identity.get()
+        except APITimeoutError:
+            # we have no version, the connection timed out
+            self.add_to_output("Get version failed...", WARNING)
+            return False
+        except APIConnectionError:
+            # the API never came up, stock firmware that needs the install
+            self.add_to_output('Connection refused, attempting install...')
+            return "Antminer"
+        except (APIError, KeyError, IndexError):
+            self.add_to_output("Unknown error getting version, attempting install...", WARNING)
+            return "Antminer"
+        # tell the user the version of the miner
+        self.add_to_output(f'Version is {identity.version}...')
+        # TODO: change version checking to HIVEOS
+        return identity.version
+
+    async def _fetch_identity(self) -> Identity:
+        """
+        Ask the API for the version, backing off on a refused connection
+
+        Raises APIError (or one of its subclasses) if the API doesn't answer.
+        """
         retries = 0
         while True:
-            # open a connection to the [cgminer, bmminer, bosminer] API port (4028)
-            connection_fut = asyncio.open_connection(self.ip, 4028)
             try:
-                # get reader and writer streams from connection
-                reader, writer = await asyncio.wait_for(connection_fut, timeout=5)
-                # send the standard version command (JSON)
-                writer.write(b'{"command":"version"}')
-                # wait until command is finished sending
-                await writer.drain()
-                # read the returned data
-                data = await reader.read(4096)
-                # let the user know we recieved data
-                self.add_to_output("Recieved data...")
-                # close the writer
-                writer.close()
-                # make sure the writer is fully closed
-                await writer.wait_closed()
-                # load the returned data (JSON), and remove the null byte at the end
-                data_dict = json.loads(data[:-1].decode('utf-8'))
-                # tell the user the version of the miner
-                self.add_to_output(f'Version is {data_dict["VERSION"][0][list(data_dict["VERSION"][0].keys())[1]]}...')
-                # TODO: change version checking to HIVEOS
-                if "BOSminer+" in data_dict["VERSION"][0].keys() or "BOSminer" in data_dict["VERSION"][0].keys():
-                    print("HIVE")
-
-            except asyncio.exceptions.TimeoutError:
-                # we have no version, the connection timed out
-                self.add_to_output("Get version failed...")
-                return False
-            except ConnectionRefusedError:
-                # add to retry times
-                retries += 1
-                # connection was refused, tell the user
-                self.add_to_output("Connection refused, retrying...")
+                # send the standard version command to the [cgminer, bmminer, bosminer] API (JSON)
+                reply = await self.send_api_cmd("version")
+                break
+            except APIConnectionError:
                 # make sure it doesnt get stuck here
+                retries += 1
                 if retries > 3:
-                    self.add_to_output('Connection refused, attempting install...')
-                    return "Antminer"
-                await asyncio.sleep(3)
-            except:
-                self.add_to_output("Unknown error getting version, attempting install...")
-                return "Antminer"
-
-    async def send_api_cmd(self, command: str) -> dict or None:
-        """Send a command to the API of the miner"""
-        try:
-            # open reader and writer streams to the api
-            reader, writer = await asyncio.open_connection(self.ip, self.api_port)
-
-            # write the command
-            api_command = json.dumps({"command": command}).encode('utf-8')
-
-            # send the command
-            writer.write(api_command)
-            await writer.drain()
-
-            data = b""
-
-            # loop to receive all the data
-            while True:
-                d = await reader.read(4096)
-                if not d:
-                    break
-                data += d
+                    raise
+                # connection was refused, tell the user
+                self.add_to_output("Connection refused, retrying...", WARNING)
+                await asyncio.sleep(2 ** (retries - 1))
+        # the connection we just made put the miner in the ARP cache
+        return Identity.from_version(reply, await lookup_mac(self.ip))
 
-            # load the data into a dict
-            data = json.loads(data.decode('utf-8')[:-1])
+    def _identity_changed(self, identity: Identity or None) -> None:
+        """Send the new identity with the data, so clients see what each miner is"""
+        data = identity.to_dict() if identity is not None else None
+        self.messages["Identity"] = data
+        if self.stats is not None:
+            self.stats["Identity"] = data
 
-            # close the connection
-            writer.close()
-            await writer.wait_closed()
+    async def send_api_cmd(self, command: str) -> dict:
+        """
+        Send a command to the API of the miner
 
-            # return the data
-            return data
-        except:
-            # if an error happens, return none
-            return None
+        Raises APIError (or one of its subclasses) if the command fails
+        """
+        with API_COMMAND_SECONDS.time():
+            return await self.api.send_command(command)
 
     async def pause(self) -> None:
-        """Pause the miner"""
+        """Pause the miner, stopping the installer if it is running"""
         self.add_to_output("Pausing...")
         self.running.clear()
+        self.update_controls()
+        for job in list(self.jobs):
+            self.add_to_output("Stopping the installer, it will start over when unpaused...", WARNING)
+            job.cancel()
 
     async def unpause(self) -> None:
         """Unpause the miner"""
         self.add_to_output("Unpausing...")
         self.running.set()
+        self.update_controls()
 
-    async def light(self) -> None:
-        """Turn on the fault light"""
-        self.lit = True
+    async def light(self) -> bool:
+        """Turn on the fault light, returns False if the miner didn't take the command"""
         # TODO: find light function for HIVEOS
-        # await self.run_command("miner fault_light on")
-        print("light " + self.ip)
+        if await self.run_command("miner fault_light on", wait_if_paused=False) is None:
+            return False
+        self.lit = True
+        self.update_controls()
+        return True
 
-    async def unlight(self) -> None:
-        """Turn off the fault light"""
+    async def unlight(self) -> bool:
+        """Turn off the fault light, returns False if the miner didn't take the command"""
+        if await self.run_command("miner fault_light off", wait_if_paused=False) is None:
+            return False
         self.lit = False
-        # TODO: find light function for HIVEOS
-        # await self.run_command("miner fault_light off")
-        print("unlight" + self.ip)
-
-    def add_to_output(self, message: str) -> None:
-        text = message + "\n" + self.messages["text"]
-        self.messages["text"] = text
-
-    async def get_connection(self, username: str, password: str) -> asyncssh.connect:
-        """Create a new asyncssh connection"""
-        conn = await asyncssh.connect(self.ip, known_hosts=None, username=username, password=password,
-                                      server_host_key_algs=['ssh-rsa'])
-        # return created connection
-        return conn
-
-    async def run_command(self, cmd: str) -> None:
-        """Run a command on the miner"""
+        self.update_controls()
+        return True
+
+    async def reboot(self) -> bool:
+        """Reboot the miner, returns False if the miner didn't take the command"""
+        self.add_to_output("Rebooting...")
+        if await self.run_command("reboot", wait_if_paused=False) is None:
+            return False
+        self.identity.invalidate()
+        # the connection goes down with the miner, and the fault light with it
+        await self.ssh_pool.invalidate(self.ip)
+        self.lit = False
+        self.update_controls()
+        return True
+
+    def set_ports(self, api_port: int, http_port: int, ssh_port: int) -> None:
+        """Move the miner to other ports, reconnecting to the ones that changed"""
+        if api_port != self.api_port:
+            old = self.api
+            self.api_port = api_port
+            self.api = MinerAPI(self.ip, api_port, old.connect_timeout, old.timeout)
+            asyncio.ensure_future(old.close())
+        if ssh_port != self.ssh_port:
+            self.ssh_port = ssh_port
+            asyncio.ensure_future(self.ssh_pool.invalidate(self.ip))
+        self.http_port = http_port
+
+    def control_state(self) -> dict:
+        """Pause, light and install state, sent along with the data so clients don't have to ask for it"""
+        return {"Paused": not self.running.is_set(), "Lit": self.lit, "State": self.main_state}
+
+    def update_controls(self) -> None:
+        """Put the current pause, light and install state into the data the webserver sends"""
+        controls = self.control_state()
+        self.messages.update(controls)
+        if self.stats is not None:
+            self.stats.update(controls)
+
+    async def close(self) -> None:
+        """Close any open connections to the miner"""
+        await self.api.close()
+        await self.ssh_pool.invalidate(self.ip)
+
+    def add_to_output(self, message: str, level: str = INFO) -> None:
+        """Add a message to the install log"""
+        entry = self.log.add(message, level, self.main_state)
+        self.messages["log_seq"] = entry.seq
+
+    @asynccontextmanager
+    async def get_connection(self, username: str, password: str):
+        """
+        Borrow the pooled asyncssh connection to the miner
+
+        Use as `async with self.get_connection(username, password) as conn:`
+        """
+        start = time.perf_counter()
+        async with self.ssh_pool.connection(self.ip, username, password, self.ssh_port) as conn:
+            SSH_CONNECT_SECONDS.observe(time.perf_counter() - start)
+            yield conn
+
+    async def run_command(self, cmd: str, wait_if_paused: bool = True):
+        """
+        Run a command on the miner
+
+        Returns the completed process, or None if the command couldn't be run.
+        Control commands like the fault light pass wait_if_paused=False so
+        they still work on a paused miner.
+        """
         # pause logic
-        if not self.running.is_set():
-            self.add_to_output("Paused...")
-        await self.running.wait()
+        if wait_if_paused:
+            if not self.running.is_set():
+                self.add_to_output("Paused...")
+            await self.running.wait()
         result = None
-        # get/create ssh connection to miner
-        conn = await self.get_connection("root", "admin")
         # send the command and store the result
-        for i in range(3):
+        for attempt in range(COMMAND_ATTEMPTS):
             try:
-                result = await conn.run(cmd)
-            except:
-                if i == 3:
-                    self.add_to_output(f"Unknown error when running the command {cmd}...")
-                    return
-                pass
+                # get/create ssh connection to miner
+                async with self.get_connection(self.settings.username, self.settings.password) as conn:
+                    with SSH_COMMAND_SECONDS.time():
+                        result = await conn.run(cmd)
+                break
+            except (OSError, asyncssh.Error, asyncio.TimeoutError) as e:
+                if attempt + 1 == COMMAND_ATTEMPTS:
+                    self.add_to_output(f"Error when running the command {cmd}: {str(e) or type(e).__name__}...",
+                                       ERROR)
+                    return None
         # let the user know the result of the command
         if result is not None:
             if result.stdout != "":
                 self.add_to_output(result.stdout)
                 if result.stderr != "":
-                    self.add_to_output("ERROR: " + result.stderr)
+                    self.add_to_output("ERROR: " + result.stderr, ERROR)
             elif result.stderr != "":
-                self.add_to_output("ERROR: " + result.stderr)
+                self.add_to_output("ERROR: " + result.stderr, ERROR)
             else:
                 self.add_to_output(cmd)
+        return result
+
+    async def stream_command(self, cmd: str, on_line=None, timeout: float = COMMAND_TIMEOUT) -> dict:
+        """
+        Run a command on the miner, putting each line in the log as it is printed
+
+        on_line(ip, stream, line) is called with every line as well. Runs
+        on paused miners, it is for diagnostics. Returns {"exit_status",
+        "stdout", "stderr", "error", "seconds", "timed_out"}, with whatever
+        was printed before a timeout or error, up to MAX_OUTPUT of each.
+        """
+        result = {"exit_status": None, "stdout": "", "stderr": "", "error": None, "seconds": 0.0,
+                  "timed_out": False}
+        output = {"stdout": [], "stderr": []}
+        kept = {"stdout": 0, "stderr": 0}
+
+        async def read(reader, stream: str) -> None:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                line = line.rstrip("\r\n")
+                self.add_to_output(line, WARNING if stream == "stderr" else INFO)
+                if on_line is not None:
+                    on_line(self.ip, stream, line)
+                if kept[stream] < MAX_OUTPUT:
+                    output[stream].append(line[:MAX_OUTPUT - kept[stream]])
+                    kept[stream] += len(line) + 1
+
+        async def run() -> None:
+            async with self.get_connection(self.settings.username, self.settings.password) as conn:
+                # a binary or badly encoded byte in the output shouldn't end the read with a UnicodeDecodeError
+                async with conn.create_process(cmd, encoding="utf-8", errors="replace") as process:
+                    await asyncio.gather(read(process.stdout, "stdout"), read(process.stderr, "stderr"))
+                    result["exit_status"] = (await process.wait()).exit_status
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(run(), timeout)
+        except asyncio.TimeoutError:
+            result["timed_out"] = True
+            result["error"] = f"timed out after {timeout:g}s"
+        except (OSError, asyncssh.Error) as e:
+            result["error"] = str(e) or type(e).__name__
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        SSH_COMMAND_SECONDS.observe(result["seconds"])
+        if result["error"] is not None:
+            self.add_to_output(f"Command {cmd} failed: {result['error']}", ERROR)
+        result["stdout"] = "\n".join(output["stdout"])
+        result["stderr"] = "\n".join(output["stderr"])
+        return result
+
+    async def get_stats(self) -> MinerStats:
+        """
+        Get hashrate, temps and fans in one API call, parsed straight from the reply bytes
+
+        Raises APIError (or one of its subclasses) if the command fails
+        """
+        with API_COMMAND_SECONDS.time():
+            raw = await self.api.send_raw("devs+temps+fans")
+        return parse_stats(raw)
 
     async def get_api_data(self) -> dict:
         # This is only needed for the firmware after install
         """Get and parse API data for the client"""
         if not self.firmware.is_set():
-            self.lit = False
+            self.polled_ok = False
+            self.update_controls()
             return self.messages
         try:
-            # get all data and split it up
-            all_data = await self.send_api_cmd("devs+temps+fans")
-            devs_raw = all_data['devs'][0]
-            # TODO: find BMMiner command to get temps and fan data -> ONLY FOR HIVE OS, dont need standard
-            # temps_raw = all_data['temps'][0]
-            # fans_raw = all_data['fans'][0]
-
-            # parse temperature data
-            # temps_data = {}
-            # for board in range(len(temps_raw['TEMPS'])):
-            #     temps_data[f"board_{temps_raw['TEMPS'][board]['ID']}"] = {}
-            #     temps_data[f"board_{temps_raw['TEMPS'][board]['ID']}"]["Board"] = temps_raw['TEMPS'][board]['Board']
-            #     temps_data[f"board_{temps_raw['TEMPS'][board]['ID']}"]["Chip"] = temps_raw['TEMPS'][board]['Chip']
-
-            # parse individual board and chip temperature data
-            # for board in temps_data.keys():
-            #     if "Board" not in temps_data[board].keys():
-            #         temps_data[board]["Board"] = 0
-            #     if "Chip" not in temps_data[board].keys():
-            #         temps_data[board]["Chip"] = 0
-
-            # TODO: make sure MHS works, if not add GHS
-            # parse hashrate data
-            hr_data = {}
-            for board in range(len(devs_raw['DEVS'])):
-                hr_data[f"board_{devs_raw['DEVS'][board]['ID']}"] = {}
-                hr_data[f"board_{devs_raw['DEVS'][board]['ID']}"]["HR"] = round(
-                    devs_raw['DEVS'][board]['MHS 5s'] / 1000000,
-                    2)
-
-            # parse fan data
-            # fans_data = {}
-            # for fan in range(len(fans_raw['FANS'])):
-            #     fans_data[f"fan_{fans_raw['FANS'][fan]['ID']}"] = {}
-            #     fans_data[f"fan_{fans_raw['FANS'][fan]['ID']}"]['RPM'] = fans_raw['FANS'][fan]['RPM']
-
-            # set the miner data
-            miner_data = {'IP': self.ip, "Light": "show"}
-            # , 'Fans': fans_data, 'HR': hr_data, 'Temps': temps_data}
-
-            # save stats for later
-            self.stats = miner_data
-
-            # return stats
-            return miner_data
-        except:
+            stats = await self.get_stats()
+        except APIError:
             # if it fails, return install data
-            # usually fails on getting None from API
-            self.lit = False
+            # usually fails on the API being down
+            self.polled_ok = False
+            self.update_controls()
             data = self.messages
             data['Light'] = "show"
             return data
 
+        # keep the samples for the history graphs
+        if self.history is not None:
+            self.history.record(self.ip, stats.metrics(), time.time())
+
+        # set the miner data
+        miner_data = {'IP': self.ip, "Light": "show", **self.control_state(), "Identity": self.messages["Identity"],
+                      **stats.payload()}
+
+        # save stats for later
+        self.stats = miner_data
+        self.polled_ok = True
+
+        # return stats
+        return miner_data
+
     async def send_dir(self, l_dir: str, r_dest: str) -> None:
         """
         Send a directory to a miner
@@ -332,9 +537,9 @@ class Miner:
         # tell the user we are sending a directory to the miner
         self.add_to_output(f"Sending directory to {self.ip}...")
         # get/create ssh connection to miner
-        conn = await self.get_connection("root", "admin")
-        # send the file
-        await asyncssh.scp(l_dir, (conn, r_dest), preserve=True, recurse=True)
+        async with self.get_connection(self.settings.username, self.settings.password) as conn:
+            # send the file
+            await asyncssh.scp(l_dir, (conn, r_dest), preserve=True, recurse=True)
         # tell the user the directory was sent to the miner
         self.add_to_output(f"Directory sent...")
 
@@ -348,9 +553,9 @@ class Miner:
         await self.running.wait()
 
         # get/create ssh connection to miner
-        conn = await self.get_connection("root", "admin")
-        # send file over scp
-        await asyncssh.scp(l_file, (conn, r_dest))
+        async with self.get_connection(self.settings.username, self.settings.password) as conn:
+            # send file over scp
+            await asyncssh.scp(l_file, (conn, r_dest))
         self.add_to_output(f"File sent...")
 
     async def get_file(self, r_file: str, l_dest: str) -> None:
@@ -364,13 +569,25 @@ class Miner:
 
         # tell the user we are copying a file from the miner
         self.add_to_output(f"Copying file from {self.ip}...")
-        # create ssh connection to miner
-        conn = await self.get_connection("root", "admin")
-        # get the file
-        await asyncssh.scp((conn, r_file), l_dest)
+        # get/create ssh connection to miner
+        async with self.get_connection(self.settings.username, self.settings.password) as conn:
+            # get the file
+            await asyncssh.scp((conn, r_file), l_dest)
         # tell the user we copied the file from the miner
         self.add_to_output(f"File copied...")
 
+    def _process_output(self, line: str, stream: str) -> None:
+        """Put a line printed by the installer into the log as it comes in"""
+        self.add_to_output(line, WARNING if stream == "stderr" else INFO)
+
+    async def run_process(self, args: list[str], timeout: float) -> ProcessResult:
+        """
+        Run a program like the installer for this miner, streaming its output into the log
+
+        Raises JobTimeout if it runs too long and JobCancelled if the miner is paused.
+        """
+        return await self.process_pool.run(args, on_line=self._process_output, timeout=timeout, jobs=self.jobs)
+
     async def ssh_unlock(self) -> bool:
         """
         Unlock the SSH of a miner
@@ -381,17 +598,12 @@ class Miner:
         await self.running.wait()
 
         # have to outsource this to another program
-        proc = await asyncio.create_subprocess_shell(
-            f'{os.path.join(os.getcwd(), "files", "asicseer_installer.exe")} -p -f {self.ip} root',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-        # get stdout of the unlock
-        stdout, stderr = await proc.communicate()
+        result = await self.run_process([INSTALLER, "-p", "-f", self.ip, "root"],
+                                        timeout=self.settings.unlock_timeout)
         # check if the webUI password needs to be reset
-        print(stderr)
-        if str(stdout).find("webUI") != -1:
+        if "webUI" in result.stdout:
             # tell the user to reset the webUI password
-            self.add_to_output("SSH unlock failed, please reset miner with reset button...")
+            self.add_to_output("SSH unlock failed, please reset miner with reset button...", ERROR)
             # ssh unlock failed
             return False
         else:
@@ -417,130 +629,265 @@ class Miner:
             print(0)
             # TODO: add possible alternate hive update process
         except OSError:
-            self.add_to_output(f"Unknown error...")
+            self.add_to_output(f"Unknown error...", ERROR)
 
     async def install(self) -> None:
         """
         Run the braiinsOS installation process on the miner
         """
         self.add_to_output("Starting install, please wait...")
-        # outsource installer process
+        # outsource installer process, its output goes into the log as it runs
         # TODO: move to asicseer web install process?
-        global fw_file
-        proc = await asyncio.create_subprocess_shell(
-            f'{os.path.join(os.getcwd(), "files", "asicseer_installer.exe")} -t 3 -u {fw_file} {self.ip} root',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-        # get stdout of the install
-        stdout, stderr = await proc.communicate()
+        firmware = self.settings.firmware
+        if firmware is None:
+            self.add_to_output("No firmware tarball configured or found in ./files...", ERROR)
+            raise RuntimeError("no firmware tarball configured or found in ./files")
+        result = await self.run_process([INSTALLER, "-t", "3", "-u", firmware, self.ip, "root"],
+                                        timeout=self.settings.install_timeout)
+        if result.returncode != 0:
+            self.add_to_output(f"Installer failed with exit code {result.returncode}...", ERROR)
+            raise RuntimeError(f"installer exited with {result.returncode} on {self.ip}")
         self.add_to_output("Rebooting...")
-        await asyncio.sleep(10)
-        while not await self.ping_http():
-            await asyncio.sleep(3)
-        await asyncio.sleep(5)
-        while not await self.ping_http():
-            await asyncio.sleep(3)
-        await asyncio.sleep(5)
+        # the old SSH connection does not survive the reboot
+        await self.ssh_pool.invalidate(self.ip)
+        await self.wait_for_boot()
         self.add_to_output("Install complete...")
 
+    async def run_install(self) -> None:
+        """
+        Install when the orchestrator gives this miner a slot, then push the config and referral
+        """
+        if self.installer is None:
+            await self.install()
+            return
+        if self.settings.firmware is None:
+            # a config error, not a failed install, so it stays out of the rollout's failure budget
+            raise RuntimeError("no firmware tarball configured or found in ./files")
+        async with self.installer.slot(self):
+            await self.install()
+            await self.installer.installed(self)
+
+    async def state_start(self) -> str:
+        """
+        Wait for the miner to come up and decide what it needs
+        """
+        # Check for http
+        if not await self.ping_http():
+            # if no http or ssh are present, the miner is off or not ready
+            self.add_to_output("Down...")
+            await wait_until(self.ping_http, initial=1, maximum=5)
+        # check for ssh if http works
+        if not await self.ping_ssh():
+            # miner is on but has no ssh, needs to be unlocked
+            self.add_to_output('SSH Disconnected...')
+            return "unlock"
+        # if both ssh and http are up, the miner is on and unlocked
+        self.add_to_output('SSH Connected...')
+        # skip the install if this exact firmware is already on the miner
+        if self.installer is not None and await self.installer.has_firmware(self):
+            self.add_to_output('Firmware already installed, skipping install...')
+            return "done"
+        # check if BraiinsOS is already on the miner
+        if await self.get_version() == "Hive":
+            self.add_to_output('HiveOS is already installed!')
+            # skip install, update HiveOS
+            return "update"
+        # if BraiinsOS is not installed but ssh is up, move on to installing it over ssh
+        await self.wait_for_firmware()
+        return "install"
+
+    async def wait_for_firmware(self) -> None:
+        """
+        Wait for a firmware tarball to be configured, before the miner queues for an install slot
+        """
+        if self.settings.firmware is not None:
+            return
+        self.add_to_output("No firmware tarball configured or found in ./files, waiting for one...", ERROR)
+
+        async def configured() -> bool:
+            return self.settings.firmware is not None
+
+        # the settings are replaced when the config is reloaded
+        await wait_until(configured, initial=1, maximum=10)
+
+    async def state_unlock(self) -> str:
+        """
+        Unlock SSH so the install can run
+        """
+        self.add_to_output('Unlocking...')
+        # ssh_unlock returns True when unlock works
+        if await self.ssh_unlock():
+            # without a firmware to install, start waits for one
+            return "install" if self.settings.firmware is not None else "start"
+        # if ssh unlock fails, it needs to be reset, ssh_unlock will tell the user that
+        return "reset"
+
+    async def state_reset(self) -> str:
+        """
+        Wait for the user to reset and unplug the miner, then start over
+        """
+        await self.wait_for_disconnect()
+        return "start"
+
+    async def state_install(self) -> str:
+        """
+        Install the firmware
+        """
+        # let the user know we are starting install
+        self.add_to_output('Starting install...')
+        self.install_outcome = None
+        # give SSH a moment to settle after an unlock instead of sleeping a fixed time
+        if not await wait_until(self.ping_ssh, timeout=60):
+            self.add_to_output("SSH didn't come up, starting over...", WARNING)
+            return "start"
+        try:
+            await self.run_install()
+        except asyncio.exceptions.IncompleteReadError:
+            print("Incomplete Read")
+            self.add_to_output("Incomplete Read Error, waiting for install to complete.", WARNING)
+            # the install carries on without us, wait for the miner to finish rebooting
+            await self.wait_for_boot()
+        return "done"
+
+    async def state_update(self) -> str:
+        """
+        Update firmware that is already installed
+        """
+        await self.update()
+        return "done"
+
+    async def state_done(self) -> str:
+        """
+        Monitor the miner until it is unplugged
+        """
+        if self.revalidate:
+            self.revalidate = False
+            if not await self.still_installed():
+                self.add_to_output("Not the miner that was installed before the restart, starting over...",
+                                   WARNING)
+                return "start"
+        self.firmware.set()
+        # wait for the user to disconnect the miner
+        await self.wait_for_disconnect()
+        self.firmware.clear()
+        if "Light" in self.messages.keys():
+            del self.messages["Light"]
+        return "start"
+
+    async def still_installed(self) -> bool:
+        """
+        Whether a miner resumed as installed after a restart still is
+
+        With a firmware configured the marker it leaves on the miner is
+        checked, otherwise the identity is fetched again (after the MAC
+        address check) and compared to the one saved. A miner that can't
+        be asked isn't trusted.
+        """
+        try:
+            if self.installer is not None and self.installer.firmware is not None:
+                return await self.installer.has_firmware(self)
+            saved = self.identity.identity
+            current = await self.identity.get()
+        except (OSError, asyncssh.Error, asyncio.TimeoutError, APIError):
+            return False
+        return saved is not None and current.mac == saved.mac and current.firmware == saved.firmware
+
+    def state_failed(self, state: str, error: Exception) -> None:
+        """
+        Log a state that raised or timed out, the machine goes back to start
+        """
+        if isinstance(error, asyncio.TimeoutError):
+            self.add_to_output(f"Timed out in {state}, starting over...", ERROR)
+        else:
+            print(error)
+            self.add_to_output(f"Error in {state}: {error}, starting over...", ERROR)
+        self.firmware.clear()
 
     async def main_loop(self):
         """
         Main run loop for the testing process of the miner
         """
-        # start the main loop
-        while True:
-            await asyncio.sleep(3)
-            # check state
-            if self.main_state == "start":
-                # Check for http
-                if await self.ping_http():
-                    # check for ssh if http works
-                    if await self.ping_ssh():
-                        # if both ssh and http are up, the miner is on and unlocked
-                        self.add_to_output('SSH Connected...')
-                        # check if BraiinsOS is already on the miner
-                        if (version := await self.get_version()) == "Hive":
-                            self.add_to_output('HiveOS is already installed!')
-                            # set state to update HiveOS, skip install
-                            self.main_state = "update"
-                            # restart the while loop just to be safe
-                            continue
-                        else:
-                            # if BraiinsOS is not installed but ssh is up, move on to installing it over ssh
-                            await asyncio.sleep(5)
-                            self.main_state = "install"
-                    else:
-                        # miner is on but has no ssh, needs to be unlocked
-                        self.add_to_output('SSH Disconnected...')
-                        self.add_to_output('Unlocking...')
-                        # do the unlock
-                        if await self.ssh_unlock():
-                            # set state to install now that ssh works, ssh_unlock returns True when unlock works
-                            self.main_state = "install"
-                            # pause for a second to bypass bugs
-                            await asyncio.sleep(5)
-                            # restart the while loop just to be safe
-                            continue
-                        else:
-                            # if ssh unlock fails, it needs to be reset, ssh_unlock will tell the user that and
-                            # return false, so wait for disconnect
-                            await self.wait_for_disconnect()
-                            # set state to start to retry after reset
-                            self.main_state = "start"
-                            # restart the while loop just to be safe
-                            continue
-                else:
-                    # if no http or ssh are present, the miner is off or not ready
-                    self.add_to_output("Down...")
-            # check state
-            if self.main_state == "install":
-                # let the user know we are starting install
-                self.add_to_output('Starting install...')
-                # start install
-                try:
-                    await self.install()
-                    self.main_state = "done"
-                except asyncio.exceptions.IncompleteReadError:
-                    print("Incomplete Read")
-                    self.add_to_output("Incomplete Read Error, waiting 60 seconds for install to complete.")
-                    await asyncio.sleep(70)
-                    self.main_state = "done"
-                except Exception as e:
-                    print(e)
-                    self.main_state = "start"
-                    continue
-            # check state
-            if self.main_state == "update":
-                # start update
-                await self.update()
-                # after update completes, move to sending referral
-                await asyncio.sleep(20)
-            # check state
-            if self.main_state == "done":
-                # wait for the user to disconnect the miner
-                self.firmware.set()
-                await self.wait_for_disconnect()
-                # set state to start and restart the process
-                self.firmware.clear()
-                if "Light" in self.messages.keys():
-                    del self.messages["Light"]
-                self.main_state = "start"
-                # restart main loop
-                continue
+        await self.state_machine.run({
+            "start": self.state_start,
+            "unlock": self.state_unlock,
+            "reset": self.state_reset,
+            "install": self.state_install,
+            "update": self.state_update,
+            "done": self.state_done,
+        }, on_error=self.state_failed)
 
 
 class MinerList:
-    def __init__(self, *items: Miner):
+    def __init__(self, *items: Miner, ssh_pool: SSHPool = None, history: TimeSeriesStore = None,
+                 installer: InstallOrchestrator = None, tags: dict = None, process_pool: ProcessPool = None,
+                 settings: MinerSettings = None, ports: dict = None, warmup: TokenBucket = None):
         self.miners = {}
-        for item in items:
-            self.miners[item.ip] = item
+        # login, firmware and timeouts of every miner in the list
+        self.settings = settings if settings is not None else MinerSettings()
+        # api_port, http_port and ssh_port of miners made by new_miner
+        self.ports = ports or {}
+        # SSH pool shared by every miner in the list, caps open sessions across the whole bench
+        self.ssh_pool = ssh_pool if ssh_pool is not None else default_pool
+        # runs the installer for every miner in the list, caps installer processes across the whole bench
+        self.process_pool = process_pool if process_pool is not None else default_process_pool
+        # history of hashrate, temps and fans for every miner, optional
+        self.history = history
+        # decides when each miner may install, optional
+        self.installer = installer
+        # paces how fast install loops start, None to start them all at once
+        self.warmup = warmup
+        # ip -> running main_loop task
+        self.tasks = {}
+        # set once install has been started, miners added after that start right away
+        self.installing = False
+        # callables run on every state transition of every miner
+        self.state_listeners = []
+        # tag -> networks whose miners get that tag, including miners discovered later
+        self.tag_rules = self._tag_rules(tags)
+        self.append(*items)
+
+    @staticmethod
+    def _tag_rules(tags: dict or None) -> dict:
+        return {tag: [ipaddress.ip_network(member, strict=False) for member in members]
+                for tag, members in (tags or {}).items()}
+
+    @staticmethod
+    def _matches(miner: Miner, networks: list) -> bool:
+        return any(ipaddress.ip_address(miner.ip) in network for network in networks)
+
+    def new_miner(self, ip: str) -> Miner:
+        """A miner on the ports of this list, not added to it yet"""
+        return Miner(ip, **self.ports)
+
+    def set_tag_rules(self, tags: dict) -> None:
+        """
+        Replace the tag rules, retagging the miners already in the list
+
+        Tags a rule gave a miner are taken off when the rule stops matching
+        it, tags added by hand with tag are left alone unless a rule of the
+        same name used to cover the miner.
+        """
+        rules = self._tag_rules(tags)
+        for miner in self.miners.values():
+            for tag, networks in self.tag_rules.items():
+                if self._matches(miner, networks) and not self._matches(miner, rules.get(tag, [])):
+                    miner.tags.discard(tag)
+            for tag, networks in rules.items():
+                if self._matches(miner, networks):
+                    miner.tags.add(tag)
+        self.tag_rules = rules
+
+    def apply_settings(self) -> None:
+        """Push the API timeouts of settings to every miner, after they were changed in place"""
+        for miner in self.miners.values():
+            miner.api.connect_timeout = self.settings.api_connect_timeout
+            miner.api.timeout = self.settings.api_timeout
 
     def basic_data(self) -> list[dict]:
         """Give fake data to be used initializing the client side before we can get data"""
         miner_data = []
-        for miner in self.miners:
-            miner_data.append({'IP': miner, "text": ""})
+        for ip, miner in self.miners.items():
+            miner_data.append({'IP': ip, "log_seq": 0, **miner.control_state(), "Identity": None})
         return miner_data
 
     async def pause(self, ip: str) -> None:
@@ -554,7 +901,7 @@ class MinerList:
         await miner.unpause()
 
     async def check_pause(self, ip: str) -> bool:
-        """Check if a miner is paused"""
+        """Check if a miner is paused, clients get this in the miner data as "Paused" now"""
         miner = self.miners[ip]
         return not miner.running.is_set()
 
@@ -569,27 +916,207 @@ class MinerList:
         await miner.unlight()
 
     async def check_light(self, ip: str) -> bool:
-        """Check if fault light is on for a miner"""
+        """Check if fault light is on for a miner, clients get this in the miner data as "Lit" now"""
         miner = self.miners[ip]
         return miner.lit
 
+    def select(self, selector: dict) -> list[Miner]:
+        """
+        Miners matching a selector
+
+        selector can have "ips" (a list), "cidr" (a network or list of them),
+        "state" (an install state or list of them) and "tags" (a list, a miner
+        needs any one of them). Miners have to match every key given, an empty
+        selector matches nothing so a typo can't hit the whole bench.
+        """
+        if not selector:
+            return []
+        miners = list(self.miners.values())
+        if "ips" in selector:
+            ips = set(selector["ips"])
+            miners = [miner for miner in miners if miner.ip in ips]
+        if "cidr" in selector:
+            cidrs = selector["cidr"] if isinstance(selector["cidr"], list) else [selector["cidr"]]
+            networks = [ipaddress.ip_network(cidr, strict=False) for cidr in cidrs]
+            miners = [miner for miner in miners
+                      if any(ipaddress.ip_address(miner.ip) in network for network in networks)]
+        if "state" in selector:
+            states = selector["state"] if isinstance(selector["state"], list) else [selector["state"]]
+            miners = [miner for miner in miners if miner.main_state in states]
+        if "tags" in selector:
+            tags = set(selector["tags"])
+            miners = [miner for miner in miners if miner.tags & tags]
+        return miners
+
+    def tag(self, selector: dict, *tags: str) -> list[str]:
+        """Add tags to the selected miners, returns their IPs"""
+        miners = self.select(selector)
+        for miner in miners:
+            miner.tags.update(tags)
+        return [miner.ip for miner in miners]
+
+    def untag(self, selector: dict, *tags: str) -> list[str]:
+        """Remove tags from the selected miners, returns their IPs"""
+        miners = self.select(selector)
+        for miner in miners:
+            miner.tags.difference_update(tags)
+        return [miner.ip for miner in miners]
+
+    async def batch(self, action: str, selector: dict, concurrency: int = BATCH_CONCURRENCY) -> dict:
+        """
+        Run one of BATCH_ACTIONS on every selected miner, a few at a time
+
+        Returns {"action", "ok": count, "failed": count, "results": {ip: {"ok", "error"}}}.
+        """
+        if action not in BATCH_ACTIONS:
+            raise ValueError(f"unknown batch action {action}")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(miner: Miner) -> dict:
+            async with semaphore:
+                try:
+                    # pause and unpause return None, the rest return False when the miner didn't take it
+                    if await getattr(miner, action)() is False:
+                        return {"ok": False, "error": "command failed"}
+                    return {"ok": True, "error": None}
+                except Exception as e:
+                    return {"ok": False, "error": str(e)}
+
+        miners = self.select(selector)
+        outcomes = await asyncio.gather(*[run(miner) for miner in miners])
+        results = {miner.ip: outcome for miner, outcome in zip(miners, outcomes)}
+        ok = sum(1 for outcome in outcomes if outcome["ok"])
+        return {"action": action, "ok": ok, "failed": len(outcomes) - ok, "results": results}
+
+    async def run_on(self, command: str, selector: dict, concurrency: int = COMMAND_CONCURRENCY,
+                     timeout: float = COMMAND_TIMEOUT, on_line=None) -> dict:
+        """
+        Run a shell command on every selected miner, a few at a time
+
+        Each miner gets timeout seconds, on_line(ip, stream, line) is called
+        with the output as it is printed. Returns ip -> the result of
+        Miner.stream_command.
+        """
+        if not command or not command.strip():
+            raise ValueError("command is empty")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(miner: Miner) -> dict:
+            async with semaphore:
+                return await miner.stream_command(command, on_line=on_line, timeout=timeout)
+
+        miners = self.select(selector)
+        outcomes = await asyncio.gather(*[run(miner) for miner in miners])
+        return {miner.ip: outcome for miner, outcome in zip(miners, outcomes)}
+
+    async def fan_out(self, command: str, selector: dict, concurrency: int = COMMAND_CONCURRENCY,
+                      timeout: float = COMMAND_TIMEOUT, on_line=None) -> dict:
+        """run_on, with the miners grouped by what they printed, see group_outputs"""
+        return group_outputs(command, await self.run_on(command, selector, concurrency, timeout, on_line))
+
     def append(self, *items: Miner) -> None:
         """Add a miner to MinerList"""
         for item in items:
+            item.ssh_pool = self.ssh_pool
+            item.process_pool = self.process_pool
+            item.history = self.history
+            item.installer = self.installer
+            item.settings = self.settings
+            item.api.connect_timeout = self.settings.api_connect_timeout
+            item.api.timeout = self.settings.api_timeout
+            for tag, networks in self.tag_rules.items():
+                if self._matches(item, networks):
+                    item.tags.add(tag)
+            if item.ip not in self.miners:
+                item.state_machine.subscribe(
+                    lambda old, new, elapsed, miner=item: self._state_changed(miner, old, new, elapsed))
             self.miners[item.ip] = item
+            if self.installing:
+                self.start(item.ip)
+
+    def subscribe(self, listener) -> None:
+        """Call listener(miner, old, new, elapsed) whenever any miner changes state"""
+        self.state_listeners.append(listener)
+
+    def _state_changed(self, miner: Miner, old: str, new: str, elapsed: float) -> None:
+        for listener in self.state_listeners:
+            listener(miner, old, new, elapsed)
+
+    def state_times(self) -> dict:
+        """Seconds each miner has spent in each state"""
+        return {ip: miner.state_machine.time_in_states() for ip, miner in self.miners.items()}
+
+    def remove(self, ip: str) -> None:
+        """Remove a miner from MinerList and stop its install loop"""
+        miner = self.miners.pop(ip, None)
+        task = self.tasks.pop(ip, None)
+        if task is not None:
+            task.cancel()
+        if miner is not None:
+            asyncio.ensure_future(miner.close())
+
+    def start(self, ip: str) -> None:
+        """Start the install loop for a miner if it isn't running"""
+        task = self.tasks.get(ip)
+        if task is None or task.done():
+            self.tasks[ip] = asyncio.create_task(self._run(self.miners[ip]))
+
+    async def _run(self, miner: Miner) -> None:
+        # wait for a warm-up token, so the first pings and SSH handshakes of a big bench are spread out
+        if self.warmup is not None:
+            await self.warmup.take()
+        await miner.main_loop()
+
+    def get_logs(self, since: dict, fmt: str = "entries") -> dict:
+        """
+        Get new log entries for several miners at once
+
+        since maps IP -> the last sequence number the client has, fmt is
+        "entries" for a list of entry dicts or "text" for rendered text.
+        """
+        logs = {}
+        for ip, seq in since.items():
+            miner = self.miners.get(ip)
+            if miner is None:
+                continue
+            seq = int(seq or 0)
+            if fmt == "text":
+                entries = miner.log.render(seq)
+            else:
+                entries = [entry.to_dict() for entry in miner.log.since(seq)]
+            logs[ip] = {"seq": miner.log.seq, "entries": entries}
+        return logs
 
     async def get_data(self) -> list[dict]:
         """Run loop to get data from all miners"""
         tasks = [self.miners[miner].get_api_data() for miner in self.miners]
-        results = await asyncio.gather(*tasks)
+        with POLL_CYCLE_SECONDS.time():
+            results = await asyncio.gather(*tasks)
         return results
 
     async def install(self) -> None:
-        """Run the install on all miners"""
-        tasks = [asyncio.create_task(self.miners[miner].main_loop()) for miner in self.miners]
-        await asyncio.gather(*tasks)
+        """Run the install on all miners, including ones added later"""
+        self.installing = True
+        for ip in self.miners:
+            self.start(ip)
+
+
+async def check_version(ip: str = None) -> None:
+    """Get the version of a miner, or of a simulated one if no IP is given"""
+    mock = None
+    if ip is None:
+        from simulator import MockMiner
+        mock = MockMiner(services=("api",))
+        await mock.start()
+        miner_ = Miner(mock.host, api_port=mock.api_port)
+    else:
+        miner_ = Miner(ip)
+    print(await miner_.get_version())
+    await miner_.close()
+    if mock is not None:
+        await mock.stop()
 
 
 if __name__ == '__main__':
-    miner_ = Miner("172.16.1.18")
-    asyncio.get_event_loop().run_until_complete(miner_.get_version())
\ No newline at end of file
+    import sys
+    asyncio.run(check_version(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,65 @@
+import time
+from collections import deque
+from itertools import islice
+
+# number of entries kept per miner, older ones fall off the end
+LOG_CAPACITY = 500
+
+# severities
+INFO = "info"
+WARNING = "warning"
+ERROR = "error"
+
+
+class LogEntry:
+    __slots__ = ("seq", "time", "level", "state", "message")
+
+    def __init__(self, seq: int, timestamp: float, level: str, state: str, message: str):
+        # sequence number, increases by one per entry for the life of the miner
+        self.seq = seq
+        # unix time the entry was added
+        self.time = timestamp
+        # INFO, WARNING or ERROR
+        self.level = level
+        # install state of the miner when the entry was added
+        self.state = state
+        self.message = message
+
+    def to_dict(self) -> dict:
+        return {"seq": self.seq, "time": self.time, "level": self.level, "state": self.state,
+                "message": self.message}
+
+    def render(self) -> str:
+        return f"{time.strftime('%H:%M:%S', time.localtime(self.time))} {self.message}"
+
+
+class MinerLog:
+    """
+    Fixed size log of what the installer did on one miner
+
+    Adding an entry is O(1) and memory stays bounded no matter how long a
+    miner sits on the bench. Text is only built when a client asks for it.
+    """
+    def __init__(self, capacity: int = LOG_CAPACITY):
+        self.entries = deque(maxlen=capacity)
+        # sequence number of the newest entry, 0 when empty
+        self.seq = 0
+
+    def add(self, message: str, level: str = INFO, state: str = None) -> LogEntry:
+        """Add an entry to the log"""
+        self.seq += 1
+        entry = LogEntry(self.seq, time.time(), level, state, message)
+        self.entries.append(entry)
+        return entry
+
+    def since(self, seq: int = 0) -> list[LogEntry]:
+        """Entries newer than seq, oldest first"""
+        if not self.entries or seq >= self.seq:
+            return []
+        # sequence numbers are contiguous, so the offset into the deque can be computed
+        start = max(0, seq - self.entries[0].seq + 1)
+        return list(islice(self.entries, start, None))
+
+    def render(self, since: int = 0) -> str:
+        """Entries newer than since as text, newest first like the dashboard shows them"""
+        return "\n".join(entry.render() for entry in reversed(self.since(since)))
@@ -0,0 +1,108 @@
+import json
+from dataclasses import dataclass
+
+from miner_api import APIResponseError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# hashrate keys of a DEVS entry in the order they are tried, with the factor that turns them into MH/s
+HASHRATE_KEYS = (("MHS 5s", 1.0), ("GHS 5s", 1000.0), ("MHS av", 1.0), ("GHS av", 1000.0))
+
+
+@dataclass
+class BoardStats:
+    """Hashrate and temperatures of one hashboard"""
+    __slots__ = ("id", "mhs", "board_temp", "chip_temp")
+    id: int
+    # hashrate in MH/s, whatever unit the firmware reported it in
+    mhs: float
+    board_temp: float
+    chip_temp: float
+
+
+@dataclass
+class MinerStats:
+    """One poll of devs+temps+fans, boards sorted by ID and fan ID -> RPM"""
+    __slots__ = ("boards", "fans")
+    boards: list
+    fans: dict
+
+    def payload(self) -> dict:
+        """HR (TH/s), Temps and Fans in the shape the dashboard draws"""
+        hr = {}
+        temps = {}
+        for board in self.boards:
+            key = f"board_{board.id}"
+            hr[key] = {"HR": round(board.mhs / 1000000, 2)}
+            temps[key] = {"Board": board.board_temp, "Chip": board.chip_temp}
+        fans = {f"fan_{fan}": {"RPM": rpm} for fan, rpm in self.fans.items()}
+        return {"HR": hr, "Temps": temps, "Fans": fans}
+
+    def metrics(self) -> dict:
+        """Samples for the history store"""
+        samples = {}
+        for board in self.boards:
+            samples[f"hr.board_{board.id}"] = round(board.mhs / 1000000, 2)
+            samples[f"temp.board_{board.id}"] = board.board_temp
+            samples[f"chip_temp.board_{board.id}"] = board.chip_temp
+        for fan, rpm in self.fans.items():
+            samples[f"fan.fan_{fan}"] = rpm
+        return samples
+
+
+def loads(raw: bytes):
+    """Decode a reply straight from the bytes read off the socket"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _section(reply: dict, command: str, key: str) -> list:
+    """Entries of one command of a multi-command reply, empty if the firmware doesn't support it"""
+    sections = reply.get(command)
+    if not sections:
+        return []
+    section = sections[0]
+    status = section.get("STATUS")
+    if status and status[0].get("STATUS") == "E":
+        return []
+    return section.get(key) or []
+
+
+def _hashrate(dev: dict) -> float:
+    for key, factor in HASHRATE_KEYS:
+        value = dev.get(key)
+        if value is not None:
+            return float(value) * factor
+    return 0.0
+
+
+def parse_stats(raw: bytes) -> MinerStats:
+    """
+    Parse the raw reply to devs+temps+fans
+
+    Raises APIResponseError if it isn't JSON or has no devs. Temps and fans
+    are optional, stock firmware doesn't have those commands.
+    """
+    try:
+        reply = loads(raw)
+        devs = reply["devs"][0]
+        status = devs.get("STATUS")
+        if status and status[0].get("STATUS") == "E":
+            raise APIResponseError(status[0].get("Msg", "devs failed"))
+        # board id -> [mhs, board temp, chip temp]
+        boards = {int(dev["ID"]): [_hashrate(dev), 0.0, 0.0] for dev in devs.get("DEVS") or []}
+        for temp in _section(reply, "temps", "TEMPS"):
+            board = boards.get(int(temp["ID"]))
+            if board is not None:
+                board[1] = float(temp.get("Board") or 0)
+                board[2] = float(temp.get("Chip") or 0)
+        fans = {int(fan["ID"]): int(fan.get("RPM") or 0) for fan in _section(reply, "fans", "FANS")}
+    except APIResponseError:
+        raise
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise APIResponseError(f"unexpected devs+temps+fans reply: {e!r}") from e
+    return MinerStats([BoardStats(id_, *values) for id_, values in sorted(boards.items())], fans)
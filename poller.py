@@ -0,0 +1,109 @@
+import asyncio
+import random
+
+from miner_data import Miner, MinerList
+from metrics import POLL_SECONDS
+
+# seconds between polls of a miner that is installing or just failed a poll
+FAST_INTERVAL = 2
+# seconds between polls of a miner waiting to be installed
+NORMAL_INTERVAL = 5
+# seconds between polls of a miner that is done and answering its API
+SLOW_INTERVAL = 15
+# longest wait between polls of a miner whose API keeps failing
+MAX_BACKOFF = 60
+# fraction of the interval added or removed at random so polls don't line up
+JITTER = 0.2
+# seconds a single poll may take before it counts as failed
+POLL_TIMEOUT = 20
+# seconds between checks for miners added to or removed from the list
+SYNC_INTERVAL = 1
+
+
+class PollScheduler:
+    """
+    Polls every miner on its own timer instead of one gather over the fleet
+
+    Each miner has its own task, so a slow or dead miner only delays itself.
+    Results are handed to on_result as soon as each poll finishes, and
+    on_remove is called when a miner leaves the list.
+    """
+    def __init__(self, miner_list: MinerList, on_result, on_remove=None):
+        self.miner_list = miner_list
+        self.on_result = on_result
+        self.on_remove = on_remove
+        # ip -> poll task
+        self.tasks = {}
+        # ip -> polls in a row that failed
+        self.failures = {}
+        # seconds between polls and the poll timeout, changed when the config is reloaded
+        self.fast_interval = FAST_INTERVAL
+        self.normal_interval = NORMAL_INTERVAL
+        self.slow_interval = SLOW_INTERVAL
+        self.max_backoff = MAX_BACKOFF
+        self.timeout = POLL_TIMEOUT
+        self._sync_task = None
+
+    def start(self) -> None:
+        """Start polling, miners added to the list later are picked up automatically"""
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    def stop(self) -> None:
+        """Stop all polling"""
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+
+    def interval(self, miner: Miner) -> float:
+        """How long to wait before polling a miner again"""
+        failures = self.failures.get(miner.ip, 0)
+        if miner.main_state in ("install", "update"):
+            # the install log is changing, keep it fresh
+            interval = self.fast_interval
+        elif not miner.firmware.is_set():
+            # waiting for the miner to be plugged in or installed, nothing to query
+            interval = self.normal_interval
+        elif failures:
+            # the API stopped answering, back off exponentially
+            interval = min(self.max_backoff, self.fast_interval * 2 ** (failures - 1))
+        else:
+            interval = self.slow_interval
+        return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def sync(self) -> None:
+        """Start tasks for new miners and stop them for removed ones"""
+        for ip, miner in self.miner_list.miners.items():
+            task = self.tasks.get(ip)
+            if task is None or task.done():
+                self.tasks[ip] = asyncio.create_task(self._poll_loop(miner))
+        for ip in [ip for ip in self.tasks if ip not in self.miner_list.miners]:
+            self.tasks.pop(ip).cancel()
+            self.failures.pop(ip, None)
+            if self.on_remove is not None:
+                self.on_remove(ip)
+
+    async def _sync_loop(self) -> None:
+        while True:
+            self.sync()
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    async def _poll_loop(self, miner: Miner) -> None:
+        # spread the first polls out so a big bench doesn't poll all at once
+        await asyncio.sleep(random.uniform(0, self.normal_interval))
+        while True:
+            try:
+                with POLL_SECONDS.time():
+                    data = await asyncio.wait_for(miner.get_api_data(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                data = None
+            if data is not None and miner.polled_ok:
+                self.failures[miner.ip] = 0
+            elif miner.firmware.is_set():
+                self.failures[miner.ip] = self.failures.get(miner.ip, 0) + 1
+            if data is not None:
+                self.on_result(miner.ip, data)
+            await asyncio.sleep(self.interval(miner))
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+# installer processes running at the same time across the whole bench
+MAX_PROCESSES = 8
+# seconds a job may run unless told otherwise
+JOB_TIMEOUT = 1800
+# seconds a process gets to exit after being asked before it is killed
+KILL_GRACE = 5
+# longest line read from a process, installers draw progress bars on one very long line
+MAX_LINE = 1024 * 1024
+
+
+class JobError(RuntimeError):
+    """A job could not finish"""
+
+
+class JobTimeout(JobError):
+    """A job ran longer than its timeout and was killed"""
+
+
+class JobCancelled(JobError):
+    """A job was cancelled, usually because its miner was paused"""
+
+
+class ProcessResult:
+    """Exit code and output of a finished job"""
+    __slots__ = ("returncode", "stdout", "stderr", "elapsed")
+
+    def __init__(self, returncode: int, stdout: str, stderr: str, elapsed: float):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+
+class Job:
+    """A process started, or waiting to be started, by a ProcessPool"""
+    def __init__(self, args: list[str], on_cancel=None):
+        self.args = args
+        self.process = None
+        self.cancelled = False
+        # called when a job that hasn't started is cancelled, wakes it up from waiting for a slot
+        self.on_cancel = on_cancel
+
+    def cancel(self) -> None:
+        """Stop the job, the run() waiting on it raises JobCancelled"""
+        self.cancelled = True
+        if self.process is None and self.on_cancel is not None:
+            self.on_cancel()
+        self.terminate()
+
+    def terminate(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def kill(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+
+class ProcessPool:
+    """
+    Runs external programs like the installer, a few at a time
+
+    Programs are started directly from an argument list, without a shell.
+    Their output is handed over line by line as it is printed instead of
+    all at once when they exit, and jobs that run too long or get
+    cancelled are terminated, then killed if they don't exit.
+    """
+    def __init__(self, max_processes: int = MAX_PROCESSES):
+        self.max_processes = max_processes
+        # every job started or waiting to start
+        self.jobs = set()
+        # jobs holding a slot
+        self._used = 0
+        # created lazily so it binds to the running loop
+        self._changed = None
+
+    @property
+    def running(self) -> int:
+        """Processes running right now"""
+        return sum(1 for job in self.jobs if job.process is not None and job.process.returncode is None)
+
+    @property
+    def waiting(self) -> int:
+        """Jobs waiting for a free slot"""
+        return sum(1 for job in self.jobs if job.process is None)
+
+    async def run(self, args: list[str], on_line=None, timeout: float = JOB_TIMEOUT, jobs: set = None) -> ProcessResult:
+        """
+        Run a program once a slot is free and wait for it to exit
+
+        on_line(line, stream) is called for every line of output, stream is
+        "stdout" or "stderr". The job is added to jobs while it runs, so its
+        owner can cancel it. Raises JobTimeout or JobCancelled, and kills
+        the process if the caller is cancelled.
+        """
+        job = Job(args, on_cancel=self._notify)
+        self.jobs.add(job)
+        if jobs is not None:
+            jobs.add(job)
+        try:
+            async with self._slot(job):
+                start = time.monotonic()
+                job.process = await asyncio.create_subprocess_exec(
+                    *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=MAX_LINE)
+                try:
+                    stdout, stderr = await asyncio.wait_for(self._collect(job, on_line), timeout=timeout)
+                except asyncio.TimeoutError:
+                    raise JobTimeout(f"{args[0]} did not finish in {timeout}s") from None
+                finally:
+                    await self._stop(job)
+                if job.cancelled:
+                    raise JobCancelled(f"{args[0]} was cancelled")
+                return ProcessResult(job.process.returncode, stdout, stderr, time.monotonic() - start)
+        finally:
+            self.jobs.discard(job)
+            if jobs is not None:
+                jobs.discard(job)
+
+    def resize(self, max_processes: int) -> None:
+        """Change how many processes run at once, running ones are never stopped to get under it"""
+        self.max_processes = max_processes
+        self._notify()
+
+    @asynccontextmanager
+    async def _slot(self, job: Job):
+        """Hold one of the max_processes slots, raises JobCancelled if the job is cancelled before it gets one"""
+        changed = self._condition()
+        async with changed:
+            await changed.wait_for(lambda: job.cancelled or self._used < self.max_processes)
+            if job.cancelled:
+                raise JobCancelled(f"{job.args[0]} cancelled before it started")
+            self._used += 1
+        try:
+            yield
+        finally:
+            self._used -= 1
+            self._notify()
+
+    def _condition(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _notify(self) -> None:
+        """Wake up jobs waiting for a slot"""
+        if not self.waiting:
+            return
+        changed = self._condition()
+
+        async def notify():
+            async with changed:
+                changed.notify_all()
+        asyncio.ensure_future(notify())
+
+    def cancel_all(self) -> None:
+        """Cancel every job, for shutting down"""
+        for job in list(self.jobs):
+            job.cancel()
+
+    async def _collect(self, job: Job, on_line) -> tuple[str, str]:
+        """Read both output streams line by line until the process exits"""
+        stdout, stderr = await asyncio.gather(
+            self._read_lines(job.process.stdout, "stdout", on_line),
+            self._read_lines(job.process.stderr, "stderr", on_line))
+        await job.process.wait()
+        return stdout, stderr
+
+    @staticmethod
+    async def _read_lines(stream: asyncio.StreamReader, name: str, on_line) -> str:
+        lines = []
+        while True:
+            try:
+                raw = await stream.readline()
+            except ValueError:
+                # longer than MAX_LINE, take what is buffered and carry on
+                raw = await stream.read(MAX_LINE)
+            if not raw:
+                return "\n".join(lines)
+            # progress bars redraw with carriage returns, only the last one matters
+            line = raw.decode("utf-8", errors="replace").rstrip("\r\n").rsplit("\r", 1)[-1]
+            lines.append(line)
+            if on_line is not None and line.strip():
+                on_line(line, name)
+
+    @staticmethod
+    async def _stop(job: Job) -> None:
+        """Make sure the process is gone, politely first"""
+        if job.process.returncode is not None:
+            return
+        job.terminate()
+        try:
+            await asyncio.wait_for(job.process.wait(), timeout=KILL_GRACE)
+        except asyncio.TimeoutError:
+            job.kill()
+            await job.process.wait()
+
+
+# pool shared by every miner unless a MinerList is given its own
+default_pool = ProcessPool()
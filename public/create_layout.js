@@ -1,5 +1,10 @@
 import { sio } from "./sio.js"
-import { generate_graphs } from "./generate_graphs.js"
+import { generate_graphs, update_graphs, destroy_graphs } from "./generate_graphs.js"
+
+// IP -> the DOM nodes and charts of that miner, kept between updates so only what changed is redrawn
+var cards = {};
+// button class of the IP header by health verdict, anything else stays blue
+const HEALTH_CLASSES = {"warning": "btn-warning", "critical": "btn-danger"};
 
 
 function pauseMiner(ip, checkbox) {
@@ -11,17 +16,6 @@ function pauseMiner(ip, checkbox) {
     }
 }
 
-function checkPause(ip, checkbox) {
-    // make sure the checkbox exists, removes an error
-    if (checkbox) {
-        // get status of pause and set checkbox to this status
-        sio.emit("check_pause", ip, (result) => {
-                checkbox.checked = result
-            }
-        );
-    }
-}
-
 function lightMiner(ip, checkbox) {
     // if the checkbox is checked turn the light on, otherwise off
     if (checkbox.checked){
@@ -31,231 +25,287 @@ function lightMiner(ip, checkbox) {
     }
 }
 
-function checkLight(ip, checkbox) {
-    // make sure the checkbox exists, removes an error
-    if (checkbox) {
-        // get status of light and set checkbox to this status
-        sio.emit("check_light", ip, (result) => {
-                checkbox.checked = result
-            }
-        );
-    }
+function create_switch(ip, name, label_text, on_click) {
+    // create switch container
+    var container = document.createElement('div');
+    container.className = "form-check form-switch d-flex justify-content-evenly"
+
+    // create the switch
+    var checkbox = document.createElement('input');
+    checkbox.type = "checkbox"
+    checkbox.id = name + "_" + ip
+    checkbox.className = "form-check-input"
+    checkbox.addEventListener("click", function(){on_click(ip, checkbox);}, false);
+
+    // add a label to the switch
+    var label = document.createElement("label");
+    label.setAttribute("for", name + "_" + ip);
+    label.innerHTML = label_text;
+
+    // add the switch and label to the container
+    container.append(checkbox)
+    container.append(label)
+    return {container: container, checkbox: checkbox}
 }
 
-export function generate_layout(data_graph) {
-    // get the container for all the charts and data
-    var container_all = document.getElementById('chart_container');
-    // empty the container out
-    container_all.innerHTML = ""
+function create_card(miner) {
+    // create main div column for all data to sit inside
+    var column = document.createElement('div');
+    column.className = "col border border-dark p-3"
 
-    data_graph.miners.forEach(function(miner) {
+    // create IP address header
+    var header = document.createElement('button');
+    header.className = "text-center btn btn-primary w-100"
+    header.onclick = function(){window.open("http://" + miner.IP, '_blank');}
+    header.innerHTML += miner.IP
 
-        // create main div column for all data to sit inside
-        var column = document.createElement('div');
-        column.className = "col border border-dark p-3"
-
-        // create IP address header
-        var header = document.createElement('button');
-        header.className = "text-center btn btn-primary w-100"
-        header.onclick = function(){window.open("http://" + miner.IP, '_blank');}
-        header.innerHTML += miner.IP
-
-        // add the header to col first
-        column.append(header)
-
-        // create light button container
-        var container_light = document.createElement('div');
-        container_light.className = "form-check form-switch d-flex justify-content-evenly"
-
-        // create light button
-        var light_switch = document.createElement('input');
-        light_switch.type = "checkbox"
-        light_switch.id = "light_" + miner.IP
-        light_switch.className = "form-check-input"
-
-        // check if the light is turned on and add click listener
-        checkLight(miner.IP, light_switch);
-        light_switch.addEventListener("click", function(){lightMiner(miner.IP, light_switch);}, false);
-
-        // add a light label to the button
-        var label_light = document.createElement("label");
-        label_light.setAttribute("for", "light_" + miner.IP);
-        label_light.innerHTML = "Light";
-
-        // add the button and label to the container
-        container_light.append(light_switch)
-        container_light.append(label_light)
-
-        if (miner.hasOwnProperty('text')) {
-            // create text row
-            var row_text = document.createElement('div');
-            row_text.className = "row"
-
-            // create text container
-            var text_container = document.createElement('div')
-            text_container.className = "col w-100 p-3"
-
-
-            // create text area for data
-            var text_area = document.createElement('textarea');
-            text_area.rows = "10"
-            text_area.className = "form-control"
-            text_area.style = "font-size: 12px"
-            text_area.disabled = true
-            text_area.readonly = true
-
-            // add data to the text area
-            var text = miner.text
-            text += text_area.innerHTML
-            text_area.innerHTML = text
-
-            // add the text area to the row
-            row_text.append(text_area)
-
-            // create a row for buttons
-            var row_buttons = document.createElement('div');
-            row_buttons.className = "row mt-3"
-
-            // create pause button container
-            var container_pause = document.createElement('div');
-            container_pause.className = "form-check form-switch d-flex justify-content-evenly"
-
-            // create the pause button
-            var pause_switch = document.createElement('input');
-            pause_switch.type = "checkbox"
-            pause_switch.id = "pause_" + miner.IP
-            pause_switch.className = "form-check-input"
-
-            // check if it is paused and add the click listener
-            checkPause(miner.IP, pause_switch);
-            pause_switch.addEventListener("click", function(){pauseMiner(miner.IP, pause_switch);}, false);
-
-            // add a pause label
-            var label_pause = document.createElement("label");
-            label_pause.setAttribute("for", "pause_" + miner.IP);
-            label_pause.innerHTML = "Pause";
-
-            // add the label and button to the container
-            container_pause.append(pause_switch);
-            container_pause.append(label_pause);
-            text_container.append(row_text);
-
-            // add the container to the row
-            row_buttons.append(container_pause);
-
-            if (miner.Light == "show") {
-                // add the light container to the row
-                row_buttons.append(container_light)
-            }
+    // add the header to col first
+    column.append(header)
+
+    // create a row for buttons, filled in by the log or stats card
+    var row_buttons = document.createElement('div');
+    row_buttons.className = "row mt-3"
+
+    // the light switch is always there, it is only shown when the miner can take it
+    var light = create_switch(miner.IP, "light", "Light", lightMiner)
+    light.container.hidden = true
+
+    return {column: column, header: header, row_buttons: row_buttons, light: light, last: {}}
+}
+
+function create_log_card(miner) {
+    var card = create_card(miner)
+    card.kind = "log"
+
+    // create text row
+    var row_text = document.createElement('div');
+    row_text.className = "row"
+
+    // create text container
+    var text_container = document.createElement('div')
+    text_container.className = "col w-100 p-3"
+
+    // create text area for data
+    var text_area = document.createElement('textarea');
+    text_area.rows = "10"
+    text_area.className = "form-control"
+    text_area.style = "font-size: 12px"
+    text_area.disabled = true
+    text_area.readonly = true
+
+    // add the text area to the row
+    row_text.append(text_area)
+    text_container.append(row_text);
+
+    // create the pause switch
+    var pause = create_switch(miner.IP, "pause", "Pause", pauseMiner)
+
+    // add the pause and light switches to the row
+    card.row_buttons.append(pause.container);
+    card.row_buttons.append(card.light.container)
+
+    //add the rows to the main column
+    card.column.append(text_container);
+    card.column.append(card.row_buttons);
+
+    card.text_area = text_area
+    card.pause = pause
+    return card
+}
 
-            //add the row to the main column
-            column.append(text_container);
-            column.append(row_buttons);
+function create_stats_card(miner) {
+    var card = create_card(miner)
+    card.kind = "stats"
+
+    // create hr canvas
+    var hr_canvas = document.createElement('canvas');
+
+    // create temp canvas
+    var temp_canvas = document.createElement('canvas');
+
+    // create fan 1 title
+    var fan_1_title = document.createElement('p');
+    fan_1_title.className = "text-center"
+
+    // create fan 2 title
+    var fan_2_title = document.createElement('p');
+    fan_2_title.className = "text-center"
+
+    // create fan 1 canvas
+    var fan_1_canvas = document.createElement('canvas');
+
+    // create fan 2 canvas
+    var fan_2_canvas = document.createElement('canvas');
+
+    // create row for hr and temp data
+    var row_hr = document.createElement('div');
+    row_hr.className = "row"
+
+    // create row for titles of fans
+    var row_fan_title = document.createElement('div');
+    row_fan_title.className = "row"
+
+    // create row for fan graphs
+    var row_fan = document.createElement('div');
+    row_fan.className = "row"
+
+    // create hr container
+    var container_col_hr = document.createElement('div');
+    container_col_hr.className = "col w-50 ps-0 pe-4"
+
+    // create temp container
+    var container_col_temp = document.createElement('div');
+    container_col_temp.className = "col w-50 ps-0 pe-4"
+
+    // create fan title 1 container
+    var container_col_title_fan_1 = document.createElement('div');
+    container_col_title_fan_1.className = "col"
+
+    // create fan title 2 container
+    var container_col_title_fan_2 = document.createElement('div');
+    container_col_title_fan_2.className = "col"
+
+    // create fan 1 data container
+    var container_col_fan_1 = document.createElement('div');
+    container_col_fan_1.className = "col w-50 ps-3 pe-1"
+
+    // create fan 2 data container
+    var container_col_fan_2 = document.createElement('div');
+    container_col_fan_2.className = "col w-50 ps-3 pe-1"
+
+    // append canvases to the appropriate container columns
+    container_col_hr.append(hr_canvas)
+    container_col_temp.append(temp_canvas)
+    container_col_title_fan_1.append(fan_1_title)
+    container_col_title_fan_2.append(fan_2_title)
+    container_col_fan_1.append(fan_1_canvas)
+    container_col_fan_2.append(fan_2_canvas)
+
+    // add container columns to the correct rows
+    row_hr.append(container_col_hr)
+    row_hr.append(container_col_temp)
+    row_fan_title.append(container_col_title_fan_1)
+    row_fan_title.append(container_col_title_fan_2)
+    row_fan.append(container_col_fan_1)
+    row_fan.append(container_col_fan_2)
+
+    // append the rows to the columns
+    card.column.append(row_hr)
+    card.column.append(row_fan_title)
+    card.column.append(row_fan)
+
+    // add the light switch to the button row, and the row to the main column
+    card.row_buttons.append(card.light.container)
+    card.column.append(card.row_buttons)
+
+    card.fan_titles = [fan_1_title, fan_2_title]
+    // the canvases have to be on the page before the charts are made, see generate_layout
+    card.canvases = [hr_canvas, temp_canvas, fan_1_canvas, fan_2_canvas]
+    return card
+}
 
-            // add the column onto the page
-            container_all.append(column);
+function changed(card, key, value) {
+    // compare with what this card last showed, and remember the new value
+    if (card.last[key] === value) {
+        return false
+    }
+    card.last[key] = value
+    return true
+}
 
-        } else {
+function update_card(card, miner) {
+    // show what the miner is when hovering over its IP
+    var title_changed = false
+    if (changed(card, "Identity", JSON.stringify(miner.Identity || null))) {
+        var identity = miner.Identity || {}
+        card.identity_text = [identity.model, identity.firmware, identity.version, identity.mac]
+            .filter(function(value) {return value}).join(" ")
+        title_changed = true
+    }
+    // color the IP by the health verdict of the server, with the reasons under the identity
+    if (changed(card, "Health", JSON.stringify(miner.Health || null))) {
+        var health = miner.Health || {}
+        card.header.className = "text-center btn w-100 " + (HEALTH_CLASSES[health.status] || "btn-primary")
+        card.health_text = (health.reasons || []).join("\n")
+        title_changed = true
+    }
+    if (title_changed) {
+        card.header.title = [card.identity_text, card.health_text].filter(function(value) {return value}).join("\n")
+    }
+    // only set the switches when the server changes them, so a click isn't undone before it lands
+    if (changed(card, "Lit", !!miner.Lit)) {
+        card.light.checkbox.checked = !!miner.Lit
+    }
+    if (changed(card, "Light", miner.Light)) {
+        card.light.container.hidden = (miner.Light != "show")
+    }
+
+    if (card.kind == "log") {
+        if (changed(card, "Paused", !!miner.Paused)) {
+            card.pause.checkbox.checked = !!miner.Paused
+        }
+        // add the log text fetched by sio_events.js to the text area
+        if (changed(card, "text", miner.text || "")) {
+            card.text_area.textContent = miner.text || ""
+        }
+    } else {
+        var stats = JSON.stringify([miner.HR, miner.Temps, miner.Fans])
+        if (changed(card, "stats", stats)) {
             // get fan rpm
-            var fan_rpm_1 = miner.Fans.fan_0.RPM;
-            var fan_rpm_2 = miner.Fans.fan_1.RPM;
-
-            // create hr canvas
-            var hr_canvas = document.createElement('canvas');
-
-            // create temp canvas
-            var temp_canvas = document.createElement('canvas');
-
-            // create fan 1 title
-            var fan_1_title = document.createElement('p');
-            fan_1_title.innerHTML += "Fan L: " + fan_rpm_1 + " RPM";
-            fan_1_title.className = "text-center"
-
-            // create fan 2 title
-            var fan_2_title = document.createElement('p');
-            fan_2_title.innerHTML += "Fan R: " + fan_rpm_2 + " RPM";
-            fan_2_title.className = "text-center"
-
-            // create fan 1 canvas
-            var fan_1_canvas = document.createElement('canvas');
-
-            // create fan 2 canvas
-            var fan_2_canvas = document.createElement('canvas');
-
-
-            // create row for hr and temp data
-            var row_hr = document.createElement('div');
-            row_hr.className = "row"
-
-            // create row for titles of fans
-            var row_fan_title = document.createElement('div');
-            row_fan_title.className = "row"
-
-            // create row for fan graphs
-            var row_fan = document.createElement('div');
-            row_fan.className = "row"
-
-            // create hr container
-            var container_col_hr = document.createElement('div');
-            container_col_hr.className = "col w-50 ps-0 pe-4"
-
-            // create temp container
-            var container_col_temp = document.createElement('div');
-            container_col_temp.className = "col w-50 ps-0 pe-4"
-
-            // create fan title 1 container
-            var container_col_title_fan_1 = document.createElement('div');
-            container_col_title_fan_1.className = "col"
-
-            // create fan title 2 container
-            var container_col_title_fan_2 = document.createElement('div');
-            container_col_title_fan_2.className = "col"
-
-            // create fan 1 data container
-            var container_col_fan_1 = document.createElement('div');
-            container_col_fan_1.className = "col w-50 ps-3 pe-1"
-
-            // create fan 2 data container
-            var container_col_fan_2 = document.createElement('div');
-            container_col_fan_2.className = "col w-50 ps-3 pe-1"
-
-            // append canvases to the appropriate container columns
-            container_col_hr.append(hr_canvas)
-            container_col_temp.append(temp_canvas)
-            container_col_title_fan_1.append(fan_1_title)
-            container_col_title_fan_2.append(fan_2_title)
-            container_col_fan_1.append(fan_1_canvas)
-            container_col_fan_2.append(fan_2_canvas)
-
-            // add container columns to the correct rows
-            row_hr.append(container_col_hr)
-            row_hr.append(container_col_temp)
-            row_fan_title.append(container_col_title_fan_1)
-            row_fan_title.append(container_col_title_fan_2)
-            row_fan.append(container_col_fan_1)
-            row_fan.append(container_col_fan_2)
-
-            // append the rows to the columns
-            column.append(row_hr)
-            column.append(row_fan_title)
-            column.append(row_fan)
-
-            // create a row for buttons
-            var row_buttons = document.createElement('div');
-            row_buttons.className = "row mt-3"
-
-            if (miner.Light == "show") {
-                // add the light container to the row
-                row_buttons.append(container_light)
+            var fans = miner.Fans || {}
+            card.fan_titles[0].innerHTML = "Fan L: " + (fans.fan_0 ? fans.fan_0.RPM : 0) + " RPM";
+            card.fan_titles[1].innerHTML = "Fan R: " + (fans.fan_1 ? fans.fan_1.RPM : 0) + " RPM";
+            if (card.charts) {
+                update_graphs(card.charts, miner)
+            } else {
+                // generate the graphs
+                card.charts = generate_graphs(miner, ...card.canvases);
             }
-            // add the row to the main column
-            column.append(row_buttons)
+        }
+    }
+}
+
+function remove_card(ip) {
+    var card = cards[ip]
+    if (card.charts) {
+        destroy_graphs(card.charts)
+    }
+    card.column.remove()
+    delete cards[ip]
+}
 
-            // add the column to the page
-            container_all.append(column);
+export function generate_layout(data_graph) {
+    // get the container for all the charts and data
+    var container_all = document.getElementById('chart_container');
+    var seen = new Set()
 
-            // generate the graphs
-            generate_graphs(miner, hr_canvas, temp_canvas, fan_1_canvas, fan_2_canvas);
+    data_graph.miners.forEach(function(miner) {
+        seen.add(miner.IP)
+        var kind = miner.hasOwnProperty('log_seq') ? "log" : "stats"
+        var card = cards[miner.IP]
+
+        if (!card || card.kind != kind) {
+            // a new miner, or one that switched between install log and stats
+            var new_card = (kind == "log") ? create_log_card(miner) : create_stats_card(miner)
+            if (card) {
+                // keep its place on the page
+                card.column.replaceWith(new_card.column)
+                if (card.charts) {
+                    destroy_graphs(card.charts)
+                }
+            } else {
+                // add the column onto the page
+                container_all.append(new_card.column)
+            }
+            card = cards[miner.IP] = new_card
         }
+        update_card(card, miner)
     });
-}
\ No newline at end of file
+
+    // take miners that are gone off the page
+    for (const ip of Object.keys(cards)) {
+        if (!seen.has(ip)) {
+            remove_card(ip)
+        }
+    }
+}
@@ -1,135 +1,135 @@
 import { options_hr, options_temp, options_fans } from "./graph_options.js";
 
-// generate graphs used for the layout
-export function generate_graphs(miner, hr_canvas, temp_canvas, fan_1_canvas, fan_2_canvas) {
+// colors of the hashrate bars for each board (shades of blue)
+const HR_COLORS = {6: "rgba(0, 19, 97, 1)", 7: "rgba(0, 84, 219, 1)", 8: "rgba(36, 180, 224, 1)"};
 
+function hr_datasets(miner) {
     var hr_data = []
 
-    var count = 0
     // get data on all 3 boards
     for (const board_num of [6, 7, 8]) {
         // check if that board exists in the data
-        if (("board_" + board_num) in miner.HR) {
+        if (miner.HR && ("board_" + board_num) in miner.HR) {
             // set the key used to get the data
             var key = "board_"+board_num
 
             // add the hr info to the hr_data
-            hr_data.push({label: board_num, data: [miner.HR[key].HR], backgroundColor: []})
-
-            // set the colors to be used in the graphs (shades of blue)
-            if (board_num == 6) {
-                hr_data[count].backgroundColor = ["rgba(0, 19, 97, 1)"]
-            } else if (board_num == 7) {
-                hr_data[count].backgroundColor = ["rgba(0, 84, 219, 1)"]
-            } else if (board_num == 8) {
-                hr_data[count].backgroundColor = ["rgba(36, 180, 224, 1)"]
-            }
-            count += 1
+            hr_data.push({label: board_num, data: [miner.HR[key].HR], backgroundColor: [HR_COLORS[board_num]]})
         }
     }
+    return hr_data
+}
 
-    // create the hr chart
-    var chart_hr = new Chart(hr_canvas, {
-        type: "bar",
-        data: {
-            labels: ["Hashrate"],
-            // data from above
-            datasets: hr_data
-        },
-        // options imported from graph_options.js
-        options: options_hr
-    });
-
-
+function temp_datasets(miner) {
     var temps_data = []
 
     // get temp data for each board
     for (const board_num of [6, 7, 8]) {
 
         // check if the board is in the keys list
-        if (("board_" + board_num) in miner.Temps) {
+        if (miner.Temps && ("board_" + board_num) in miner.Temps) {
 
             // set the key to be used to access the data
-            key = "board_"+board_num
+            var key = "board_"+board_num
 
             // add chip and board temps to the temps_data along with colors
             temps_data.push({label: board_num + " Chip", data: [miner.Temps[key].Chip], backgroundColor: ["rgba(6, 92, 39, 1)"]});
             temps_data.push({label: board_num + " Board", data: [miner.Temps[key].Board], backgroundColor: ["rgba(255, 15, 58, 1)"]});
         }
     }
+    return temps_data
+}
+
+function fan_dataset(fan_rpm) {
+    // a stopped fan shows the rest of the doughnut in red
+    var secondary_col = (fan_rpm == 0) ? "rgba(97, 4, 4, 1)" : "rgba(199, 199, 199, 1)"
+    // set the fan data to be rpm and the rest to go up to 6000
+    return {data: [fan_rpm, (6000-fan_rpm)], backgroundColor: ["rgba(103, 0, 221, 1)", secondary_col]}
+}
+
+function fan_rpm(miner, fan) {
+    return (miner.Fans && miner.Fans[fan]) ? miner.Fans[fan].RPM : 0
+}
+
+function set_datasets(chart, datasets) {
+    // keep the dataset objects when only the numbers changed so chart.js can update in place
+    if (chart.data.datasets.length == datasets.length &&
+        chart.data.datasets.every((dataset, i) => dataset.label == datasets[i].label)) {
+        datasets.forEach(function(dataset, i) {
+            chart.data.datasets[i].data = dataset.data
+            chart.data.datasets[i].backgroundColor = dataset.backgroundColor
+        });
+    } else {
+        chart.data.datasets = datasets
+    }
+}
+
+// generate graphs used for the layout, returns the charts so update_graphs can change them later
+export function generate_graphs(miner, hr_canvas, temp_canvas, fan_1_canvas, fan_2_canvas) {
 
+    // create the hr chart
+    var chart_hr = new Chart(hr_canvas, {
+        type: "bar",
+        data: {
+            labels: ["Hashrate"],
+            // data from above
+            datasets: hr_datasets(miner)
+        },
+        // options imported from graph_options.js
+        options: options_hr
+    });
 
     var chart_temp = new Chart(temp_canvas, {
         type: "bar",
         data: {
             labels: ["Temps"],
             // data from above
-            datasets: temps_data
+            datasets: temp_datasets(miner)
         },
         // options imported from graph_options.js
         options: options_temp,
     });
 
-    // get fan rpm
-    var fan_rpm_1 = miner.Fans.fan_0.RPM;
-    if (fan_rpm_1 == 0){
-        var secondary_col_1 = "rgba(97, 4, 4, 1)"
-    } else {
-        var secondary_col_1 = "rgba(199, 199, 199, 1)"
-    }
-    var fan_rpm_2 = miner.Fans.fan_1.RPM;
-    if (fan_rpm_2 == 0){
-        var secondary_col_2 = "rgba(97, 4, 4, 1)"
-    } else {
-        var secondary_col_2 = "rgba(199, 199, 199, 1)"
-    }
-
-    // set the fan data to be rpm and the rest to go up to 6000
-    var fan_data_1 = [fan_rpm_1, (6000-fan_rpm_1)];
-
     // create the fan 1 chart
     var chart_fan_1 = new Chart(fan_1_canvas, {
         type: "doughnut",
         data: {
             labels: ["Fan L"],
-            datasets: [
-                {
-                    // data from above, no colors included
-                    data: fan_data_1,
-                    // add colors
-                    backgroundColor: [
-                        "rgba(103, 0, 221, 1)",
-                        secondary_col_1
-                    ]
-                },
-            ]
+            datasets: [fan_dataset(fan_rpm(miner, "fan_0"))]
         },
         // options imported from graph_options.js
         options: options_fans
     });
 
-
-    var fan_data_2 = [fan_rpm_2, (6000-fan_rpm_2)];
-
     // create the fan 2 chart
     var chart_fan_2 = new Chart(fan_2_canvas, {
         type: "doughnut",
         data: {
             labels: ["Fan R"],
-            datasets: [
-                {
-                    // data from above, no colors included
-                    data: fan_data_2,
-                    // add colors
-                    backgroundColor: [
-                        "rgba(103, 0, 221, 1)",
-                        secondary_col_2
-                    ]
-                },
-            ]
+            datasets: [fan_dataset(fan_rpm(miner, "fan_1"))]
         },
         // options imported from graph_options.js
         options: options_fans
     });
+
+    return {hr: chart_hr, temp: chart_temp, fan_1: chart_fan_1, fan_2: chart_fan_2}
+}
+
+// update the charts made by generate_graphs with new data, without recreating them
+export function update_graphs(charts, miner) {
+    set_datasets(charts.hr, hr_datasets(miner))
+    set_datasets(charts.temp, temp_datasets(miner))
+    set_datasets(charts.fan_1, [fan_dataset(fan_rpm(miner, "fan_0"))])
+    set_datasets(charts.fan_2, [fan_dataset(fan_rpm(miner, "fan_1"))])
+    // "none" skips the animation, it would run on every miner every update
+    for (const chart of Object.values(charts)) {
+        chart.update("none")
+    }
 }
 
+// free the canvases of charts whose miner left the page
+export function destroy_graphs(charts) {
+    for (const chart of Object.values(charts)) {
+        chart.destroy()
+    }
+}
@@ -1,2 +1,21 @@
-// socketIO io to be used by everything else
-export const sio = io();
\ No newline at end of file
+// miners this page shows, from the address, e.g. /?cidr=192.168.1.0/28&state=done or /?unhealthy=1
+function selector_from_url() {
+    var params = new URLSearchParams(window.location.search);
+    var selector = {};
+    if (params.get("ips")) {
+        selector.ips = params.get("ips").split(",");
+    }
+    if (params.get("cidr")) {
+        selector.cidr = params.get("cidr").split(",");
+    }
+    if (params.get("state")) {
+        selector.state = params.get("state").split(",");
+    }
+    if (params.get("unhealthy")) {
+        selector.unhealthy = true;
+    }
+    return selector;
+}
+
+// socketIO io to be used by everything else, the server only sends the miners in the selector
+export const sio = io({auth: {selector: selector_from_url()}});
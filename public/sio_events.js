@@ -1,11 +1,157 @@
 import {generate_layout} from "./create_layout.js"
 import {sio} from "./sio.js"
 
-// when miner data is sent
-sio.on("miner_data", (data, cb) => {
+// latest data for every miner, keyed by IP
+var miners = {};
+// install log text and the last log entry we have for every miner, keyed by IP
+var logs = {};
+// most lines of log text kept per miner
+const LOG_LINES = 200;
+// one get_logs request at a time, deltas that arrive meanwhile ask again once it is answered
+var logsInFlight = false;
+var logsStale = false;
+
+function render() {
     // generate the layout of the page
-    generate_layout(JSON.parse(data));
+    generate_layout({miners: Object.values(miners)});
+}
+
+function updateLogs() {
+    // ask only for the logs that have new entries, in one request
+    var since = {};
+    for (const [ip, miner] of Object.entries(miners)) {
+        if (miner.hasOwnProperty('log_seq')) {
+            var log = logs[ip] || (logs[ip] = {seq: 0, text: ""});
+            miner.text = log.text;
+            if (miner.log_seq > log.seq) {
+                since[ip] = log.seq;
+            }
+        }
+    }
+    if (Object.keys(since).length == 0) {
+        render();
+        return;
+    }
+    if (logsInFlight) {
+        // the same since would be sent again and the entries added twice
+        logsStale = true;
+        render();
+        return;
+    }
+    logsInFlight = true;
+    sio.emit("get_logs", {since: since, format: "text"}, (result) => {
+        logsInFlight = false;
+        for (const [ip, log] of Object.entries(result)) {
+            // already have these, a reply must never roll the log back
+            if (logs[ip] && log.seq <= logs[ip].seq) {
+                continue;
+            }
+            // the miner may have been removed while we waited
+            var old = logs[ip] ? logs[ip].text : "";
+            // new entries come newest first, so they go on top
+            var text = log.entries;
+            if (old != "") {
+                text = (text != "") ? text + "\n" + old : old;
+            }
+            logs[ip] = {seq: log.seq, text: text.split("\n", LOG_LINES).join("\n")};
+            if (miners[ip]) {
+                miners[ip].text = logs[ip].text;
+            }
+        }
+        if (logsStale) {
+            logsStale = false;
+            updateLogs();
+        } else {
+            render();
+        }
+    });
+}
+
+// a reply lost with the connection never comes, don't wait for it forever
+sio.on("disconnect", () => {
+    logsInFlight = false;
+    logsStale = false;
+});
+
+// the dashboard reads JSON only, msgpack from set_format is for custom clients
+var formatReset = false;
 
-    // quick callback to server
-    cb("graph data received");
+function decode(data) {
+    if (typeof data === "string") {
+        formatReset = false;
+        return JSON.parse(data);
+    }
+    // switched to a binary format, go back to JSON once, the snapshot is sent again in it
+    if (!formatReset) {
+        formatReset = true;
+        sio.emit("set_format", "json");
+    }
+    return null;
+}
+
+// pages of the snapshot still coming in, null once it is complete
+var pages = null;
+// deltas that arrived while the snapshot was coming in, applied on top of it
+var pending = [];
+
+// when the snapshot of the subscribed miners is sent (on connect and on subscribe), one page at a time
+sio.on("miner_page", (data) => {
+    var page = decode(data);
+    if (page === null) {
+        return;
+    }
+    if (page.page == 0) {
+        pages = {};
+        pending = [];
+    }
+    if (pages === null) {
+        return;
+    }
+    page.miners.forEach(function(miner) {
+        pages[miner.IP] = miner;
+    });
+    if (page.page == page.pages - 1) {
+        miners = pages;
+        pages = null;
+        pending.forEach(apply_delta);
+        pending = [];
+        // forget the logs of miners we no longer show
+        for (const ip of Object.keys(logs)) {
+            if (!miners[ip]) {
+                delete logs[ip];
+            }
+        }
+        updateLogs();
+    }
 });
+
+// when only the changes since the last update are sent
+sio.on("miner_delta", (data) => {
+    var delta = decode(data);
+    if (delta === null) {
+        return;
+    }
+    if (pages !== null) {
+        // the snapshot isn't complete yet, these changes are newer than it
+        pending.push(delta);
+        return;
+    }
+    apply_delta(delta);
+    updateLogs();
+});
+
+function apply_delta(delta) {
+    // miners that are new or changed shape
+    for (const [ip, miner] of Object.entries(delta.replaced || {})) {
+        miners[ip] = miner;
+    }
+    // fields that changed on known miners
+    for (const [ip, fields] of Object.entries(delta.changed || {})) {
+        miners[ip] = Object.assign(miners[ip] || {IP: ip}, fields);
+    }
+    // miners that are gone
+    (delta.removed || []).forEach(function(ip) {
+        delete miners[ip];
+        delete logs[ip];
+    });
+}
@@ -0,0 +1,374 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+
+from broadcast import Broadcaster
+from config import Config, CONFIG_FILE, load_config
+from diagnostics import LoopMonitor
+from fleet import Fleet, rpc_methods, invoke, fleet_stats, state_event
+from miner_data import Miner
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# where the web process listens for shards unless told otherwise
+BUS_HOST = "127.0.0.1"
+BUS_PORT = 4100
+# seconds between the deltas a shard publishes to the web process
+PUBLISH_INTERVAL = 1
+# seconds between the stats a shard publishes to the web process
+STATS_INTERVAL = 5
+# seconds a shard waits before reconnecting to the web process
+RECONNECT_DELAY = 2
+# seconds the web process waits for a shard to answer a call, a batch reboot can take a while
+CALL_TIMEOUT = 120
+# longest message on the bus, the first delta of a shard is a snapshot of all its miners
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class ShardCallError(RuntimeError):
+    """A shard could not be reached, or raised while answering a call"""
+
+
+def merge_results(results: list):
+    """
+    Merge the replies of several shards into one
+
+    Numbers are summed, lists joined and dicts merged key by key, which
+    combines per-IP replies (their keys never overlap between shards) as
+    well as counts like those from batch or install_stats.
+    """
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+    first = results[0]
+    if isinstance(first, bool):
+        return any(results)
+    if isinstance(first, (int, float)):
+        return sum(results)
+    if isinstance(first, list):
+        return [item for result in results for item in result]
+    if isinstance(first, dict):
+        keys = dict.fromkeys(key for result in results for key in result)
+        return {key: merge_results([result[key] for result in results if key in result]) for key in keys}
+    return first
+
+
+def _dumps(message: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message) + b"\n"
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class _ShardConnection:
+    """A connected shard, as seen from the web process"""
+    def __init__(self, index: int, writer: asyncio.StreamWriter):
+        self.index = index
+        self.writer = writer
+        # call id -> future waiting on the reply
+        self.pending = {}
+        self._ids = itertools.count()
+
+    async def call(self, method: str, args: list):
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            self.writer.write(_dumps({"type": "call", "id": call_id, "method": method, "args": args}))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout=CALL_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ShardCallError(f"shard {self.index} did not answer {method}") from e
+        finally:
+            self.pending.pop(call_id, None)
+
+    def fail_pending(self) -> None:
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ShardCallError(f"shard {self.index} disconnected"))
+
+
+class ShardHub:
+    """
+    The web process end of the bus, shards connect to it and publish their miners
+
+    Each shard sends the deltas of its own miners, which are applied to one
+    miner_data dict here, so the broadcast to clients is built exactly like
+    it is when one process runs every miner. Calls from clients are sent to
+    the shard that owns the miner, or to every shard with the replies merged.
+    """
+    def __init__(self, miner_data: dict, on_state=None, on_output=None, host: str = BUS_HOST, port: int = BUS_PORT):
+        # ip -> latest data, shared with the broadcaster of the web process
+        self.miner_data = miner_data
+        # called with each miner_state event a shard sends
+        self.on_state = on_state
+        # called with (run_id, lines) as the miners of a shard print the output of run_command
+        self.on_output = on_output
+        self.host = host
+        self.port = port
+        # shard index -> connection
+        self.shards = {}
+        # ip -> index of the shard that owns it
+        self.owners = {}
+        # shard index -> last stats it sent
+        self.stats = {}
+        self._server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_MESSAGE_SIZE)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for shard in list(self.shards.values()):
+            shard.writer.close()
+
+    async def call(self, method: str, *args, ip: str):
+        """Call a method on the shard that owns ip"""
+        index = self.owners.get(ip)
+        if index is None or index not in self.shards:
+            raise KeyError(ip)
+        return self._reply(await self.shards[index].call(method, list(args)))
+
+    async def call_all(self, method: str, *args):
+        """Call a method on every shard and merge the replies, shards that fail are left out"""
+        replies = await asyncio.gather(*[shard.call(method, list(args)) for shard in self.shards.values()],
+                                       return_exceptions=True)
+        results = []
+        errors = []
+        for reply in replies:
+            try:
+                if isinstance(reply, Exception):
+                    raise reply
+                results.append(self._reply(reply))
+            except ShardCallError as e:
+                errors.append(e)
+        if errors and not results:
+            raise errors[0]
+        return merge_results(results)
+
+    def stats_total(self) -> dict:
+        """fleet_stats summed over every connected shard"""
+        return merge_results([self.stats[index] for index in self.shards if index in self.stats]) or {}
+
+    @staticmethod
+    def _reply(reply: dict):
+        if reply.get("error") is not None:
+            raise ShardCallError(reply["error"])
+        return reply.get("result")
+
+    def _drop_shard_miners(self, index: int) -> None:
+        for ip in [ip for ip, owner in self.owners.items() if owner == index]:
+            del self.owners[ip]
+            self.miner_data.pop(ip, None)
+
+    def _apply(self, index: int, delta: dict) -> None:
+        """Apply a delta from a shard to the shared miner data"""
+        for ip, data in delta.get("replaced", {}).items():
+            self.miner_data[ip] = data
+            self.owners[ip] = index
+        for ip, fields in delta.get("changed", {}).items():
+            self.miner_data.setdefault(ip, {"IP": ip}).update(fields)
+            self.owners[ip] = index
+        for ip in delta.get("removed", []):
+            if self.owners.get(ip) == index:
+                del self.owners[ip]
+                self.miner_data.pop(ip, None)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        shard = None
+        try:
+            hello = json.loads(await reader.readline() or b"{}")
+            if hello.get("type") != "hello":
+                return
+            index = int(hello["shard"])
+            old = self.shards.get(index)
+            if old is not None:
+                # the shard restarted, the old connection is stale
+                old.writer.close()
+                old.fail_pending()
+            # its first delta is a full snapshot, forget whatever it had before
+            self._drop_shard_miners(index)
+            shard = self.shards[index] = _ShardConnection(index, writer)
+            print(f"Shard {index} connected")
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                kind = message.get("type")
+                if kind == "delta":
+                    self._apply(index, message["delta"])
+                elif kind == "state" and self.on_state is not None:
+                    self.on_state(message["event"])
+                elif kind == "output" and self.on_output is not None:
+                    self.on_output(message["id"], message["lines"])
+                elif kind == "stats":
+                    self.stats[index] = message["stats"]
+                elif kind == "reply":
+                    future = shard.pending.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            print(f"Shard connection error: {e}")
+        finally:
+            writer.close()
+            if shard is not None:
+                shard.fail_pending()
+                # a newer connection from the same shard may already have replaced this one
+                if self.shards.get(shard.index) is shard:
+                    del self.shards[shard.index]
+                    self.stats.pop(shard.index, None)
+                    self._drop_shard_miners(shard.index)
+                    print(f"Shard {shard.index} disconnected")
+
+
+class ShardWorker:
+    """
+    One shard of the bench, polls and installs its own miners and publishes them to the web process
+
+    Runs the same install, discovery and poll loops the web process runs
+    on its own, and answers calls from the web process with rpc_methods.
+    """
+    def __init__(self, index: int, count: int, config: Config, host: str = BUS_HOST, port: int = BUS_PORT,
+                 exit_with_hub: bool = False, config_path: str = CONFIG_FILE):
+        self.index = index
+        self.count = count
+        self.host = host
+        self.port = port
+        # spawned shards exit when the web process goes away instead of being orphaned
+        self.exit_with_hub = exit_with_hub
+        # reloaded when it changes, every shard watches the same file
+        self.config_path = config_path
+        self.fleet = Fleet(config, (index, count))
+        # logs whatever blocks the loop of this shard
+        self.monitor = LoopMonitor(slow=config.diagnostics.slow_callback)
+        self.miner_list = self.fleet.miner_list
+        self.methods = rpc_methods(self.fleet, on_output=self._send_output)
+        # ip -> latest data, published as deltas
+        self.miner_data = {data["IP"]: data for data in self.miner_list.basic_data()}
+        self.fleet.poll(on_result=self._store, on_remove=self._drop)
+        self.miner_list.subscribe(self._state_changed)
+        self._writer = None
+
+    def _store(self, ip: str, data: dict) -> None:
+        self.miner_data[ip] = data
+
+    def _drop(self, ip: str) -> None:
+        self.miner_data.pop(ip, None)
+
+    def _send(self, message: dict) -> None:
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_dumps(message))
+
+    def _send_output(self, run_id: str, lines: list) -> None:
+        self._send({"type": "output", "id": run_id, "lines": lines})
+
+    def _state_changed(self, miner: Miner, old: str, new: str, elapsed: float) -> None:
+        self._send({"type": "state", "event": state_event(miner, old, new, elapsed)})
+
+    async def run(self) -> None:
+        """Run the miners and keep publishing them, reconnecting to the web process as needed"""
+        self.monitor.start()
+        self.fleet.start()
+        asyncio.create_task(self.fleet.watch(self.config_path))
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_MESSAGE_SIZE)
+            except OSError:
+                if self.exit_with_hub:
+                    return
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await self._session(reader, writer)
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                print(f"Shard {self.index} lost the web process: {e}")
+            finally:
+                self._writer = None
+                writer.close()
+            if self.exit_with_hub:
+                return
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+        self._send({"type": "hello", "shard": self.index, "count": self.count})
+        publisher = asyncio.create_task(self._publish())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                message = json.loads(line)
+                if message.get("type") == "call":
+                    # answer in a task, a batch reboot shouldn't hold up other calls
+                    asyncio.create_task(self._answer(message))
+        finally:
+            publisher.cancel()
+
+    async def _publish(self) -> None:
+        # a fresh broadcaster makes the first delta a full snapshot
+        broadcaster = Broadcaster()
+        cycles = 0
+        while True:
+            self.fleet.health.evaluate()
+            delta = broadcaster.delta(list(self.miner_data.values()))
+            if delta is not None:
+                self._send({"type": "delta", "delta": delta})
+            if cycles % (STATS_INTERVAL // PUBLISH_INTERVAL) == 0:
+                self._send({"type": "stats", "stats": fleet_stats(self.fleet)})
+            cycles += 1
+            try:
+                if self._writer is not None:
+                    await self._writer.drain()
+            except OSError:
+                # the read loop notices the connection is gone and ends the session
+                return
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    async def _answer(self, message: dict) -> None:
+        reply = {"type": "reply", "id": message["id"], "result": None, "error": None}
+        try:
+            reply["result"] = await invoke(self.methods, message["method"], message.get("args", []))
+        except Exception as e:
+            reply["error"] = f"{type(e).__name__}: {e}"
+        self._send(reply)
+
+
+async def spawn_shards(count: int, host: str = BUS_HOST, port: int = BUS_PORT, config_path: str = CONFIG_FILE) -> list:
+    """Start count shard processes on this machine, they exit when the web process does"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shard.py")
+    return [await asyncio.create_subprocess_exec(
+                sys.executable, script, "--index", str(index), "--count", str(count),
+                "--bus", f"{host}:{port}", "--config", config_path, "--exit-with-hub")
+            for index in range(count)]
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run one shard of the bench and publish it to the web process")
+    parser.add_argument("--index", type=int, required=True, help="index of this shard, from 0")
+    parser.add_argument("--count", type=int, required=True, help="total number of shards")
+    parser.add_argument("--bus", default=f"{BUS_HOST}:{BUS_PORT}", help="host:port the web process listens on")
+    parser.add_argument("--config", default=CONFIG_FILE, help="config file, the same one the web process uses")
+    parser.add_argument("--exit-with-hub", action="store_true", help="exit when the web process goes away")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args(sys.argv[1:])
+    bus_host, bus_port = arguments.bus.rsplit(":", 1)
+    worker = ShardWorker(arguments.index, arguments.count, load_config(arguments.config), bus_host, int(bus_port),
+                         exit_with_hub=arguments.exit_with_hub, config_path=arguments.config)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
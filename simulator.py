@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import hashlib
+import ipaddress
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+# services a simulated miner can run
+SERVICES = ("api", "http", "ssh")
+# first loopback address handed out, each miner gets its own so MinerList can key them by IP
+FIRST_HOST = "127.0.1.1"
+# board IDs reported by an S9
+BOARDS = (6, 7, 8)
+FANS = (0, 1)
+
+
+class MockMiner:
+    """
+    A fake miner on loopback speaking the cgminer/bosminer API, HTTP and SSH
+
+    Every service listens on its own ephemeral port. latency delays every
+    reply, failure_rate is the chance a connection is dropped without one,
+    and reboot() takes every service down for a while like a real reboot.
+    """
+    def __init__(self, host: str = "127.0.0.1", services: tuple = SERVICES, latency: float = 0.0,
+                 failure_rate: float = 0.0, firmware: str = "BOSminer+", ssh_key=None, root: str = None):
+        self.host = host
+        self.services = services
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.firmware = firmware
+        self.ssh_key = ssh_key
+        # directory files sent over SFTP/SCP end up in, only needed for SSH
+        self.root = root
+        # removed by stop() when we made it
+        self._own_root = False
+        if root is None and "ssh" in services:
+            self.root = tempfile.mkdtemp(prefix="mock_miner_")
+            self._own_root = True
+        if self.root is not None:
+            for directory in ("etc", "tmp"):
+                os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        # service -> port, kept across reboots
+        self.ports = {service: 0 for service in services}
+        self._servers = {}
+        # replies sent, for checking the load a client put on us
+        self.requests = 0
+
+    @property
+    def api_port(self) -> int:
+        return self.ports.get("api", 0)
+
+    @property
+    def http_port(self) -> int:
+        return self.ports.get("http", 0)
+
+    @property
+    def ssh_port(self) -> int:
+        return self.ports.get("ssh", 0)
+
+    async def start(self) -> None:
+        """Start every service, reusing the ports from before a reboot"""
+        if "api" in self.services:
+            server = await asyncio.start_server(self._handle_api, self.host, self.ports["api"])
+            self._servers["api"] = server
+        if "http" in self.services:
+            server = await asyncio.start_server(self._handle_http, self.host, self.ports["http"])
+            self._servers["http"] = server
+        if "ssh" in self.services and asyncssh is not None:
+            if self.ssh_key is None:
+                self.ssh_key = asyncssh.generate_private_key("ssh-rsa")
+            server = await asyncssh.create_server(
+                _MockSSHServer, self.host, self.ports["ssh"], server_host_keys=[self.ssh_key],
+                process_factory=self._handle_ssh, sftp_factory=self._sftp_factory, allow_scp=True)
+            self._servers["ssh"] = server
+        for service, server in self._servers.items():
+            self.ports[service] = server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """Stop every service and remove the files sent to it"""
+        await self._close()
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._own_root = False
+
+    async def _close(self) -> None:
+        for server in self._servers.values():
+            server.close()
+        for server in self._servers.values():
+            await server.wait_closed()
+        self._servers = {}
+
+    async def reboot(self, downtime: float = 5.0) -> None:
+        """Go down for downtime seconds, then come back on the same ports"""
+        # the files stay, like on the flash of a real miner
+        await self._close()
+        await asyncio.sleep(downtime)
+        await self.start()
+
+    def version_reply(self) -> dict:
+        return {"STATUS": [{"STATUS": "S", "Msg": "BOSminer+ versions"}],
+                "VERSION": [{self.firmware: "0.9.0", "API": "3.7"}], "id": 1}
+
+    def stats_reply(self) -> dict:
+        """Reply to devs+temps+fans, with a little noise so every poll is different"""
+        status = [{"STATUS": "S"}]
+        devs = [{"ID": board, "MHS 5s": random.uniform(4.4e6, 4.8e6), "Temperature": 60.0}
+                for board in BOARDS]
+        temps = [{"ID": board, "Board": round(random.uniform(50, 60), 1), "Chip": round(random.uniform(65, 80), 1)}
+                 for board in BOARDS]
+        fans = [{"ID": fan, "RPM": random.randint(4000, 4600)} for fan in FANS]
+        return {"devs": [{"STATUS": status, "DEVS": devs}],
+                "temps": [{"STATUS": status, "TEMPS": temps}],
+                "fans": [{"STATUS": status, "FANS": fans}], "id": 1}
+
+    async def _fail_or_wait(self, writer) -> bool:
+        """Apply latency and random failures, returns False if the connection was dropped"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            writer.close()
+            return False
+        return True
+
+    async def _handle_api(self, reader, writer) -> None:
+        try:
+            data = await reader.read(4096)
+            if not data or not await self._fail_or_wait(writer):
+                return
+            command = json.loads(data).get("command", "")
+            if command == "version":
+                reply = self.version_reply()
+            elif all(part in ("devs", "temps", "fans") for part in command.split("+")):
+                reply = self.stats_reply()
+            else:
+                reply = {"STATUS": [{"STATUS": "E", "Msg": f"Invalid command {command}"}], "id": 1}
+            self.requests += 1
+            # like cgminer: JSON, a null byte, then close the connection
+            writer.write(json.dumps(reply).encode("utf-8") + b"\x00")
+            await writer.drain()
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_http(self, reader, writer) -> None:
+        try:
+            await reader.readline()
+            if not await self._fail_or_wait(writer):
+                return
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n<html>mock miner</html>")
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_ssh(self, process) -> None:
+        """Run a command, only the handful the webserver uses are understood"""
+        command = process.command or ""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if command.startswith("sha256sum ") or command.startswith("cat "):
+            path = self._local_path(command.split(" ", 1)[1].strip())
+            if not os.path.exists(path):
+                process.stderr.write(f"{command.split()[0]}: no such file\n")
+                process.exit(1)
+                return
+            if command.startswith("cat "):
+                with open(path) as f:
+                    process.stdout.write(f.read())
+            else:
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                process.stdout.write(f"{digest}  {command.split(' ', 1)[1].strip()}\n")
+        elif command.startswith("echo ") and " > " in command:
+            text, target = command[5:].rsplit(" > ", 1)
+            path = self._local_path(target.strip())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text + "\n")
+        elif command in ("reboot", "/sbin/reboot"):
+            process.exit(0)
+            asyncio.ensure_future(self.reboot())
+            return
+        else:
+            process.stdout.write(f"{command}\n")
+        process.exit(0)
+
+    def _local_path(self, remote_path: str) -> str:
+        return os.path.join(self.root, remote_path.lstrip("/"))
+
+    def _sftp_factory(self, chan):
+        return asyncssh.SFTPServer(chan, chroot=self.root)
+
+
+if asyncssh is not None:
+    class _MockSSHServer(asyncssh.SSHServer):
+        """Accepts any username and password"""
+        def begin_auth(self, username: str) -> bool:
+            return True
+
+        def password_auth_supported(self) -> bool:
+            return True
+
+        def validate_password(self, username: str, password: str) -> bool:
+            return True
+else:
+    _MockSSHServer = None
+
+
+class Simulator:
+    """
+    A bench of MockMiners, optionally rebooting at random
+
+    Each miner gets its own loopback address starting at first_host, which
+    works out of the box on Linux and Windows (macOS needs the addresses
+    aliased onto lo0 first).
+    """
+    def __init__(self, count: int, services: tuple = SERVICES, latency: float = 0.0, failure_rate: float = 0.0,
+                 reboot_interval: float = None, reboot_downtime: float = 5.0, first_host: str = FIRST_HOST):
+        # one host key for every miner, generating thousands is slow
+        key = asyncssh.generate_private_key("ssh-rsa") if asyncssh is not None and "ssh" in services else None
+        first = ipaddress.ip_address(first_host)
+        self.miners = [MockMiner(host=str(first + index), services=services, latency=latency,
+                                 failure_rate=failure_rate, ssh_key=key)
+                       for index in range(count)]
+        # average seconds between reboots of each miner, None to never reboot
+        self.reboot_interval = reboot_interval
+        self.reboot_downtime = reboot_downtime
+        self._chaos = None
+
+    async def start(self) -> None:
+        for miner in self.miners:
+            await miner.start()
+        if self.reboot_interval:
+            self._chaos = asyncio.ensure_future(self._reboot_loop())
+
+    async def stop(self) -> None:
+        if self._chaos is not None:
+            self._chaos.cancel()
+        await asyncio.gather(*[miner.stop() for miner in self.miners])
+
+    def ports(self) -> list[dict]:
+        """Where every miner is listening"""
+        return [{"ip": miner.host, **miner.ports} for miner in self.miners]
+
+    async def _reboot_loop(self) -> None:
+        # with N miners each rebooting every reboot_interval seconds on average
+        while True:
+            await asyncio.sleep(random.expovariate(len(self.miners) / self.reboot_interval))
+            asyncio.ensure_future(random.choice(self.miners).reboot(self.reboot_downtime))
+
+
+async def serve(args) -> None:
+    """Run a simulator until interrupted or terminated, printing the miner ports as one JSON line"""
+    simulator = Simulator(args.count, services=tuple(args.services.split(",")), latency=args.latency,
+                          failure_rate=args.failure_rate, reboot_interval=args.reboot_interval,
+                          reboot_downtime=args.reboot_downtime, first_host=args.first_host)
+    stopped = asyncio.Event()
+    try:
+        # terminate() from the benchmark should clean up like ctrl-c does
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    except NotImplementedError:
+        # no signal handlers on the Windows event loop
+        pass
+    await simulator.start()
+    print(json.dumps(simulator.ports()), flush=True)
+    try:
+        await stopped.wait()
+    finally:
+        await simulator.stop()
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run fake miners on loopback for testing the webserver")
+    parser.add_argument("--count", type=int, default=10, help="number of miners")
+    parser.add_argument("--services", default=",".join(SERVICES), help="comma separated: api,http,ssh")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance a connection is dropped")
+    parser.add_argument("--reboot-interval", type=float, default=None,
+                        help="average seconds between reboots of each miner")
+    parser.add_argument("--reboot-downtime", type=float, default=5.0, help="seconds a reboot takes")
+    parser.add_argument("--first-host", default=FIRST_HOST, help="loopback address of the first miner")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args(sys.argv[1:])))
+    except KeyboardInterrupt:
+        pass
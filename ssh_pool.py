@@ -0,0 +1,208 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import asyncssh
+
+# seconds between keepalive messages on an open connection
+KEEPALIVE_INTERVAL = 15
+# missed keepalives before the connection is considered dead
+KEEPALIVE_COUNT_MAX = 3
+# seconds a connection can sit unused before it gets closed
+IDLE_TIMEOUT = 120
+# maximum number of SSH connections open at once across every miner
+MAX_CONNECTIONS = 64
+# seconds to wait for the SSH handshake
+CONNECT_TIMEOUT = 30
+
+
+class _PooledClient(asyncssh.SSHClient):
+    """asyncssh client that tells the pool when its connection drops"""
+    def __init__(self, entry: "_PoolEntry"):
+        self.entry = entry
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.entry.closed = True
+
+
+class _PoolEntry:
+    """A cached connection plus the bookkeeping the pool needs"""
+    def __init__(self, ip: str, username: str):
+        self.ip = ip
+        self.username = username
+        self.conn = None
+        # number of callers currently using the connection
+        self.users = 0
+        # monotonic time the connection was last handed back
+        self.last_used = time.monotonic()
+        # set by the client when asyncssh reports the connection lost
+        self.closed = False
+
+
+class SSHPool:
+    """
+    Per-miner cache of SSH connections
+
+    Connections are reused between commands, kept alive while in use, closed
+    after sitting idle and capped in total so a large bench does not run out
+    of file descriptors. Call invalidate when a miner reboots so the next
+    command reconnects instead of using a dead connection.
+    """
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, idle_timeout: float = IDLE_TIMEOUT,
+                 keepalive_interval: float = KEEPALIVE_INTERVAL, connect_timeout: float = CONNECT_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        # ip -> _PoolEntry for every open or opening connection
+        self._entries = {}
+        # ip -> lock so only one handshake per miner runs at a time
+        self._locks = {}
+        # created lazily so they bind to the running loop
+        self._changed = None
+        self._reaper = None
+        # number of callers waiting for a free slot
+        self._waiting = 0
+
+    @property
+    def open_connections(self) -> int:
+        """Number of connections currently open or being opened"""
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def connection(self, ip: str, username: str, password: str, port: int = 22):
+        """Borrow the connection to a miner, opening it if needed"""
+        entry = await self._acquire(ip, username, password, port)
+        try:
+            yield entry.conn
+        except (asyncssh.ConnectionLost, asyncssh.DisconnectError, ConnectionError):
+            # the miner went away mid command, make sure it is not reused
+            entry.closed = True
+            raise
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            if entry.closed:
+                self._drop(entry)
+            self._notify()
+
+    def resize(self, max_connections: int) -> None:
+        """
+        Change the cap on open connections while the pool is in use
+
+        Growing lets waiting callers in right away. Shrinking closes idle
+        connections over the new cap, busy ones are left open and
+        no new connection is made until the pool is back under it.
+        """
+        self.max_connections = max_connections
+        idle = sorted((e for e in self._entries.values() if e.users == 0 and e.conn is not None),
+                      key=lambda e: e.last_used)
+        for entry in idle[:max(0, len(self._entries) - max_connections)]:
+            self._drop(entry)
+        self._notify()
+
+    async def invalidate(self, ip: str) -> None:
+        """Close the cached connection to a miner, used when it reboots"""
+        entry = self._entries.get(ip)
+        if entry is not None:
+            entry.closed = True
+            if entry.users == 0:
+                self._drop(entry)
+            self._notify()
+
+    async def close(self) -> None:
+        """Close every connection in the pool"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for entry in list(self._entries.values()):
+            self._drop(entry)
+
+    async def _acquire(self, ip: str, username: str, password: str, port: int) -> _PoolEntry:
+        """Get a live entry for a miner, waiting for a free slot if the pool is full"""
+        self._start_reaper()
+        lock = self._locks.setdefault(ip, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(ip)
+            if entry is not None and (entry.closed or entry.username != username):
+                if entry.users == 0:
+                    self._drop(entry)
+                entry = None
+            if entry is None:
+                await self._wait_for_slot()
+                entry = _PoolEntry(ip, username)
+                self._entries[ip] = entry
+                try:
+                    entry.conn = await asyncio.wait_for(asyncssh.connect(
+                        ip, port=port, known_hosts=None, username=username, password=password,
+                        server_host_key_algs=['ssh-rsa'], client_factory=lambda: _PooledClient(entry),
+                        keepalive_interval=self.keepalive_interval, keepalive_count_max=KEEPALIVE_COUNT_MAX),
+                        timeout=self.connect_timeout)
+                except BaseException:
+                    # free the slot we reserved
+                    if self._entries.get(ip) is entry:
+                        del self._entries[ip]
+                    self._notify()
+                    raise
+            entry.users += 1
+            return entry
+
+    async def _wait_for_slot(self) -> None:
+        """Wait until opening one more connection stays under the cap"""
+        changed = self._condition()
+        async with changed:
+            while len(self._entries) >= self.max_connections:
+                # evict the least recently used idle connection if there is one
+                idle = [e for e in self._entries.values() if e.users == 0 and e.conn is not None]
+                if idle:
+                    self._drop(min(idle, key=lambda e: e.last_used))
+                    continue
+                self._waiting += 1
+                try:
+                    await changed.wait()
+                finally:
+                    self._waiting -= 1
+
+    def _drop(self, entry: _PoolEntry) -> None:
+        """Remove an entry from the pool and close its connection"""
+        if self._entries.get(entry.ip) is entry:
+            del self._entries[entry.ip]
+        entry.closed = True
+        if entry.conn is not None:
+            entry.conn.close()
+
+    def _condition(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _notify(self) -> None:
+        """Wake up anything waiting for a free slot"""
+        if not self._waiting:
+            return
+        changed = self._condition()
+
+        async def notify():
+            async with changed:
+                changed.notify_all()
+        asyncio.ensure_future(notify())
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.ensure_future(self._reap())
+
+    async def _reap(self) -> None:
+        """Close connections that have been idle for longer than idle_timeout"""
+        while True:
+            await asyncio.sleep(self.idle_timeout / 4)
+            now = time.monotonic()
+            expired = [e for e in self._entries.values()
+                       if e.users == 0 and (e.closed or now - e.last_used > self.idle_timeout)]
+            for entry in expired:
+                self._drop(entry)
+            if expired:
+                self._notify()
+
+
+# pool shared by every MinerList that doesn't bring its own
+default_pool = SSHPool()
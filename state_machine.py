@@ -0,0 +1,114 @@
+import asyncio
+import random
+import time
+
+# state every machine falls back to when a state times out or fails
+FALLBACK_STATE = "start"
+# seconds to wait after a handler fails, doubled for every failure in a row up to MAX_ERROR_DELAY
+ERROR_DELAY = 1
+MAX_ERROR_DELAY = 60
+
+
+class InvalidTransition(ValueError):
+    """A handler asked for a transition that isn't declared"""
+
+
+async def wait_until(check, timeout: float = None, initial: float = 0.5, maximum: float = 5,
+                     factor: float = 2) -> bool:
+    """
+    Call an async check until it returns True, backing off exponentially between calls
+
+    Returns False if timeout seconds pass first.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = initial
+    while True:
+        if await check():
+            return True
+        if deadline is not None and time.monotonic() + delay > deadline:
+            return False
+        # a little jitter so a bench of miners doesn't check in lockstep
+        await asyncio.sleep(delay * random.uniform(0.9, 1.1))
+        delay = min(maximum, delay * factor)
+
+
+class StateMachine:
+    """
+    Explicit states with declared transitions and per-state timeouts
+
+    run() calls the handler of the current state, which returns the next
+    state. Handlers that take longer than their state's timeout, or raise,
+    send the machine back to FALLBACK_STATE after a delay that grows with
+    every failure in a row, so a handler that keeps raising doesn't spin.
+    Listeners are called with
+    (old, new, seconds spent in old) on every transition, and the total
+    time spent in each state is kept in durations.
+    """
+    def __init__(self, initial: str, transitions: dict, timeouts: dict = None):
+        self.state = initial
+        # state -> set of states it may move to
+        self.transitions = transitions
+        # state -> seconds its handler may run, None for no limit
+        self.timeouts = timeouts or {}
+        # state -> total seconds spent in it
+        self.durations = {state: 0.0 for state in transitions}
+        # monotonic time the current state was entered
+        self.entered_at = time.monotonic()
+        # callables run on every transition
+        self.listeners = []
+
+    def subscribe(self, listener) -> None:
+        """Call listener(old, new, elapsed) on every transition"""
+        self.listeners.append(listener)
+
+    def time_in_states(self) -> dict:
+        """Total seconds spent in each state, including the current one so far"""
+        durations = dict(self.durations)
+        durations[self.state] += time.monotonic() - self.entered_at
+        return durations
+
+    def restore(self, state: str, elapsed: float = 0.0) -> None:
+        """Start in a saved state entered elapsed seconds ago, without telling listeners"""
+        if state not in self.transitions:
+            raise InvalidTransition(f"unknown state {state}")
+        self.state = state
+        self.entered_at = time.monotonic() - max(0.0, elapsed)
+
+    def transition(self, new: str) -> None:
+        """Move to a new state, it has to be declared unless it is the fallback"""
+        old = self.state
+        if new not in self.transitions:
+            raise InvalidTransition(f"unknown state {new}")
+        if new == old:
+            return
+        if new != FALLBACK_STATE and new not in self.transitions[old]:
+            raise InvalidTransition(f"{old} -> {new} is not allowed")
+        now = time.monotonic()
+        elapsed = now - self.entered_at
+        self.durations[old] += elapsed
+        self.state = new
+        self.entered_at = now
+        for listener in self.listeners:
+            listener(old, new, elapsed)
+
+    async def run(self, handlers: dict, on_error=None) -> None:
+        """
+        Run handlers forever, each one returns the next state
+
+        on_error(state, exception) is called when a handler raises or times out.
+        """
+        failures = 0
+        while True:
+            state = self.state
+            try:
+                new = await asyncio.wait_for(handlers[state](), timeout=self.timeouts.get(state))
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if on_error is not None:
+                    on_error(state, e)
+                new = FALLBACK_STATE
+                failures += 1
+                await asyncio.sleep(min(MAX_ERROR_DELAY, ERROR_DELAY * 2 ** (failures - 1)))
+            self.transition(new)
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+from identity import Identity
+from miner_data import Miner
+from miner_log import ERROR
+
+# database of install states, identities and install outcomes, kept across restarts
+STATE_FILE = os.path.join(os.getcwd(), "state.db")
+# seconds between writes of what changed, a crash loses at most this much
+FLUSH_INTERVAL = 1
+# seconds transitions and install outcomes are kept
+KEEP_SECONDS = 30 * 24 * 3600
+# state a miner resumes in after a restart, by the state it was in, anything else starts over
+RESUME_STATES = {
+    # installed, checked to be the same installed miner before monitoring resumes, see Miner.still_installed
+    "done": "done",
+    # still waiting for the user to reset it
+    "reset": "reset",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS miners (
+    ip TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    state_since REAL NOT NULL,
+    discovered INTEGER NOT NULL,
+    paused INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    firmware TEXT,
+    version TEXT,
+    model TEXT,
+    mac TEXT,
+    identity_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL,
+    from_state TEXT NOT NULL,
+    to_state TEXT NOT NULL,
+    elapsed REAL NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_at ON transitions (at);
+CREATE TABLE IF NOT EXISTS installs (
+    id INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    elapsed REAL NOT NULL,
+    firmware_sha256 TEXT,
+    error TEXT,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS installs_at ON installs (at);
+"""
+
+
+class MinerRecord:
+    """What was known about a miner when it was last saved"""
+    __slots__ = ("ip", "state", "state_since", "discovered", "paused", "tags", "identity")
+
+    def __init__(self, ip: str, state: str, state_since: float, discovered: bool, paused: bool, tags: set,
+                 identity: Identity = None):
+        self.ip = ip
+        self.state = state
+        # unix time the state was entered
+        self.state_since = state_since
+        self.discovered = discovered
+        self.paused = paused
+        self.tags = tags
+        self.identity = identity
+
+    def restore(self, miner: Miner) -> None:
+        """
+        Put a miner back where it was before the restart
+
+        Nothing is trusted blindly: a miner resumed in "done" checks it still
+        has the firmware, or is the same hardware, before monitoring, and the
+        identity is checked against the MAC address the first time it is used.
+        """
+        state = RESUME_STATES.get(self.state, "start")
+        miner.state_machine.restore(state, time.time() - self.state_since if state == self.state else 0.0)
+        miner.revalidate = state == "done"
+        miner.tags.update(self.tags)
+        if self.paused:
+            miner.running.clear()
+        miner.update_controls()
+        if self.identity is not None:
+            miner.identity.restore(self.identity)
+
+
+class StateStore:
+    """
+    SQLite store of the install state, identity and install outcomes of every miner
+
+    The database is in WAL mode, state transitions are queued as they
+    happen and written with the rest of what changed every FLUSH_INTERVAL
+    in one transaction, so the event loop never waits on the disk for long
+    and a crash loses at most the last second. Shards share the file, each
+    one only writes and deletes the miners it runs.
+    """
+    def __init__(self, path: str = STATE_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only loses the last commits on a power cut, never corrupts the file
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # other shards write to the same file
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(_SCHEMA)
+        cutoff = time.time() - KEEP_SECONDS
+        with self.db:
+            self.db.execute("DELETE FROM transitions WHERE at < ?", (cutoff,))
+            self.db.execute("DELETE FROM installs WHERE at < ?", (cutoff,))
+        # rows waiting for the next flush
+        self._transitions = []
+        self._installs = []
+        # ip -> miner row as last written, so only what changed is written again
+        self._written = {}
+
+    def load(self) -> dict:
+        """ip -> MinerRecord of every miner saved"""
+        records = {}
+        for row in self.db.execute("SELECT ip, state, state_since, discovered, paused, tags, firmware, version, "
+                                   "model, mac, identity_at FROM miners"):
+            ip, state, since, discovered, paused, tags, firmware, version, model, mac, identity_at = row
+            identity = None
+            if identity_at is not None:
+                identity = Identity(firmware, version, model, mac)
+                # keep its age so it still expires on time
+                identity.fetched_at = time.monotonic() - max(0.0, time.time() - identity_at)
+            records[ip] = MinerRecord(ip, state, since, bool(discovered), bool(paused), set(json.loads(tags)),
+                                      identity)
+        return records
+
+    def loaded(self, ips) -> None:
+        """Mark saved miners as run by this process, so they are deleted if it removes them"""
+        for ip in ips:
+            self._written.setdefault(ip, None)
+
+    def record_transition(self, miner: Miner, old: str, new: str, elapsed: float) -> None:
+        """
+        MinerList listener, queues the transition and the outcome of an install
+
+        An install the orchestrator counted as aborted, paused or stopped on
+        purpose, is left out of the install history like it is left out of
+        the failures.
+        """
+        now = time.time()
+        self._transitions.append((miner.ip, old, new, elapsed, now))
+        if old == "install" and not (new != "done" and miner.install_outcome == "aborted"):
+            ok = new == "done"
+            firmware = miner.installer.firmware if miner.installer is not None else None
+            error = None
+            if not ok:
+                error = next((entry.message for entry in reversed(miner.log.entries) if entry.level == ERROR),
+                             "install failed")
+            self._installs.append((miner.ip, int(ok), elapsed, firmware.sha256 if firmware is not None else None,
+                                   error, now))
+
+    @staticmethod
+    def _row(miner: Miner, discovered: bool) -> tuple:
+        now = time.time()
+        identity = miner.identity.identity
+        identity_at = None
+        if identity is not None:
+            identity_at = round(now - (time.monotonic() - identity.fetched_at))
+            identity_fields = (identity.firmware, identity.version, identity.model, identity.mac)
+        else:
+            identity_fields = (None, None, None, None)
+        # whole seconds, so the row only changes when something in it does
+        state_since = round(now - (time.monotonic() - miner.state_machine.entered_at))
+        return (miner.ip, miner.main_state, state_since, int(discovered), int(not miner.running.is_set()),
+                json.dumps(sorted(miner.tags)), *identity_fields, identity_at)
+
+    def flush(self, miners: list[Miner], discovered=()) -> None:
+        """Write queued transitions and install outcomes, and every miner that changed since the last flush"""
+        now = time.time()
+        rows = {}
+        for miner in miners:
+            row = self._row(miner, miner.ip in discovered)
+            if self._written.get(miner.ip) != row:
+                rows[miner.ip] = row
+        # miners this process removed, they shouldn't come back on the next restart
+        current = {miner.ip for miner in miners}
+        gone = [ip for ip in self._written if ip not in current]
+        if not (rows or gone or self._transitions or self._installs):
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO miners VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(*row, now) for row in rows.values()])
+            self.db.executemany("DELETE FROM miners WHERE ip = ?", [(ip,) for ip in gone])
+            self.db.executemany("INSERT INTO transitions (ip, from_state, to_state, elapsed, at) "
+                                "VALUES (?, ?, ?, ?, ?)", self._transitions)
+            self.db.executemany("INSERT INTO installs (ip, ok, elapsed, firmware_sha256, error, at) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", self._installs)
+        self._written.update(rows)
+        for ip in gone:
+            del self._written[ip]
+        self._transitions = []
+        self._installs = []
+
+    def install_history(self, ip: str, limit: int = 20) -> list[dict]:
+        """Latest install outcomes of a miner, newest first"""
+        return [{"ok": bool(ok), "elapsed": elapsed, "firmware_sha256": sha256, "error": error, "time": at}
+                for ok, elapsed, sha256, error, at in self.db.execute(
+                    "SELECT ok, elapsed, firmware_sha256, error, at FROM installs WHERE ip = ? "
+                    "ORDER BY at DESC LIMIT ?", (ip, limit))]
+
+    async def run(self, miner_list, discovered=None) -> None:
+        """Flush every FLUSH_INTERVAL, discovered() gives the IPs that were found by discovery"""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush(list(miner_list.miners.values()), discovered() if discovered is not None else ())
+            except sqlite3.Error as e:
+                # keep running on a locked or full disk, the queued rows are written next time
+                print(f"Could not save miner states: {e}")
+
+    def close(self) -> None:
+        self.db.close()
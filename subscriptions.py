@@ -0,0 +1,199 @@
+import hashlib
+import ipaddress
+import json
+
+from health import WARNING, CRITICAL
+
+# miners per page of the snapshot a client gets when it subscribes
+PAGE_SIZE = 200
+# biggest page a client can ask for
+MAX_PAGE_SIZE = 1000
+# keys a subscription selector can have
+SELECTOR_KEYS = ("ips", "cidr", "state", "unhealthy")
+
+
+def normalize(selector: dict or None) -> dict:
+    """
+    Check a selector and put it in one canonical form
+
+    selector can have "ips" (a list), "cidr" (a network or list of them),
+    "state" (an install state or list of them) and "unhealthy" (true for
+    only the miners that need attention). Miners have to match every key
+    given, an empty or missing selector subscribes to the whole bench.
+    Raises ValueError if it isn't valid.
+    """
+    if not selector:
+        return {}
+    if not isinstance(selector, dict):
+        raise ValueError("selector must be an object")
+    unknown = set(selector) - set(SELECTOR_KEYS)
+    if unknown:
+        raise ValueError(f"unknown selector keys {sorted(unknown)}")
+    normalized = {}
+    if "ips" in selector:
+        normalized["ips"] = sorted({str(ipaddress.ip_address(ip)) for ip in selector["ips"]})
+    if "cidr" in selector:
+        cidrs = selector["cidr"] if isinstance(selector["cidr"], list) else [selector["cidr"]]
+        normalized["cidr"] = sorted({str(ipaddress.ip_network(cidr, strict=False)) for cidr in cidrs})
+    if "state" in selector:
+        states = selector["state"] if isinstance(selector["state"], list) else [selector["state"]]
+        normalized["state"] = sorted({str(state) for state in states})
+    if selector.get("unhealthy"):
+        normalized["unhealthy"] = True
+    return normalized
+
+
+def unhealthy(data: dict) -> bool:
+    """
+    Whether a miner needs attention, from the data clients are sent
+
+    Waiting for a reset, or given a warning or critical verdict by the
+    health analyzer.
+    """
+    if data.get("State") == "reset":
+        return True
+    return data.get("Health", {}).get("status") in (WARNING, CRITICAL)
+
+
+class Subscription:
+    """
+    One distinct selector and the clients subscribed with it
+
+    members is the set of IPs the clients of this subscription have been
+    sent, so each cycle only the changes to those miners, and miners
+    moving in or out of the selection, go to its rooms.
+    """
+    def __init__(self, selector: dict):
+        self.selector = selector
+        self.key = json.dumps(selector, sort_keys=True)
+        # short and stable, used in room names
+        self.id = hashlib.sha1(self.key.encode()).hexdigest()[:12]
+        self.ips = set(selector.get("ips", []))
+        self.networks = [ipaddress.ip_network(cidr) for cidr in selector.get("cidr", [])]
+        self.states = set(selector.get("state", []))
+        # sid -> wire format of every client subscribed
+        self.clients = {}
+        self.members = set()
+
+    def room(self, fmt: str) -> str:
+        return f"sub:{self.id}:{fmt}"
+
+    def formats(self) -> set[str]:
+        return set(self.clients.values())
+
+    def matches(self, data: dict) -> bool:
+        if self.ips and data["IP"] not in self.ips:
+            return False
+        if self.networks and not any(ipaddress.ip_address(data["IP"]) in network for network in self.networks):
+            return False
+        if self.states and data.get("State") not in self.states:
+            return False
+        if self.selector.get("unhealthy") and not unhealthy(data):
+            return False
+        return True
+
+    def delta(self, delta: dict, miners: dict) -> dict or None:
+        """
+        The part of a fleet delta these clients need, None if there is nothing
+
+        Miners that start matching are sent whole, miners that stop
+        matching are sent as removed, miners are checked only when they
+        changed since data can't match differently otherwise.
+        """
+        changed = {}
+        replaced = {}
+        removed = []
+        for ip, fields in delta.get("changed", {}).items():
+            was = ip in self.members
+            now = self.matches(miners[ip])
+            if was and now:
+                changed[ip] = fields
+            elif now:
+                replaced[ip] = miners[ip]
+                self.members.add(ip)
+            elif was:
+                removed.append(ip)
+                self.members.discard(ip)
+        for ip, data in delta.get("replaced", {}).items():
+            if self.matches(data):
+                replaced[ip] = data
+                self.members.add(ip)
+            elif ip in self.members:
+                removed.append(ip)
+                self.members.discard(ip)
+        for ip in delta.get("removed", []):
+            if ip in self.members:
+                removed.append(ip)
+                self.members.discard(ip)
+        if not (changed or replaced or removed):
+            return None
+        result = {}
+        if changed:
+            result["changed"] = changed
+        if replaced:
+            result["replaced"] = replaced
+        if removed:
+            result["removed"] = removed
+        return result
+
+
+class SubscriptionManager:
+    """
+    Groups clients by what they subscribed to, so each subset is built and serialized once per cycle
+
+    Clients with the same selector and wire format share a Socket.IO room,
+    the whole bench is just the subscription with an empty selector.
+    """
+    def __init__(self):
+        # Subscription.key -> Subscription with at least one client
+        self.subscriptions = {}
+        # sid -> the subscription it is in
+        self.by_sid = {}
+
+    def subscribe(self, sid: str, selector: dict, fmt: str, miners: dict) -> tuple[Subscription, str or None]:
+        """
+        Move a client to the subscription for selector
+
+        miners is ip -> the data last sent, used to fill a new subscription.
+        Returns the subscription and the room the client has to leave, if any.
+        """
+        selector = normalize(selector)
+        old_room = self.unsubscribe(sid)
+        key = json.dumps(selector, sort_keys=True)
+        subscription = self.subscriptions.get(key)
+        if subscription is None:
+            subscription = self.subscriptions[key] = Subscription(selector)
+            subscription.members = {ip for ip, data in miners.items() if subscription.matches(data)}
+        subscription.clients[sid] = fmt
+        self.by_sid[sid] = subscription
+        return subscription, old_room
+
+    def unsubscribe(self, sid: str) -> str or None:
+        """Take a client out of its subscription, returns the room it was in"""
+        subscription = self.by_sid.pop(sid, None)
+        if subscription is None:
+            return None
+        fmt = subscription.clients.pop(sid)
+        if not subscription.clients:
+            # nobody left to send it to, stop building it
+            del self.subscriptions[subscription.key]
+        return subscription.room(fmt)
+
+    def dispatch(self, delta: dict, miners: dict) -> list[tuple[Subscription, dict]]:
+        """Split a fleet delta into the delta of every subscription, leaving out the empty ones"""
+        deltas = []
+        for subscription in self.subscriptions.values():
+            part = subscription.delta(delta, miners)
+            if part is not None:
+                deltas.append((subscription, part))
+        return deltas
+
+    @staticmethod
+    def pages(subscription: Subscription, miners: dict, page_size: int = PAGE_SIZE) -> list[dict]:
+        """Snapshot of the members of a subscription, split into pages sent one after the other"""
+        page_size = max(1, min(MAX_PAGE_SIZE, page_size))
+        ips = sorted(subscription.members, key=lambda ip: ipaddress.ip_address(ip))
+        count = max(1, -(-len(ips) // page_size))
+        return [{"page": index, "pages": count, "total": len(ips),
+                 "miners": [miners[ip] for ip in ips[index * page_size:(index + 1) * page_size]]}
+                for index in range(count)]
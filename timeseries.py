@@ -0,0 +1,292 @@
+import collections
+import math
+import mmap
+import os
+import struct
+import time
+
+# directory the history files are kept in, one per miner
+HISTORY_DIR = os.path.join(os.getcwd(), "history")
+
+# (name, seconds per slot, number of slots), raw polls first then the rollups
+TIERS = (
+    ("5s", 5, 720),      # 1 hour of raw samples
+    ("1m", 60, 1440),    # 1 day of minute averages
+    ("1h", 3600, 336),   # 2 weeks of hourly averages
+)
+
+# segment header: magic, version, step, capacity, and the rollup accumulator
+# (bucket being averaged, running sum, sample count) so averages survive a restart
+_HEADER = struct.Struct("<4sHxxIIqdIxxxx")
+_MAGIC = b"TSEG"
+_VERSION = 1
+# history file header: magic, version, number of metrics
+_FILE_HEADER = struct.Struct("<4sHH")
+_FILE_MAGIC = b"TSMF"
+# metric name at the start of its block
+_NAME = struct.Struct("<64s")
+# history files kept mapped at once, each holds a file descriptor so a big bench can't map them all
+MAX_OPEN_FILES = 128
+
+
+class Segment:
+    """
+    Fixed size ring of (time, value) slots in part of a memory mapped file
+
+    Slot i holds the bucket whose number is i modulo the capacity, so writes
+    never shift data and a window query is a direct index. Times are stored
+    as float64 and values as float32 in two separate columns.
+    """
+    def __init__(self, view: memoryview, step: int, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        size = segment_size(capacity)
+        self._map = view
+        magic, version, file_step, file_capacity, *_ = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION or file_step != step or file_capacity != capacity:
+            # new or the layout changed, start the segment over
+            self._map[:] = bytes(size)
+            _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, step, capacity, -1, 0.0, 0)
+        self.times = self._map[_HEADER.size:_HEADER.size + capacity * 8].cast("d")
+        self.values = self._map[_HEADER.size + capacity * 8:size].cast("f")
+
+    def write(self, timestamp: float, value: float) -> None:
+        """Store a raw sample, a newer one in the same slot replaces it"""
+        bucket = int(timestamp // self.step)
+        index = bucket % self.capacity
+        self.times[index] = bucket * self.step
+        self.values[index] = value
+
+    def add(self, timestamp: float, value: float) -> None:
+        """Fold a sample into the average for its slot"""
+        bucket = int(timestamp // self.step)
+        _, _, _, _, acc_bucket, acc_sum, acc_count = _HEADER.unpack_from(self._map)
+        if acc_bucket != bucket:
+            acc_bucket, acc_sum, acc_count = bucket, 0.0, 0
+        acc_sum += value
+        acc_count += 1
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self.step, self.capacity, acc_bucket, acc_sum, acc_count)
+        # the slot always holds the average so far, so a partial bucket is visible right away
+        self.write(timestamp, acc_sum / acc_count)
+
+    def read(self, start: float, end: float) -> tuple[list[float], list[float]]:
+        """Times and values of the filled slots between start and end"""
+        first = int(start // self.step)
+        last = int(end // self.step)
+        # older buckets than this have been overwritten
+        first = max(first, last - self.capacity + 1)
+        times, values = [], []
+        for bucket in range(first, last + 1):
+            index = bucket % self.capacity
+            slot_time = bucket * self.step
+            if self.times[index] == slot_time:
+                times.append(slot_time)
+                values.append(self.values[index])
+        return times, values
+
+    def close(self) -> None:
+        self.times.release()
+        self.values.release()
+        self._map.release()
+
+
+def segment_size(capacity: int) -> int:
+    return _HEADER.size + capacity * 12
+
+
+# bytes of one metric in a history file, its name then a segment per tier
+_BLOCK_SIZE = _NAME.size + sum(segment_size(capacity) for _, _, capacity in TIERS)
+
+
+class Series:
+    """All the tiers of one metric on one miner, views into the history file of the miner"""
+    def __init__(self, view: memoryview):
+        self.segments = {}
+        offset = _NAME.size
+        for name, step, capacity in TIERS:
+            size = segment_size(capacity)
+            self.segments[name] = Segment(view[offset:offset + size], step, capacity)
+            offset += size
+
+    def record(self, timestamp: float, value: float) -> None:
+        raw_name = TIERS[0][0]
+        for name, segment in self.segments.items():
+            if name == raw_name:
+                segment.write(timestamp, value)
+            else:
+                segment.add(timestamp, value)
+
+    def close(self) -> None:
+        for segment in self.segments.values():
+            segment.close()
+
+
+class HistoryFile:
+    """
+    Every metric and tier of one miner in one memory mapped file
+
+    A header, then one block per metric in the order they were first
+    recorded: the metric name and its segments. A new metric grows the
+    file by a block and maps it again, so a miner costs one file
+    descriptor however many metrics and tiers it has.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        # metric -> Series, in file order
+        self.series = {}
+        self._file = None
+        self._mmap = None
+        self._view = None
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, 0))
+        self._map()
+
+    def _map(self) -> None:
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            if size < _FILE_HEADER.size:
+                f.write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, 0))
+                size = _FILE_HEADER.size
+            self._mmap = mmap.mmap(f.fileno(), size)
+        self._view = memoryview(self._mmap)
+        magic, version, count = _FILE_HEADER.unpack_from(self._view)
+        if magic != _FILE_MAGIC or version != _VERSION or _FILE_HEADER.size + count * _BLOCK_SIZE > size:
+            # not a history file of this layout, or cut short, start over
+            self._unmap()
+            with open(self.path, "wb") as f:
+                f.write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, 0))
+            self._map()
+            return
+        self.series = {}
+        for index in range(count):
+            offset = _FILE_HEADER.size + index * _BLOCK_SIZE
+            block = self._view[offset:offset + _BLOCK_SIZE]
+            name = _NAME.unpack_from(block)[0].rstrip(b"\0").decode("utf-8", "replace")
+            self.series[name] = Series(block)
+
+    def _unmap(self) -> None:
+        for series in self.series.values():
+            series.close()
+        self.series = {}
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def get(self, metric: str) -> Series:
+        """The series of a metric, added to the file the first time"""
+        series = self.series.get(metric)
+        if series is None:
+            self.add(metric)
+            series = self.series[metric]
+        return series
+
+    def add(self, metric: str) -> None:
+        """Append a block for metric, its segments start out empty"""
+        count = len(self.series)
+        self._unmap()
+        offset = _FILE_HEADER.size + count * _BLOCK_SIZE
+        with open(self.path, "r+b") as f:
+            f.truncate(offset + _BLOCK_SIZE)
+            f.seek(offset)
+            f.write(_NAME.pack(metric.encode("utf-8")))
+            f.seek(0)
+            f.write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, count + 1))
+        self._map()
+
+    def close(self) -> None:
+        self._unmap()
+
+
+class TimeSeriesStore:
+    """
+    History of hashrate, temperature and fan data for every miner
+
+    Each miner has one history file in HISTORY_DIR holding a segment per
+    tier for each of its metrics. Samples are written to the raw tier and
+    averaged into the rollup tiers as they arrive, so no background
+    downsampling is needed. Files are mapped when a miner is first recorded
+    or queried and the least recently used are unmapped past
+    MAX_OPEN_FILES, so history is there after a restart and the store never
+    holds more than that many file descriptors.
+    """
+    def __init__(self, directory: str = HISTORY_DIR, max_open: int = MAX_OPEN_FILES):
+        self.directory = directory
+        self.max_open = max_open
+        # ip -> HistoryFile, least recently used first
+        self.files = collections.OrderedDict()
+
+    def record(self, ip: str, metrics: dict, timestamp: float = None) -> None:
+        """Record one poll worth of metrics for a miner, metrics maps name -> value"""
+        if timestamp is None:
+            timestamp = time.time()
+        history = self._file(ip, create=True)
+        for metric, value in metrics.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            history.get(metric).record(timestamp, float(value))
+
+    def metrics(self, ip: str) -> list[str]:
+        """Names of every metric recorded for a miner"""
+        history = self._file(ip)
+        return sorted(history.series) if history is not None else []
+
+    def query(self, ips: list[str], start: float, end: float = None, metrics: list[str] = None,
+              tier: str = None) -> dict:
+        """
+        Get a window of history for several miners at once
+
+        The tier defaults to the finest one that still covers start. Returns
+        {"tier": name, "series": {ip: {metric: [times, values]}}}.
+        """
+        if end is None:
+            end = time.time()
+        if tier is None:
+            tier = self.pick_tier(start, end)
+        result = {}
+        for ip in ips:
+            history = self._file(ip)
+            series = {}
+            if history is not None:
+                for metric in metrics if metrics is not None else sorted(history.series):
+                    found = history.series.get(metric)
+                    if found is not None and tier in found.segments:
+                        series[metric] = list(found.segments[tier].read(start, end))
+            result[ip] = series
+        return {"tier": tier, "series": result}
+
+    @staticmethod
+    def pick_tier(start: float, end: float) -> str:
+        """Finest tier whose retention reaches back to start"""
+        for name, step, capacity in TIERS:
+            if end - start <= step * capacity:
+                return name
+        return TIERS[-1][0]
+
+    def close(self) -> None:
+        """Unmap every file, their contents are already on disk"""
+        for history in self.files.values():
+            history.close()
+        self.files = collections.OrderedDict()
+
+    def _path(self, ip: str) -> str:
+        return os.path.join(self.directory, f"{ip}.hist")
+
+    def _file(self, ip: str, create: bool = False) -> HistoryFile or None:
+        """The mapped history file of a miner, None if it has none and create is False"""
+        history = self.files.get(ip)
+        if history is not None:
+            self.files.move_to_end(ip)
+            return history
+        path = self._path(ip)
+        if not create and not os.path.exists(path):
+            return None
+        history = HistoryFile(path)
+        self.files[ip] = history
+        while len(self.files) > self.max_open:
+            self.files.popitem(last=False)[1].close()
+        return history
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+# miners started per second once the burst is used up
+WARMUP_RATE = 50
+# miners started right away
+WARMUP_BURST = 50
+
+
+class TokenBucket:
+    """
+    Paces how fast miners start, so a big bench doesn't open every connection in the same tick
+
+    Holds up to burst tokens and refills at rate tokens a second, take()
+    waits for them. Also used as a bandwidth budget, with a token per
+    byte. Tokens are handed out in the order take() is called:
+    a waiter reserves the next token and sleeps until it is due, so
+    thousands of waiters cost no more than their sleeps.
+    """
+    def __init__(self, rate: float = WARMUP_RATE, burst: int = WARMUP_BURST):
+        self.rate = rate
+        self.burst = burst
+        # below 0 when tokens are reserved by waiters that are sleeping
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self.waiting = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self, amount: float = 1) -> None:
+        """Wait for amount tokens"""
+        self._refill()
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(-self._tokens / self.rate)
+        except asyncio.CancelledError:
+            # give the reservation back, the waiters after this one just get theirs early
+            self._tokens += amount
+            raise
+        finally:
+            self.waiting -= 1
+
+    def set_rate(self, rate: float, burst: int) -> None:
+        """Change the pace, waiters already sleeping keep the time they were given"""
+        self._refill()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = min(self._tokens, burst)